@@ -1,15 +1,24 @@
 import streamlit as st
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
+from requests.adapters import HTTPAdapter
 import pandas as pd
+import numpy as np
 import json
 import os
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, timedelta, timezone
 import plotly.express as px
 import plotly.graph_objects as go
 from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
 import hashlib
 import uuid
+import re
+import sqlite3
+import threading
+import time
+import bisect
+import io
+import queue
 
 #Importar pytz com tratamento de erro
 try:
@@ -242,6 +251,326 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# ------------------------------------------------------------
+# Estrutura das abas (cabeçalhos oficiais de cada planilha)
+# ------------------------------------------------------------
+HEADERS_FECHAMENTO_PDV = [
+    "Data_Fechamento","PDV","Operador",
+    "Qtd_Compra_Bolao","Custo_Unit_Bolao","Total_Compra_Bolao",
+    "Qtd_Compra_Raspadinha","Custo_Unit_Raspadinha","Total_Compra_Raspadinha",
+    "Qtd_Compra_LoteriaFederal","Custo_Unit_LoteriaFederal","Total_Compra_LoteriaFederal",
+    "Qtd_Venda_Bolao","Preco_Unit_Bolao","Total_Venda_Bolao",
+    "Qtd_Venda_Raspadinha","Preco_Unit_Raspadinha","Total_Venda_Raspadinha",
+    "Qtd_Venda_LoteriaFederal","Preco_Unit_LoteriaFederal","Total_Venda_LoteriaFederal",
+    "Movimentacao_Cielo","Pagamento_Premios","Vales_Despesas","Pix_Saida",
+    "Retirada_Cofre","Retirada_CaixaInterno","Dinheiro_Gaveta_Final",
+    "Saldo_Anterior","Saldo_Final_Calculado","Diferenca_Caixa",
+    "Encerrante_Relatorio","Cheques_Recebidos","Suprimento_Cofre","Troco_Anterior","Delta_Encerrante"
+]
+HEADERS_MOV_PDV = ["Data","Hora","PDV","Tipo_Mov","Valor","Vinculo_ID","Operador","Observacoes"]
+HEADERS_COFRE = ["Data","Hora","Operador","Tipo","Categoria","Origem","Destino","Valor","Observacoes","Status","Vinculo_ID"]
+HEADERS_CAIXA = [
+    "Data","Hora","Operador","Tipo_Operacao","Cliente","CPF",
+    "Valor_Bruto","Taxa_Cliente","Taxa_Banco","Valor_Liquido","Lucro",
+    "Status","Data_Vencimento_Cheque","Taxa_Percentual","Observacoes",
+    "Normalizado","Fator_Correcao",  # reparo de escala (reparar_escala_operacoes_caixa)
+    "Vinculo_ID"  # reenvio idempotente pelo DiarioGravacoes
+]
+HEADERS_ESTOQUE_MOV = [
+    "Data", "Hora", "PDV", "Produto", "Tipo_Mov",  # Entrada | Venda | Ajuste+ | Ajuste-
+    "Qtd", "Valor_Unit", "Valor_Total", "Obs",
+    "Origem", "Chave_Sync"
+]
+HEADERS_FECHAMENTO_CAIXA_INTERNO = [
+    "Data_Fechamento", "Operador", "Saldo_Dia_Anterior",
+    "Total_Saques_Cartao", "Total_Saques_PIX", "Total_Trocas_Cheque",
+    "Total_Suprimentos", "Saldo_Calculado_Dia", "Dinheiro_Contado_Gaveta",
+    "Diferenca_Caixa", "Observacoes_Fechamento"
+]
+
+# Abas conhecidas pelo sistema (criadas automaticamente no armazenamento local)
+ABAS_PADRAO = {
+    "Operacoes_Caixa": HEADERS_CAIXA,
+    "Operacoes_Cofre": HEADERS_COFRE,
+    "Movimentacoes_PDV": HEADERS_MOV_PDV,
+    "Fechamentos_PDV1": HEADERS_FECHAMENTO_PDV,
+    "Fechamentos_PDV2": HEADERS_FECHAMENTO_PDV,
+    "Estoque_Loterica_Mov": HEADERS_ESTOQUE_MOV,
+    "Fechamento_Diario_Caixa_Interno": HEADERS_FECHAMENTO_CAIXA_INTERNO,
+}
+
+# ------------------------------------------------------------
+# Esquema das abas: tipo de cada coluna (derivado dos HEADERS_*)
+# ------------------------------------------------------------
+COLUNAS_DATA = {"Data", "Data_Fechamento", "Data_Vencimento_Cheque"}
+COLUNAS_CATEGORIA = {"PDV", "Tipo_Mov", "Tipo_Operacao", "Tipo", "Produto", "Status"}
+COLUNAS_TEXTO = {
+    "Hora", "Operador", "Cliente", "CPF", "Categoria", "Origem", "Destino", "Vinculo_ID",
+    "Observacoes", "Observacoes_Fechamento", "Obs", "Chave_Sync", "Taxa_Percentual",
+    "Normalizado", "Fator_Correcao",
+}
+
+def _tipo_coluna(nome, padrao=None):
+    if nome in COLUNAS_DATA:
+        return "data"
+    if nome in COLUNAS_CATEGORIA:
+        return "categoria"
+    if nome in COLUNAS_TEXTO:
+        return "texto"
+    return padrao
+
+# nas abas conhecidas, o que não é data/categoria/texto é valor numérico
+ESQUEMAS = {
+    aba: {c: _tipo_coluna(c, "numero") for c in headers}
+    for aba, headers in ABAS_PADRAO.items()
+}
+
+def esquema_da_aba(sheet_name, cabecalho=()):
+    """Esquema registrado; para abas desconhecidas, só tipa as colunas de nome conhecido."""
+    esquema = dict(ESQUEMAS.get(sheet_name, {}))
+    for c in cabecalho:
+        if c not in esquema and _tipo_coluna(c):
+            esquema[c] = _tipo_coluna(c)
+    return esquema
+
+def tipar_frame(df, esquema):
+    """Aplica o esquema: datas -> datetime64 (meia-noite), números -> float64 (vazio = 0.0),
+    categorias -> category, texto -> str. Colunas do esquema ausentes são criadas vazias."""
+    for c, tipo in esquema.items():
+        if c not in df.columns:
+            df[c] = pd.NaT if tipo == "data" else (0.0 if tipo == "numero" else "")
+        if tipo == "data":
+            df[c] = pd.to_datetime(df[c], errors="coerce").dt.normalize()
+        elif tipo == "numero":
+            df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0.0).astype("float64")
+        elif tipo == "categoria":
+            df[c] = df[c].astype(str).astype("category")
+        elif tipo == "texto":
+            df[c] = df[c].astype(str)
+    return df
+
+# ------------------------------------------------------------
+# Armazenamento local (SQLite) — mesma interface do gspread usada pelo app
+# ------------------------------------------------------------
+def _valor_para_celula(valor):
+    """Converte um valor Python no texto que o Sheets devolveria (FORMATTED_VALUE)."""
+    if valor is None:
+        return ""
+    if isinstance(valor, bool):
+        return "TRUE" if valor else "FALSE"
+    if isinstance(valor, Decimal):
+        valor = float(valor)
+    if isinstance(valor, float):
+        if valor != valor:  # NaN
+            return ""
+        return str(int(valor)) if valor.is_integer() else repr(valor)
+    return str(valor)
+
+def _col_para_indice(letras):
+    n = 0
+    for ch in letras.upper():
+        n = n * 26 + (ord(ch) - 64)
+    return n
+
+_RE_INTERVALO_A1 = re.compile(r"^([A-Za-z]+)(\d+)?(?::([A-Za-z]+)(\d+)?)?$")
+
+def _intervalo_a1(range_name):
+    """'A5:K' -> (linha_ini, col_ini, linha_fim|None, col_fim|None), tudo 1-based."""
+    m = _RE_INTERVALO_A1.match(str(range_name).split("!")[-1].replace("$", ""))
+    if not m:
+        raise ValueError(f"Intervalo A1 inválido: {range_name}")
+    c1, r1, c2, r2 = m.groups()
+    linha_ini = int(r1) if r1 else 1
+    col_ini = _col_para_indice(c1)
+    if c2 is None:
+        return linha_ini, col_ini, (linha_ini if r1 else None), col_ini
+    return linha_ini, col_ini, (int(r2) if r2 else None), _col_para_indice(c2)
+
+def _aparar(linha):
+    """Remove células vazias do fim da linha (como a API do Sheets)."""
+    fim = len(linha)
+    while fim and linha[fim - 1] == "":
+        fim -= 1
+    return linha[:fim]
+
+def _completar(linhas):
+    """Preenche as linhas até a largura da maior (pad_values do gspread)."""
+    largura = max((len(l) for l in linhas), default=0)
+    return [l + [""] * (largura - len(l)) for l in linhas]
+
+
+class AbaSQLite:
+    """Worksheet local: cada linha da aba é um registro (pos, valores JSON) no SQLite."""
+
+    def __init__(self, planilha, title):
+        self._planilha = planilha
+        self.title = title
+
+    # ---- leitura ----
+    def _linhas(self, linha_ini=1, linha_fim=None):
+        sql = "SELECT pos, valores FROM linhas WHERE aba = ? AND pos >= ?"
+        params = [self.title, linha_ini]
+        if linha_fim is not None:
+            sql += " AND pos <= ?"
+            params.append(linha_fim)
+        with self._planilha._lock:
+            rows = self._planilha._conn.execute(sql + " ORDER BY pos", params).fetchall()
+        por_pos = {pos: _aparar(json.loads(valores)) for pos, valores in rows}
+        ultimo = max((p for p, v in por_pos.items() if v), default=linha_ini - 1)
+        return [por_pos.get(p, []) for p in range(linha_ini, ultimo + 1)]
+
+    def get_all_values(self, **kwargs):
+        return _completar(self._linhas())
+
+    def get_values(self, range_name=None, **kwargs):
+        if not range_name:
+            return self.get_all_values()
+        linha_ini, col_ini, linha_fim, col_fim = _intervalo_a1(range_name)
+        linhas = self._linhas(linha_ini, linha_fim)
+        if col_fim is None:
+            recorte = [l[col_ini - 1:] for l in linhas]
+        else:
+            recorte = [l[col_ini - 1:col_fim] for l in linhas]
+        return _completar([_aparar(l) for l in recorte])
+
+    def get_all_records(self, **kwargs):
+        from gspread.utils import numericise_all, to_records
+        valores = self.get_all_values()
+        if not valores:
+            return []
+        return to_records(valores[0], [numericise_all(l) for l in valores[1:]])
+
+    def row_values(self, row, **kwargs):
+        linhas = self._linhas(row, row)
+        return linhas[0] if linhas else []
+
+    # ---- escrita ----
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], **kwargs)
+
+    def append_rows(self, values, **kwargs):
+        p = self._planilha
+        with p._lock, p._conn:
+            ultimo = p._conn.execute("SELECT COALESCE(MAX(pos), 0) FROM linhas WHERE aba = ?",
+                                     (self.title,)).fetchone()[0]
+            p._conn.executemany(
+                "INSERT INTO linhas (aba, pos, valores) VALUES (?, ?, ?)",
+                [(self.title, ultimo + i + 1, json.dumps([_valor_para_celula(v) for v in linha]))
+                 for i, linha in enumerate(values)]
+            )
+        return {"updates": {"updatedRange": f"{self.title}!A{ultimo + 1}", "updatedRows": len(values)}}
+
+    def update(self, range_name=None, values=None, **kwargs):
+        # aceita a ordem do gspread 5 (range, values) e do gspread 6 (values, range)
+        if not isinstance(range_name, str):
+            range_name, values = values, range_name
+        linha_ini, col_ini, _, _ = _intervalo_a1(range_name or "A1")
+        p = self._planilha
+        with p._lock, p._conn:
+            for i, nova in enumerate(values or []):
+                pos = linha_ini + i
+                atual = p._conn.execute("SELECT valores FROM linhas WHERE aba = ? AND pos = ?",
+                                        (self.title, pos)).fetchone()
+                celulas = json.loads(atual[0]) if atual else []
+                fim = col_ini - 1 + len(nova)
+                if len(celulas) < fim:
+                    celulas += [""] * (fim - len(celulas))
+                celulas[col_ini - 1:fim] = [_valor_para_celula(v) for v in nova]
+                p._conn.execute("INSERT OR REPLACE INTO linhas (aba, pos, valores) VALUES (?, ?, ?)",
+                                (self.title, pos, json.dumps(celulas)))
+        return {"updatedRows": len(values or [])}
+
+    def batch_update(self, data, **kwargs):
+        with self._planilha._lock:
+            for item in data:
+                self.update(range_name=item["range"], values=item["values"])
+        return {"totalUpdatedRanges": len(data)}
+
+    def delete_rows(self, start_index, end_index=None):
+        end_index = end_index or start_index
+        qtd = end_index - start_index + 1
+        p = self._planilha
+        with p._lock, p._conn:
+            p._conn.execute("DELETE FROM linhas WHERE aba = ? AND pos BETWEEN ? AND ?",
+                            (self.title, start_index, end_index))
+            # desloca em duas etapas para não violar a chave (aba, pos)
+            p._conn.execute("UPDATE linhas SET pos = -(pos - ?) WHERE aba = ? AND pos > ?",
+                            (qtd, self.title, end_index))
+            p._conn.execute("UPDATE linhas SET pos = -pos WHERE aba = ? AND pos < 0", (self.title,))
+
+    def clear(self):
+        p = self._planilha
+        with p._lock, p._conn:
+            p._conn.execute("DELETE FROM linhas WHERE aba = ?", (self.title,))
+
+
+class PlanilhaSQLite:
+    """Substituto local do Spreadsheet do gspread, para uso offline e testes de carga."""
+
+    def __init__(self, caminho, abas_padrao=None):
+        self.caminho = caminho
+        self.id = f"sqlite:{os.path.abspath(caminho)}"
+        self.title = os.path.basename(caminho)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(caminho, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS abas (titulo TEXT PRIMARY KEY)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS linhas ("
+                " aba TEXT NOT NULL, pos INTEGER NOT NULL, valores TEXT NOT NULL,"
+                " PRIMARY KEY (aba, pos))"
+            )
+        for titulo, headers in (abas_padrao or {}).items():
+            if titulo not in self._titulos():
+                self.add_worksheet(titulo).append_row(headers)
+
+    def _titulos(self):
+        with self._lock:
+            return [t for (t,) in self._conn.execute("SELECT titulo FROM abas ORDER BY rowid")]
+
+    def worksheets(self):
+        return [AbaSQLite(self, t) for t in self._titulos()]
+
+    def worksheet(self, title):
+        if title not in self._titulos():
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return AbaSQLite(self, title)
+
+    def add_worksheet(self, title, rows=None, cols=None, index=None):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO abas (titulo) VALUES (?)", (title,))
+        return AbaSQLite(self, title)
+
+
+def _config_armazenamento():
+    """Backend de armazenamento: env STORAGE_BACKEND / st.secrets["storage"] (padrão: Google Sheets)."""
+    config = {}
+    try:
+        config = dict(st.secrets["storage"])
+    except Exception:
+        pass
+    backend = os.environ.get("STORAGE_BACKEND", config.get("backend", "sheets"))
+    caminho = os.environ.get("STORAGE_SQLITE_PATH", config.get("sqlite_path", "lotericabasededados.db"))
+    return str(backend).strip().lower(), caminho
+
+@st.cache_resource
+def conectar_sqlite(caminho):
+    try:
+        planilha = PlanilhaSQLite(caminho, ABAS_PADRAO)
+        st.success(f"🗄️ Armazenamento local (SQLite): {caminho}")
+        return planilha
+    except Exception as e:
+        st.error(f"Erro ao abrir armazenamento local {caminho}: {str(e)}")
+        return None
+
+# Função para escolher o armazenamento (Google Sheets ou SQLite local)
+def conectar_armazenamento():
+    backend, caminho = _config_armazenamento()
+    if backend == "sqlite":
+        return conectar_sqlite(caminho)
+    return conectar_google_sheets()
+
 # Função para conectar ao Google Sheets
 @st.cache_resource
 def conectar_google_sheets():
@@ -276,10 +605,95 @@ def conectar_google_sheets():
                 return None
         
         client = gspread.authorize(creds)
-        return client.open("Lotericabasededados")
+        return ConexaoPlanilhas(client, client.open("Lotericabasededados"))
     except Exception as e:
         st.error(f"Erro ao conectar com Google Sheets: {str(e)}")
         return None
+
+# ------------------------------------------------------------
+# Conexão com o Google Sheets: sessão HTTP reaproveitada e abas em cache
+# ------------------------------------------------------------
+POOL_CONEXOES = 10           # conexões keep-alive mantidas abertas com a API
+RENOVAR_TOKEN_ANTES = 300    # segundos antes de expirar em que o token é renovado em segundo plano
+
+class ConexaoPlanilhas:
+    """Spreadsheet do gspread aberto uma vez, com os handles das abas em cache por título.
+
+    worksheet(título) só vai à rede na primeira vez (uma listagem de todas as abas) ou
+    quando a aba não está na lista; o resto (id, title, ...) vem do Spreadsheet original.
+    As requisições saem pela AuthorizedSession do gspread com pool keep-alive, e uma
+    thread renova o token antes de expirar para nenhuma leitura esperar pela renovação.
+    """
+
+    def __init__(self, client, spreadsheet):
+        self._client = client
+        self._spreadsheet = spreadsheet
+        self._abas = None
+        self._lock = threading.Lock()
+        # gspread 6 guarda sessão/credenciais em client.http_client; o 5.x, no próprio client
+        self._http = getattr(client, "http_client", client)
+        self._http.session.mount("https://", HTTPAdapter(pool_connections=POOL_CONEXOES,
+                                                         pool_maxsize=POOL_CONEXOES))
+        self._parar = threading.Event()
+        threading.Thread(target=self._renovar_token, name="renovar-token-sheets", daemon=True).start()
+
+    def __getattr__(self, nome):
+        if nome.startswith("_"):
+            raise AttributeError(nome)
+        return getattr(self._spreadsheet, nome)
+
+    def _renovar_token(self):
+        from google.auth.transport.requests import Request
+        credenciais = getattr(self._http, "auth", None)
+        if credenciais is None or not hasattr(credenciais, "refresh"):
+            return
+        while not self._parar.is_set():
+            expira = getattr(credenciais, "expiry", None)  # datetime UTC ingênuo (google-auth)
+            espera = 60 if expira is None else (expira - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds() - RENOVAR_TOKEN_ANTES
+            if espera <= 0:
+                try:
+                    credenciais.refresh(Request())
+                    continue
+                except Exception:
+                    espera = 60  # falha de rede: a AuthorizedSession ainda renova sob demanda
+            self._parar.wait(min(espera, 3600))
+
+    def encerrar(self):
+        self._parar.set()
+
+    def _listar_abas(self):
+        abas = {ws.title: ws for ws in self._spreadsheet.worksheets()}
+        with self._lock:
+            self._abas = abas
+        return abas
+
+    def worksheets(self):
+        return list(self._listar_abas().values())
+
+    def worksheet(self, title):
+        with self._lock:
+            abas = self._abas
+        ws = abas.get(title) if abas is not None else None
+        if ws is None:
+            # aba nova (criada fora do app) ou primeira consulta: relista uma vez
+            ws = self._listar_abas().get(title)
+            if ws is None:
+                raise gspread.exceptions.WorksheetNotFound(title)
+        return ws
+
+    def add_worksheet(self, title, rows, cols, index=None):
+        ws = self._spreadsheet.add_worksheet(title=title, rows=rows, cols=cols, index=index)
+        with self._lock:
+            if self._abas is not None:
+                self._abas[title] = ws
+        return ws
+
+    def del_worksheet(self, worksheet):
+        resultado = self._spreadsheet.del_worksheet(worksheet)
+        with self._lock:
+            self._abas = None
+        return resultado
+
 # Função para criar ou obter worksheet
 def get_or_create_worksheet(spreadsheet, sheet_name, headers):
     try:
@@ -288,111 +702,1874 @@ def get_or_create_worksheet(spreadsheet, sheet_name, headers):
             return None
         
         worksheet = spreadsheet.worksheet(sheet_name)
-        return worksheet
+        return AbaComCache(worksheet, _sincronizador(spreadsheet))
     except:
         if spreadsheet is None:
             return None
         worksheet = spreadsheet.add_worksheet(title=sheet_name, rows="1000", cols="20")
         worksheet.append_row(headers)
-        return worksheet
-# Função para buscar dados do Google Sheets
-@st.cache_data(ttl=60)
+        _sincronizador(spreadsheet).invalidar(sheet_name, recarga_completa=True)
+        return AbaComCache(worksheet, _sincronizador(spreadsheet))
+# ------------------------------------------------------------
+# Cache incremental das abas (delta sync)
+# ------------------------------------------------------------
+TTL_DADOS = 60              # segundos até conferir se a aba ganhou linhas novas
+TTL_RECARGA_COMPLETA = 600  # recarga completa periódica (pega edições feitas fora do app)
+TTL_ABA_QUENTE = 300        # aba consultada nos últimos N s é renovada em segundo plano
+ANTECEDENCIA_RENOVACAO = 15 # renova N s antes de vencer TTL_DADOS / TTL_RECARGA_COMPLETA
+INTERVALO_RENOVACAO = 5     # segundos entre voltas do renovador
+
+def _indice_para_col(n):
+    s = ""
+    while n:
+        n, r = divmod(n - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+def _linhas_para_registros(cabecalho, linhas):
+    """Mesma conversão do get_all_records do gspread (numericise + padding)."""
+    from gspread.utils import numericise_all
+    largura = len(cabecalho)
+    return [
+        dict(zip(cabecalho, numericise_all(l[:largura] + [""] * (largura - len(l)))))
+        for l in linhas
+    ]
+
+def _mesma_linha(a, b, largura):
+    """Compara duas linhas da planilha tolerando formatação numérica ("1500" x "1500.0")."""
+    from gspread.utils import numericise
+    a, b = _aparar(list(a[:largura])), _aparar(list(b[:largura]))
+    if len(a) != len(b):
+        return False
+    for x, y in zip(a, b):
+        if x == y:
+            continue
+        nx, ny = numericise(x), numericise(y)
+        if isinstance(nx, str) or isinstance(ny, str) or abs(nx - ny) > 1e-9 * max(1.0, abs(nx)):
+            return False
+    return True
+
+
+class EstadoAba:
+    """Retrato imutável de uma aba: cabeçalho, linhas brutas (texto) e registros convertidos.
+
+    geracao muda quando linhas existentes são alteradas/removidas (recarga completa);
+    versao muda a cada alteração, inclusive quando só chegam linhas novas.
+    """
+
+    def __init__(self, cabecalho, linhas, geracao=0, versao=0, registros=None, recarregado_em=None):
+        agora = time.monotonic()
+        self.cabecalho = list(cabecalho)
+        self.linhas = linhas
+        self.registros = registros if registros is not None else _linhas_para_registros(self.cabecalho, linhas)
+        self.geracao = geracao
+        self.versao = versao
+        self.sincronizado_em = agora
+        self.recarregado_em = recarregado_em if recarregado_em is not None else agora
+        self._frame = None
+        self._frame_base = None  # (frame tipado da versão anterior, nº de linhas dele)
+        self._derivados = {}
+        self._derivados_base = None  # (derivados da versão anterior, nº de linhas dela)
+        self._receitas = {}  # chave -> (montar, acrescentar) dos derivados pedidos nesta aba
+
+    def com_linhas_novas(self, novas):
+        if not novas:
+            estado = EstadoAba(self.cabecalho, self.linhas, self.geracao, self.versao,
+                               self.registros, self.recarregado_em)
+            estado._frame, estado._frame_base = self._frame, self._frame_base
+            estado._derivados, estado._derivados_base = self._derivados, self._derivados_base
+            estado._receitas = self._receitas
+        else:
+            estado = EstadoAba(self.cabecalho, self.linhas + novas, self.geracao, self.versao + 1,
+                               self.registros + _linhas_para_registros(self.cabecalho, novas),
+                               self.recarregado_em)
+            if self._frame is not None:
+                estado._frame_base = (self._frame, len(self.registros))
+            if self._derivados:
+                estado._derivados_base = (self._derivados, len(self.registros))
+            estado._receitas = self._receitas
+        return estado
+
+    def frame(self, sheet_name):
+        """DataFrame tipado (ver ESQUEMAS) desta versão; montado uma vez, só as linhas novas são tipadas."""
+        if self._frame is None:
+            esquema = esquema_da_aba(sheet_name, self.cabecalho)
+            base, n = self._frame_base or (None, 0)
+            df = pd.DataFrame(self.registros[n:], columns=list(dict.fromkeys(self.cabecalho)) or None)
+            df = tipar_frame(df, esquema)
+            if base is not None:
+                df = pd.concat([base, df], ignore_index=True)
+                for c, tipo in esquema.items():
+                    if tipo == "categoria":
+                        df[c] = df[c].astype(str).astype("category")
+            self._frame, self._frame_base = df, None
+        return self._frame
+
+    def vinculos(self):
+        """Conjunto dos Vinculo_ID (texto da célula) desta versão, para checar duplicidade em O(1).
+
+        Quando a versão só ganhou linhas, estende o conjunto da anterior em vez de reler a aba.
+        """
+        if "vinculos" not in self._derivados:
+            col = self.cabecalho.index("Vinculo_ID") if "Vinculo_ID" in self.cabecalho else None
+            base, n = self._derivados_base or ({}, 0)
+            anteriores = base.get("vinculos")
+            if anteriores is None:
+                anteriores, n = frozenset(), 0
+            novos = {l[col] for l in self.linhas[n:] if col is not None and len(l) > col and l[col]}
+            self._derivados["vinculos"] = anteriores | novos if novos else anteriores
+        return self._derivados["vinculos"]
+
+    def aquecer(self, sheet_name, anterior):
+        """Monta o frame e as estruturas derivadas que a versão anterior já tinha em uso
+        (renovação em segundo plano: a página recebe a versão nova pronta)."""
+        if anterior is None or (anterior._frame is None and not anterior._derivados):
+            return
+        if "vinculos" in anterior._derivados:
+            self.vinculos()
+        for chave, (montar, acrescentar) in list(self._receitas.items()):
+            try:
+                self.derivado(sheet_name, chave, montar, acrescentar)
+            except Exception:
+                self._derivados.pop(chave, None)  # a página monta (e mostra o erro) quando pedir
+        self.frame(sheet_name)
+
+    def derivado(self, sheet_name, chave, montar, acrescentar=None):
+        """Estrutura derivada do frame desta versão (índice, totais...), montada uma vez.
+
+        montar(frame) monta do zero; com acrescentar(anterior, linhas_novas), uma versão que
+        só ganhou linhas estende a da versão anterior sem alterá-la (devolve um novo objeto).
+        """
+        self._receitas[chave] = (montar, acrescentar)
+        if chave not in self._derivados:
+            base, n = self._derivados_base or ({}, 0)
+            df = self.frame(sheet_name)
+            if acrescentar is not None and chave in base:
+                valor = acrescentar(base[chave], df.iloc[n:])
+            else:
+                valor = montar(df)
+            self._derivados[chave] = valor
+        return self._derivados[chave]
+
+
+class SincronizadorAbas:
+    """Mantém as abas em memória e, a cada TTL_DADOS, busca só as linhas novas.
+
+    Cai para recarga completa quando a última linha conhecida sumiu ou mudou
+    (linhas removidas/editadas), quando invalidado ou a cada TTL_RECARGA_COMPLETA.
+    Um renovador em segundo plano faz isso antes do vencimento para as abas consultadas
+    nos últimos TTL_ABA_QUENTE segundos, então a página quase sempre encontra a aba em dia.
+    """
+
+    def __init__(self):
+        self._estados = {}
+        self._recarga_pendente = set()
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._acessos = {}  # aba -> último estado() pedido (monotonic)
+        self._renovador = None
+
+    def _lock_da_aba(self, sheet_name):
+        with self._lock:
+            return self._locks.setdefault(sheet_name, threading.Lock())
+
+    def _vencimento(self, sheet_name, est, agora, antecedencia=0):
+        """"completa", "delta" ou None: o que a aba precisa (antecedencia > 0 antecipa os TTLs)."""
+        if (est is None or sheet_name in self._recarga_pendente
+                or agora - est.recarregado_em > TTL_RECARGA_COMPLETA - antecedencia):
+            return "completa"
+        if agora - est.sincronizado_em > TTL_DADOS - antecedencia:
+            return "delta"
+        return None
+
+    def estado(self, spreadsheet, sheet_name):
+        agora = time.monotonic()
+        self._acessos[sheet_name] = agora
+        self._iniciar_renovador(spreadsheet)
+        est = self._estados.get(sheet_name)
+        if self._vencimento(sheet_name, est, agora) is None:
+            return est  # estados são imutáveis e trocados inteiros: dá para ler sem o lock
+        with self._lock_da_aba(sheet_name):
+            est = self._estados.get(sheet_name)
+            vencimento = self._vencimento(sheet_name, est, time.monotonic())
+            if vencimento == "completa":
+                est = self._recarregar(spreadsheet, sheet_name, est)
+            elif vencimento == "delta":
+                est = self._sincronizar_delta(spreadsheet, sheet_name, est)
+            return est
+
+    def _recarregar(self, spreadsheet, sheet_name, anterior, preparar=None):
+        valores = spreadsheet.worksheet(sheet_name).get_all_values()
+        cabecalho, linhas = (valores[0], valores[1:]) if valores else ([], [])
+        geracao = anterior.geracao + 1 if anterior else 0
+        versao = anterior.versao + 1 if anterior else 0
+        est = EstadoAba(cabecalho, linhas, geracao, versao)
+        if anterior is not None:
+            est._receitas = dict(anterior._receitas)
+        if preparar:
+            preparar(est)
+        self._estados[sheet_name] = est
+        self._recarga_pendente.discard(sheet_name)
+        return est
+
+    def _sincronizar_delta(self, spreadsheet, sheet_name, est, preparar=None):
+        largura = max(len(est.cabecalho), 1)
+        n = len(est.linhas) + 1  # última linha já conhecida (linha 1 = cabeçalho)
+        valores = spreadsheet.worksheet(sheet_name).get_values(f"A{n}:{_indice_para_col(largura)}")
+        referencia = est.linhas[-1] if est.linhas else est.cabecalho
+        if not valores or not _mesma_linha(valores[0], referencia, largura):
+            return self._recarregar(spreadsheet, sheet_name, est, preparar)
+        novo = est.com_linhas_novas([list(l) for l in valores[1:]])
+        if preparar:
+            preparar(novo)
+        self._estados[sheet_name] = novo
+        return novo
+
+    # ---- renovação em segundo plano das abas em uso ----
+    def _iniciar_renovador(self, spreadsheet):
+        if self._renovador is None:
+            with self._lock:
+                if self._renovador is None:
+                    self._renovador = threading.Thread(target=self._renovar, args=(spreadsheet,),
+                                                       name="renovador-abas", daemon=True)
+                    self._renovador.start()
+
+    def _renovar(self, spreadsheet):
+        while True:
+            time.sleep(INTERVALO_RENOVACAO)
+            agora = time.monotonic()
+            for sheet_name, acesso in list(self._acessos.items()):
+                if agora - acesso > TTL_ABA_QUENTE:
+                    self._acessos.pop(sheet_name, None)
+                    continue
+                try:
+                    self.renovar_aba(spreadsheet, sheet_name)
+                except Exception:
+                    pass  # segue valendo o estado atual; a página tenta de novo quando ele vencer
+
+    def renovar_aba(self, spreadsheet, sheet_name):
+        """Se a aba vence em ANTECEDENCIA_RENOVACAO segundos, busca a versão nova, monta nela o
+        frame e os derivados em uso e só então a publica. Devolve se renovou."""
+        if self._vencimento(sheet_name, self._estados.get(sheet_name), time.monotonic(),
+                            ANTECEDENCIA_RENOVACAO) is None:
+            return False
+        with self._lock_da_aba(sheet_name):
+            est = self._estados.get(sheet_name)
+            if est is None:
+                return False
+            vencimento = self._vencimento(sheet_name, est, time.monotonic(), ANTECEDENCIA_RENOVACAO)
+            preparar = lambda novo: novo.aquecer(sheet_name, est)
+            if vencimento == "completa":
+                self._recarregar(spreadsheet, sheet_name, est, preparar)
+            elif vencimento == "delta":
+                self._sincronizar_delta(spreadsheet, sheet_name, est, preparar)
+            return vencimento is not None
+
+    # ---- write-through: aplica no cache o que acabou de ser gravado na planilha ----
+    def _aplicar(self, sheet_name, alteracao):
+        with self._lock_da_aba(sheet_name):
+            est = self._estados.get(sheet_name)
+            if est is None or sheet_name in self._recarga_pendente:
+                return
+            try:
+                novo = alteracao(est)
+            except Exception:
+                novo = None
+            if novo is None:
+                self._recarga_pendente.add(sheet_name)
+            else:
+                if not novo._receitas:
+                    novo._receitas = est._receitas
+                self._estados[sheet_name] = novo
+
+    def aplicar_append(self, sheet_name, linhas, linha_inicial=None):
+        novas = [_aparar([_valor_para_celula(v) for v in l]) for l in linhas]
+
+        def _alteracao(est):
+            # se a planilha recebeu linhas de outra origem, a posição não bate: recarrega
+            if linha_inicial is not None and linha_inicial != len(est.linhas) + 2:
+                return None
+            return est.com_linhas_novas(novas)
+        self._aplicar(sheet_name, _alteracao)
+
+    def aplicar_update(self, sheet_name, linha_ini, col_ini, valores):
+        self.aplicar_updates(sheet_name, [(linha_ini, col_ini, valores)])
+
+    def aplicar_updates(self, sheet_name, blocos):
+        """Vários intervalos (linha_ini, col_ini, valores) de uma vez: uma só cópia do estado e uma nova versão."""
+        def _alteracao(est):
+            cabecalho = list(est.cabecalho)
+            linhas = list(est.linhas)
+            registros = list(est.registros)
+            alteradas = set()
+            for linha_ini, col_ini, valores in blocos:
+                for i, nova in enumerate(valores):
+                    pos = linha_ini + i
+                    atual = cabecalho if pos == 1 else None
+                    if pos > 1:
+                        while len(linhas) < pos - 1:
+                            linhas.append([])
+                            registros.append(None)
+                        atual = list(linhas[pos - 2])
+                    fim = col_ini - 1 + len(nova)
+                    atual += [""] * max(0, fim - len(atual))
+                    atual[col_ini - 1:fim] = [_valor_para_celula(v) for v in nova]
+                    if pos == 1:
+                        cabecalho = _aparar(atual)
+                    else:
+                        linhas[pos - 2] = _aparar(atual)
+                        alteradas.add(pos - 2)
+            if cabecalho != est.cabecalho:
+                registros = _linhas_para_registros(cabecalho, linhas)
+            else:
+                alteradas = sorted(alteradas)
+                for idx, reg in zip(alteradas, _linhas_para_registros(cabecalho, [linhas[i] for i in alteradas])):
+                    registros[idx] = reg
+                registros = [r if r is not None else dict.fromkeys(cabecalho, "") for r in registros]
+            return EstadoAba(cabecalho, linhas, est.geracao + 1, est.versao + 1, registros, est.recarregado_em)
+        self._aplicar(sheet_name, _alteracao)
+
+    def aplicar_remocao(self, sheet_name, start_index, end_index=None):
+        end_index = end_index or start_index
+
+        def _alteracao(est):
+            if start_index < 2 or end_index - 1 > len(est.linhas):
+                return None
+            a, b = start_index - 2, end_index - 1
+            return EstadoAba(est.cabecalho, est.linhas[:a] + est.linhas[b:], est.geracao + 1, est.versao + 1,
+                             est.registros[:a] + est.registros[b:], est.recarregado_em)
+        self._aplicar(sheet_name, _alteracao)
+
+    def aplicar_limpeza(self, sheet_name):
+        self._aplicar(sheet_name, lambda est: EstadoAba([], [], est.geracao + 1, est.versao + 1))
+
+    def em_cache(self, sheet_name):
+        """Último estado da aba sem consultar a planilha (None se nunca foi carregada)."""
+        return self._estados.get(sheet_name)
+
+    def invalidar(self, sheet_name=None, recarga_completa=False):
+        with self._lock:
+            nomes = [sheet_name] if sheet_name else list(self._estados)
+            for nome in nomes:
+                if recarga_completa:
+                    self._recarga_pendente.add(nome)
+                elif nome in self._estados:
+                    self._estados[nome].sincronizado_em = 0.0
+
+_RE_LINHA_ATUALIZADA = re.compile(r"!\$?[A-Za-z]+\$?(\d+)")
+
+
+class AbaComCache:
+    """Worksheet que, após cada gravação, atualiza só a cópia em cache da própria aba."""
+
+    def __init__(self, worksheet, sincronizador):
+        self._ws = worksheet
+        self._sinc = sincronizador
+        self.title = worksheet.title
+
+    def __getattr__(self, nome):
+        return getattr(self._ws, nome)
+
+    def append_row(self, values, **kwargs):
+        resp = self._ws.append_row(values, **kwargs)
+        self._sinc.aplicar_append(self.title, [values], self._linha_inicial(resp))
+        return resp
+
+    def append_rows(self, values, **kwargs):
+        resp = self._ws.append_rows(values, **kwargs)
+        self._sinc.aplicar_append(self.title, values, self._linha_inicial(resp))
+        return resp
+
+    def update(self, range_name=None, values=None, **kwargs):
+        if not isinstance(range_name, str):
+            range_name, values = values, range_name
+        resp = self._ws.update(range_name=range_name, values=values, **kwargs)
+        try:
+            linha_ini, col_ini, _, _ = _intervalo_a1(range_name or "A1")
+            self._sinc.aplicar_update(self.title, linha_ini, col_ini, values or [])
+        except ValueError:
+            self._sinc.invalidar(self.title, recarga_completa=True)
+        return resp
+
+    def batch_update(self, data, **kwargs):
+        resp = self._ws.batch_update(data, **kwargs)
+        try:
+            blocos = [_intervalo_a1(item["range"])[:2] + (item["values"],) for item in data]
+        except ValueError:
+            self._sinc.invalidar(self.title, recarga_completa=True)
+        else:
+            self._sinc.aplicar_updates(self.title, blocos)
+        return resp
+
+    def delete_rows(self, start_index, end_index=None):
+        resp = self._ws.delete_rows(start_index, end_index)
+        self._sinc.aplicar_remocao(self.title, start_index, end_index)
+        return resp
+
+    def clear(self):
+        resp = self._ws.clear()
+        self._sinc.aplicar_limpeza(self.title)
+        return resp
+
+    @staticmethod
+    def _linha_inicial(resp):
+        try:
+            m = _RE_LINHA_ATUALIZADA.search(resp["updates"]["updatedRange"])
+            return int(m.group(1)) if m else None
+        except (KeyError, TypeError):
+            return None
+
+@st.cache_resource
+def _sincronizador_abas(chave_planilha):
+    return SincronizadorAbas()
+
+def _sincronizador(spreadsheet):
+    return _sincronizador_abas(str(getattr(spreadsheet, "id", "padrao")))
+
+# Função para buscar dados do Google Sheets (linhas novas via delta sync)
 def buscar_dados(_spreadsheet, sheet_name):
     try:
         if _spreadsheet is None:
             st.warning("⚠️ Sem conexão com Google Sheets")
             return []
         
-        worksheet = _spreadsheet.worksheet(sheet_name)
-        data = worksheet.get_all_records()
-        return data
+        estado = _sincronizador(_spreadsheet).estado(_spreadsheet, sheet_name)
+        return list(estado.registros)
     except Exception as e:
         st.warning(f"⚠️ Erro ao buscar dados de {sheet_name}: {str(e)}")
         return []
 
+# ------------------------------------------------------------
+# Gravação em lote de uma operação (várias abas espelhadas)
+# ------------------------------------------------------------
+TENTATIVAS_GRAVACAO = 3
+
+def _erro_transitorio(e):
+    """Falhas que valem nova tentativa: rede, cota (429), 5xx da API e banco local ocupado."""
+    if isinstance(e, gspread.exceptions.APIError):
+        status = getattr(getattr(e, "response", None), "status_code", None)
+        return status in (429, 500, 502, 503, 504)
+    return isinstance(e, (OSError, sqlite3.OperationalError))
+
+
+class TransacaoPlanilhas:
+    """Junta as linhas de uma operação e grava um único append_rows por aba.
+
+    Linhas com vinculo_id não são regravadas se a aba já tiver esse Vinculo_ID,
+    então uma retentativa (ou um reenvio) completa o espelhamento sem duplicar.
+    """
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self._abas = {}  # aba -> (headers, [(linha, vinculo_id)])
+
+    def adicionar(self, sheet_name, headers, row, vinculo_id=None):
+        self._abas.setdefault(sheet_name, (list(headers), []))[1].append((list(row), vinculo_id))
+
+    def __len__(self):
+        return sum(len(itens) for _, itens in self._abas.values())
+
+    def para_json(self):
+        """Linhas ainda não gravadas, para guardar no DiarioGravacoes."""
+        return json.dumps([[aba, headers, itens] for aba, (headers, itens) in self._abas.items()], default=str)
+
+    @classmethod
+    def de_json(cls, spreadsheet, texto):
+        tx = cls(spreadsheet)
+        for aba, headers, itens in json.loads(texto):
+            for row, vinculo_id in itens:
+                tx.adicionar(aba, headers, row, vinculo_id)
+        return tx
+
+    def confirmar(self):
+        """Grava todas as abas; devolve quantas linhas foram efetivamente escritas."""
+        gravadas = 0
+        for sheet_name, (headers, itens) in self._abas.items():
+            ws = get_or_create_worksheet(self.spreadsheet, sheet_name, headers)
+            self._completar_cabecalho(ws, sheet_name, headers)
+            gravadas += self._gravar_aba(ws, sheet_name, itens)
+        self._abas = {}
+        return gravadas
+
+    def _completar_cabecalho(self, ws, sheet_name, headers):
+        """Aba criada com um cabeçalho mais antigo (prefixo do atual) ganha as colunas novas no fim."""
+        cabecalho = _sincronizador(self.spreadsheet).estado(self.spreadsheet, sheet_name).cabecalho
+        if cabecalho and len(cabecalho) < len(headers) and list(headers[:len(cabecalho)]) == cabecalho:
+            ws.update(range_name="A1", values=[list(headers)])
+
+    def _gravar_aba(self, ws, sheet_name, itens):
+        sinc = _sincronizador(self.spreadsheet)
+        enviadas = None
+        for tentativa in range(TENTATIVAS_GRAVACAO):
+            est = sinc.estado(self.spreadsheet, sheet_name)
+            if enviadas and self._ja_gravadas(est, enviadas):
+                return len(enviadas)  # a tentativa anterior chegou a gravar
+            enviadas = self._pendentes(est, itens)
+            if not enviadas:
+                return 0
+            try:
+                ws.append_rows(enviadas)
+                return len(enviadas)
+            except Exception as e:
+                if tentativa == TENTATIVAS_GRAVACAO - 1 or not _erro_transitorio(e):
+                    raise
+                sinc.invalidar(sheet_name)
+                time.sleep(2 ** tentativa)
+        return 0
+
+    @staticmethod
+    def _pendentes(est, itens):
+        tem_vinculo = "Vinculo_ID" in est.cabecalho
+        existentes, nesta = est.vinculos(), set()
+        linhas = []
+        for row, vinc in itens:
+            if vinc and tem_vinculo:
+                if str(vinc) in existentes or str(vinc) in nesta:
+                    continue
+                nesta.add(str(vinc))
+            linhas.append(row)
+        return linhas
+
+    @staticmethod
+    def _ja_gravadas(est, linhas):
+        n, largura = len(linhas), max(len(est.cabecalho), 1)
+        if len(est.linhas) < n:
+            return False
+        return all(_mesma_linha(a, [_valor_para_celula(v) for v in b], largura)
+                   for a, b in zip(est.linhas[-n:], linhas))
+
+# Abas que compartilham Vinculo_ID (um lançamento espelhado entre elas usa o mesmo ID)
+ABAS_VINCULADAS = ("Operacoes_Cofre", "Movimentacoes_PDV", "Operacoes_Caixa")
+
+def vinculo_em_uso(spreadsheet, vinculo_id, abas=ABAS_VINCULADAS):
+    """True se alguma das abas já tem o Vinculo_ID, olhando só as versões já em cache
+    (nunca lê a planilha: roda no submit dos formulários)."""
+    sinc = _sincronizador(spreadsheet)
+    for sheet_name in abas:
+        est = sinc.em_cache(sheet_name)
+        if est is None:
+            continue  # aba ainda não carregada: o sorteio do ID já basta
+        if str(vinculo_id) in est.vinculos():
+            return True
+    return False
+
+def novo_vinculo(spreadsheet, prefixo, diario=None):
+    """Vinculo_ID novo ("PREFIXO-xxxxxxxx") que ainda não aparece em ABAS_VINCULADAS (em cache)
+    nem, se informado, no DiarioGravacoes (onde o id da operação é único)."""
+    from uuid import uuid4
+    while True:
+        vinculo_id = f"{prefixo}-{uuid4().hex[:8]}"
+        if diario is not None and diario.registrado(vinculo_id):
+            continue
+        if spreadsheet is None or not vinculo_em_uso(spreadsheet, vinculo_id):
+            return vinculo_id
+
+# ------------------------------------------------------------
+# Diário de gravações (write-ahead log) das operações de balcão
+# ------------------------------------------------------------
+INTERVALO_DIARIO = 5        # segundos entre conferências do diário sem aviso de operação nova
+ESPERA_MAXIMA_DIARIO = 60   # teto da espera entre tentativas de reenviar uma operação
+MAX_TENTATIVAS_DIARIO = 10  # depois disso a operação sai da fila (ver DiarioGravacoes.mortas)
+
+def _caminho_diario():
+    """Arquivo do diário: env DIARIO_GRAVACOES_PATH / st.secrets["storage"]["diario_path"]."""
+    config = {}
+    try:
+        config = dict(st.secrets["storage"])
+    except Exception:
+        pass
+    return os.environ.get("DIARIO_GRAVACOES_PATH", config.get("diario_path", "diario_gravacoes.db"))
+
+
+class DiarioGravacoes:
+    """Write-ahead log local das operações de balcão.
+
+    registrar() grava a transação num SQLite local e volta na hora; uma thread envia as
+    pendentes à planilha na ordem do registro, repetindo a primeira enquanto a falha for
+    transitória (nenhuma passa à frente). Falha não transitória, ou mais de MAX_TENTATIVAS_DIARIO,
+    tira a operação da fila (morto_em) até alguém reenviar() ou descartar() pela página.
+    Reenviar é seguro: TransacaoPlanilhas não regrava um Vinculo_ID que a aba já tem, e o
+    id da operação é o Vinculo_ID das linhas dela.
+    """
+
+    def __init__(self, spreadsheet, caminho):
+        self._spreadsheet = spreadsheet
+        self._planilha = str(getattr(spreadsheet, "id", "padrao"))
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(caminho, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS diario ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT, planilha TEXT NOT NULL, id TEXT NOT NULL UNIQUE,"
+                " registrado_em TEXT NOT NULL, transacao TEXT NOT NULL, enviado_em TEXT,"
+                " tentativas INTEGER NOT NULL DEFAULT 0, erro TEXT, morto_em TEXT, descartado_em TEXT)"
+            )
+            colunas = {linha[1] for linha in self._conn.execute("PRAGMA table_info(diario)")}
+            for coluna in ("morto_em", "descartado_em"):  # diário criado antes dessas colunas
+                if coluna not in colunas:
+                    self._conn.execute(f"ALTER TABLE diario ADD COLUMN {coluna} TEXT")
+        self._aviso = threading.Event()
+        self._aviso.set()  # envia o que ficou pendente de uma execução anterior
+        threading.Thread(target=self._rodar, name="diario-gravacoes", daemon=True).start()
+
+    def _executar(self, sql, parametros=()):
+        with self._lock, self._conn:
+            return self._conn.execute(sql, parametros).fetchall()
+
+    def registrar(self, id_operacao, tx):
+        """Guarda a transação (durável) e agenda o envio; registrar de novo o mesmo id não duplica."""
+        self._executar(
+            "INSERT OR IGNORE INTO diario (planilha, id, registrado_em, transacao) VALUES (?, ?, ?, ?)",
+            (self._planilha, str(id_operacao), datetime.now().isoformat(timespec="seconds"), tx.para_json()))
+        self._aviso.set()
+        return id_operacao
+
+    _NA_FILA = "enviado_em IS NULL AND morto_em IS NULL AND descartado_em IS NULL"
+
+    def registrado(self, id_operacao):
+        """True se o id já está no diário (enviado ou não); registrar() ignoraria um id repetido."""
+        return bool(self._executar("SELECT 1 FROM diario WHERE id = ?", (str(id_operacao),)))
+
+    def pendentes(self):
+        return self._executar(f"SELECT COUNT(*) FROM diario WHERE planilha = ? AND {self._NA_FILA}",
+                              (self._planilha,))[0][0]
+
+    def erros(self):
+        """(id, tentativas, último erro) das operações pendentes que já falharam."""
+        return self._executar(
+            f"SELECT id, tentativas, erro FROM diario WHERE planilha = ? AND {self._NA_FILA} AND erro IS NOT NULL"
+            " ORDER BY seq", (self._planilha,))
+
+    def mortas(self):
+        """(id, registrado_em, tentativas, último erro) das operações fora da fila, à espera de decisão."""
+        return self._executar(
+            "SELECT id, registrado_em, tentativas, erro FROM diario WHERE planilha = ? AND enviado_em IS NULL"
+            " AND morto_em IS NOT NULL AND descartado_em IS NULL ORDER BY seq", (self._planilha,))
+
+    def reenviar(self, id_operacao):
+        """Devolve uma operação morta à fila, na posição original, com as tentativas zeradas."""
+        self._executar("UPDATE diario SET morto_em = NULL, tentativas = 0, erro = NULL"
+                       " WHERE planilha = ? AND id = ? AND enviado_em IS NULL",
+                       (self._planilha, str(id_operacao)))
+        self._aviso.set()
+
+    def descartar(self, id_operacao):
+        """Desiste de uma operação morta; ela fica no diário só como registro."""
+        self._executar("UPDATE diario SET descartado_em = ? WHERE planilha = ? AND id = ? AND enviado_em IS NULL",
+                       (datetime.now().isoformat(timespec="seconds"), self._planilha, str(id_operacao)))
+
+    def aguardar(self, timeout=None):
+        limite = None if timeout is None else time.monotonic() + timeout
+        while self.pendentes() and (limite is None or time.monotonic() < limite):
+            self._aviso.set()
+            time.sleep(0.05)
+        return not self.pendentes()
+
+    def _proxima(self):
+        linhas = self._executar(
+            f"SELECT seq, transacao, tentativas FROM diario WHERE planilha = ? AND {self._NA_FILA}"
+            " ORDER BY seq LIMIT 1", (self._planilha,))
+        return linhas[0] if linhas else None
+
+    def _enviar_pendentes(self):
+        """Envia a fila em ordem; devolve quanto esperar antes da próxima rodada."""
+        while (proxima := self._proxima()) is not None:
+            seq, transacao, tentativas = proxima
+            try:
+                TransacaoPlanilhas.de_json(self._spreadsheet, transacao).confirmar()
+            except Exception as e:
+                if not _erro_transitorio(e) or tentativas + 1 >= MAX_TENTATIVAS_DIARIO:
+                    # não adianta repetir: sai da fila para não travar as operações seguintes
+                    self._executar("UPDATE diario SET tentativas = tentativas + 1, erro = ?, morto_em = ?"
+                                   " WHERE seq = ?", (str(e), datetime.now().isoformat(timespec="seconds"), seq))
+                    continue
+                self._executar("UPDATE diario SET tentativas = tentativas + 1, erro = ? WHERE seq = ?",
+                               (str(e), seq))
+                return min(2 ** tentativas, ESPERA_MAXIMA_DIARIO)
+            self._executar("UPDATE diario SET enviado_em = ?, erro = NULL WHERE seq = ?",
+                           (datetime.now().isoformat(timespec="seconds"), seq))
+        return INTERVALO_DIARIO
+
+    def _rodar(self):
+        espera = INTERVALO_DIARIO
+        while True:
+            self._aviso.wait(espera)
+            self._aviso.clear()
+            try:
+                espera = self._enviar_pendentes()
+            except Exception:
+                # falha fora do envio (ex.: o próprio SQLite do diário): a thread segue e tenta de novo
+                espera = ESPERA_MAXIMA_DIARIO
+
+@st.cache_resource(show_spinner=False)
+def _diario_gravacoes(_spreadsheet, chave_planilha):
+    return DiarioGravacoes(_spreadsheet, _caminho_diario())
+
+def diario_gravacoes(spreadsheet):
+    return _diario_gravacoes(spreadsheet, str(getattr(spreadsheet, "id", "padrao")))
+
+# ------------------------------------------------------------
+# DataFrames tipados por aba (cacheados por versão da aba)
+# ------------------------------------------------------------
+def carregar_tabela(spreadsheet, sheet_name):
+    """DataFrame tipado da aba, compartilhado entre páginas/reruns até a aba mudar.
+
+    Não altere o frame devolvido: filtre com .loc ou faça .copy() antes.
+    """
+    try:
+        if spreadsheet is None:
+            raise RuntimeError("sem conexão com Google Sheets")
+        return _sincronizador(spreadsheet).estado(spreadsheet, sheet_name).frame(sheet_name)
+    except Exception as e:
+        st.warning(f"⚠️ Erro ao buscar dados de {sheet_name}: {str(e)}")
+        return tipar_frame(pd.DataFrame(), esquema_da_aba(sheet_name))
+
+
+class ContextoDados:
+    """Dados de uma renderização de página: frames tipados (carregar_tabela) e estruturas derivadas.
+
+    As derivadas (derivado()) ficam na versão da aba e são reaproveitadas até ela mudar.
+    """
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def df(self, sheet_name):
+        return carregar_tabela(self.spreadsheet, sheet_name)
+
+    def derivado(self, sheet_name, chave, montar, acrescentar=None):
+        """Estrutura derivada da aba (ver EstadoAba.derivado), compartilhada até a aba mudar."""
+        estado = _sincronizador(self.spreadsheet).estado(self.spreadsheet, sheet_name)
+        return estado.derivado(sheet_name, chave, montar, acrescentar)
+
+    def indice_mov_pdv(self):
+        return self.derivado("Movimentacoes_PDV", "indice_mov_pdv",
+                             IndiceMovPDV.montar, IndiceMovPDV.com_linhas)
+
+    def livro_fechamentos(self, sheet_name, por="PDV"):
+        return self.derivado(sheet_name, f"livro_fechamentos:{por}", lambda df: LivroFechamentos(df, por))
+
+    def localizador_fechamentos(self, sheet_name):
+        return self.derivado(sheet_name, "localizador_fechamentos",
+                             LocalizadorFechamentos.montar, LocalizadorFechamentos.com_linhas)
+
+    def posicao_estoque(self):
+        return self.derivado("Estoque_Loterica_Mov", "posicao_estoque",
+                             PosicaoEstoque.montar, PosicaoEstoque.com_linhas)
+
+    def relatorio_fechamentos(self, sheet_name, pdv):
+        return self.derivado(sheet_name, f"relatorio_fechamentos:{pdv}",
+                             lambda df: RelatorioFechamentos(df, pdv))
+
+    def cubo_fechamentos(self, sheet_name, pdv):
+        return self.derivado(sheet_name, f"cubo_fechamentos:{pdv}",
+                             lambda df: CuboFechamentos.montar(df, pdv), CuboFechamentos.com_linhas)
+
+    def historico_caixa(self):
+        return self.derivado("Operacoes_Caixa", "historico",
+                             lambda df: ConsultaHistorico(normalizar_frame(df), "Tipo_Operacao",
+                                                          ["Valor_Bruto", "Taxa_Cliente"]))
+
+    def historico_cofre(self):
+        return self.derivado("Operacoes_Cofre", "historico", lambda df: ConsultaHistorico(df, "Tipo", ["Valor"]))
+
+    def resumo_caixa_interno(self):
+        return self.derivado("Operacoes_Caixa", "resumo_caixa_interno",
+                             ResumoCaixaInterno.montar, ResumoCaixaInterno.com_linhas)
+
+    def versoes(self, abas):
+        """Identifica o conteúdo atual das abas: muda a cada alteração e a cada recarga."""
+        sinc = _sincronizador(self.spreadsheet)
+        return tuple((e.versao, e.recarregado_em) for e in (sinc.estado(self.spreadsheet, a) for a in abas))
+
+
+# ------------------------------------------------------------
+# Exportações (CSV/Parquet): geradas só no clique, em blocos, e guardadas por versão das abas
+# ------------------------------------------------------------
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+LINHAS_POR_BLOCO_EXPORTACAO = 5000
+EXPORTACOES_EM_CACHE = 16
+FORMATOS_EXPORTACAO = {"CSV": ("csv", "text/csv"), "Parquet": ("parquet", "application/vnd.apache.parquet")}
+
+def _blocos(df, tamanho=LINHAS_POR_BLOCO_EXPORTACAO):
+    for i in range(0, len(df), tamanho):
+        yield df.iloc[i:i + tamanho]
+
+def exportar_csv(df):
+    """CSV (UTF-8) escrito bloco a bloco, sem montar o texto da tabela inteira de uma vez."""
+    buf = io.BytesIO()
+    buf.write(df.head(0).to_csv(index=False).encode("utf-8"))
+    for bloco in _blocos(df):
+        buf.write(bloco.to_csv(index=False, header=False).encode("utf-8"))
+    return buf.getvalue()
+
+def exportar_parquet(df):
+    """Parquet com um row group por bloco (requer pyarrow)."""
+    if not PYARROW_AVAILABLE:
+        raise RuntimeError("Exportação Parquet requer o pacote pyarrow.")
+    buf = io.BytesIO()
+    esquema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(buf, esquema) as escritor:
+        for bloco in _blocos(df):
+            escritor.write_table(pa.Table.from_pandas(bloco, schema=esquema, preserve_index=False))
+    return buf.getvalue()
+
+
+class CacheExportacoes:
+    """Arquivos exportados por (nome, filtro, versões das abas, formato), com descarte LRU.
+
+    Como a chave leva a versão das abas, qualquer gravação gera um arquivo novo no próximo clique.
+    """
+
+    GERADORES = {"CSV": exportar_csv, "Parquet": exportar_parquet}
+
+    def __init__(self, limite=EXPORTACOES_EM_CACHE):
+        self.limite = limite
+        self._arquivos = {}
+        self._lock = threading.Lock()
+
+    def obter(self, chave, formato, montar_frame):
+        chave = (*chave, formato)
+        with self._lock:
+            if chave in self._arquivos:
+                self._arquivos[chave] = self._arquivos.pop(chave)  # mais recente por último
+                return self._arquivos[chave]
+        dados = self.GERADORES[formato](montar_frame())
+        with self._lock:
+            self._arquivos[chave] = dados
+            while len(self._arquivos) > self.limite:
+                self._arquivos.pop(next(iter(self._arquivos)))
+        return dados
+
+_EXPORTACOES = CacheExportacoes()
+
+def _com_data(df, coluna="Data"):
+    """Cópia com a coluna de data (datetime64) como date, para exibir/exportar sem hora."""
+    return df.assign(**{coluna: df[coluna].dt.date})
+
+def botao_exportacao(rotulo, nome_arquivo, chave, montar_frame, key):
+    """Escolha de formato + st.download_button que só gera o arquivo quando clicado.
+
+    chave = (nome, filtro, versões das abas); montar_frame() devolve o DataFrame a exportar
+    e roda fora do script (não use comandos st nele).
+    """
+    formatos = list(FORMATOS_EXPORTACAO) if PYARROW_AVAILABLE else ["CSV"]
+    col_fmt, col_btn = st.columns([1, 3])
+    with col_fmt:
+        formato = st.selectbox("Formato", formatos, key=f"{key}_formato", label_visibility="collapsed")
+    extensao, mime = FORMATOS_EXPORTACAO[formato]
+    with col_btn:
+        st.download_button(f"{rotulo} ({formato})",
+                           data=lambda: _EXPORTACOES.obter(chave, formato, montar_frame),
+                           file_name=f"{nome_arquivo}.{extensao}", mime=mime, key=key, on_click="ignore")
+
+
+class IndiceMovPDV:
+    """Totais da Movimentacoes_PDV por (PDV, data, Tipo_Mov normalizado): (valor, [Vinculo_ID]).
+
+    Imutável: com_linhas devolve um novo índice com as linhas novas somadas.
+    """
+
+    def __init__(self, entradas=None):
+        self._entradas = entradas or {}
+
+    @staticmethod
+    def _agrupar(df):
+        if df.empty:
+            return {}
+        chaves = pd.DataFrame({
+            "PDV": df["PDV"].astype(str).to_numpy(),
+            "Data": df["Data"].to_numpy(),
+            "Tipo": df["Tipo_Mov"].astype(str).str.lower().str.strip().to_numpy(),
+        })
+        grupos = chaves.groupby(["PDV", "Data", "Tipo"], sort=False).indices
+        valores = df["Valor"].to_numpy()
+        vinculos = df["Vinculo_ID"].to_numpy()
+        entradas = {}
+        for (pdv, data, tipo), pos in grupos.items():
+            ids = [str(v) for v in vinculos[pos] if not pd.isna(v)]
+            entradas[(pdv, pd.Timestamp(data), tipo)] = (float(valores[pos].sum()), ids)
+        return entradas
+
+    @classmethod
+    def montar(cls, df):
+        return cls(cls._agrupar(df))
+
+    def com_linhas(self, df_novas):
+        entradas = dict(self._entradas)
+        for chave, (total, ids) in self._agrupar(df_novas).items():
+            if chave in entradas:
+                total_ant, ids_ant = entradas[chave]
+                total, ids = total_ant + total, ids_ant + ids
+            entradas[chave] = (total, ids)
+        return IndiceMovPDV(entradas)
+
+    def total(self, pdv, data, tipos):
+        """(soma de Valor, Vinculo_IDs) do PDV no dia para os Tipo_Mov informados (sem diferenciar caixa)."""
+        total, ids = 0.0, []
+        data = pd.Timestamp(data)
+        for tipo in dict.fromkeys(str(t).lower().strip() for t in tipos):
+            entrada = self._entradas.get((str(pdv), data, tipo))
+            if entrada is not None:
+                total += entrada[0]
+                ids += entrada[1]
+        return total, ids
+
+class LivroFechamentos:
+    """Fechamentos de uma aba Fechamentos_PDVx por PDV, ordenados por Data_Fechamento,
+    para achar o último fechamento antes de uma data por busca binária.
+    Com por=None (abas sem PDV, como a do Caixa Interno) é uma sequência só, consultada com pdv=None."""
+
+    def __init__(self, df, por="PDV"):
+        self._por_pdv = {}
+        if df.empty or "Data_Fechamento" not in df.columns:
+            return
+        df = df[df["Data_Fechamento"].notna()]
+        grupos = df.groupby(df[por].astype(str), sort=False) if por else [(None, df)]
+        for pdv, grupo in grupos:
+            # estável: no mesmo dia vale o último lançado na planilha
+            grupo = grupo.sort_values("Data_Fechamento", kind="mergesort").reset_index(drop=True)
+            self._por_pdv[pdv] = (grupo["Data_Fechamento"].to_numpy(), grupo)
+
+    def anterior(self, pdv, data):
+        """Linha (Series) do último fechamento do PDV com Data_Fechamento < data, ou None."""
+        datas, grupo = self._por_pdv.get(None if pdv is None else str(pdv), (None, None))
+        if datas is None:
+            return None
+        i = int(np.searchsorted(datas, np.datetime64(pd.Timestamp(data)), side="left"))
+        return grupo.iloc[i - 1] if i else None
+
+class LocalizadorFechamentos:
+    """(PDV, Data_Fechamento) -> nº da linha na planilha (1 = cabeçalho), primeira ocorrência.
+
+    Montado do frame da aba (posição i = linha i + 2). Vale para a versão de onde saiu:
+    update/delete_rows geram outra geração da aba e o localizador é remontado; com_linhas
+    só acrescenta as linhas anexadas ao final.
+    """
+
+    def __init__(self, linhas=None):
+        self._linhas = linhas or {}
+
+    @classmethod
+    def montar(cls, df):
+        return cls().com_linhas(df)
+
+    def com_linhas(self, df_novas):
+        if df_novas.empty or "Data_Fechamento" not in df_novas.columns:
+            return self
+        linhas = dict(self._linhas)
+        datas = df_novas["Data_Fechamento"].dt.normalize()
+        ok = datas.notna().to_numpy()
+        pdvs = df_novas["PDV"].astype(str).to_numpy()[ok]
+        for pdv, data, pos in zip(pdvs, datas[ok], df_novas.index.to_numpy()[ok]):
+            linhas.setdefault((pdv, data), int(pos) + 2)
+        return LocalizadorFechamentos(linhas)
+
+    def linha(self, pdv, data):
+        return self._linhas.get((str(pdv), pd.Timestamp(data).normalize()))
+
+class ConsultaHistorico:
+    """Histórico de uma aba para telas paginadas: posições ordenadas por (Data, Hora) e filtros
+    de período/tipo resolvidos sobre arrays, antes de montar as linhas.
+
+    consultar() devolve só a página pedida, o nº de linhas do filtro e as somas do filtro.
+    """
+
+    POR_PAGINA = 200
+
+    def __init__(self, df, col_tipo, colunas_soma):
+        self.df = df.reset_index(drop=True)
+        ordem_cols = [c for c in ("Data", "Hora") if c in self.df.columns]
+        if ordem_cols:
+            ordem = self.df.sort_values(ordem_cols, kind="mergesort", na_position="first").index.to_numpy()
+        else:
+            ordem = self.df.index.to_numpy()
+        datas = self.df["Data"] if "Data" in self.df.columns else pd.Series(pd.NaT, index=self.df.index)
+        self._ordem = ordem
+        self._sem_data = int(datas.isna().sum())  # ficam no início da ordem
+        self._datas = pd.to_datetime(datas).to_numpy()[ordem[self._sem_data:]]
+        self._tipos = self.df[col_tipo].astype(str).to_numpy()[ordem] if col_tipo in self.df.columns else None
+        self._somas = {c: pd.to_numeric(self.df[c], errors="coerce").fillna(0.0).to_numpy()[ordem]
+                       for c in colunas_soma if c in self.df.columns}
+
+    def consultar(self, ini=None, fim=None, tipo=None, pagina=1, por_pagina=POR_PAGINA):
+        """(linhas da página, nº de linhas do filtro, {coluna: soma}); mais recentes primeiro.
+
+        Sem período, as linhas sem Data vão para o fim; com período, ficam de fora.
+        """
+        sel = self._selecao(ini, fim, tipo)
+        somas = {c: float(v[sel].sum()) for c, v in self._somas.items()}
+        inicio = (max(int(pagina), 1) - 1) * por_pagina
+        return self.df.iloc[self._ordem[sel[inicio:inicio + por_pagina]]], len(sel), somas
+
+    def linhas(self, ini=None, fim=None, tipo=None):
+        """Todas as linhas do filtro, na ordem de consultar() (para exportação)."""
+        return self.df.iloc[self._ordem[self._selecao(ini, fim, tipo)]]
+
+    def _selecao(self, ini, fim, tipo):
+        k = self._sem_data
+        a = k + (int(np.searchsorted(self._datas, np.datetime64(pd.Timestamp(ini)), side="left")) if ini else 0)
+        b = k + (int(np.searchsorted(self._datas, np.datetime64(pd.Timestamp(fim)), side="right"))
+                 if fim else len(self._datas))
+        sel = np.arange(b - 1, a - 1, -1)
+        if ini is None and fim is None:
+            sel = np.concatenate([sel, np.arange(k - 1, -1, -1)])
+        if tipo is not None and self._tipos is not None:
+            sel = sel[self._tipos[sel] == tipo]
+        return sel
+
+class ResumoCaixaInterno:
+    """Totais diários da Operacoes_Caixa (já normalizada) por Tipo_Operacao: somas de
+    Valor_Bruto, Taxa_Cliente, Taxa_Banco, Valor_Liquido e Lucro e nº de operações.
+
+    Imutável: com_linhas devolve um novo resumo com as linhas novas somadas, então cada
+    operação gravada (write-through no cache da aba) atualiza só o dia dela.
+    """
+
+    COLUNAS = ["Valor_Bruto", "Taxa_Cliente", "Taxa_Banco", "Valor_Liquido", "Lucro"]
+    TIPOS_SAQUE_CARTAO = ("Saque Cartão Débito", "Saque Cartão Crédito")
+    TIPOS_PIX = ("Saque PIX",)
+    TIPOS_CHEQUE = ("Cheque à Vista", "Cheque Pré-datado", "Cheque com Taxa Manual")
+
+    def __init__(self, dias=None):
+        self._dias = dias or {}  # dia -> {Tipo_Operacao: array(COLUNAS + [nº de operações])}
+
+    @classmethod
+    def _agrupar(cls, df):
+        df = normalizar_frame(df)
+        df = df[df["Data"].notna()]
+        if df.empty:
+            return {}
+        grupos = df.groupby([df["Data"], df["Tipo_Operacao"].astype(str)], sort=False)
+        somas = grupos[cls.COLUNAS].sum()
+        somas["Operacoes"] = grupos.size()
+        dias = {}
+        for (dia, tipo), linha in zip(somas.index, somas.to_numpy(dtype="float64")):
+            dias.setdefault(dia, {})[tipo] = linha
+        return dias
+
+    @classmethod
+    def montar(cls, df):
+        return cls(cls._agrupar(df))
+
+    def com_linhas(self, df_novas):
+        dias = dict(self._dias)
+        for dia, tipos in self._agrupar(df_novas).items():
+            atual = dict(dias.get(dia, {}))
+            for tipo, linha in tipos.items():
+                atual[tipo] = atual[tipo] + linha if tipo in atual else linha
+            dias[dia] = atual
+        return ResumoCaixaInterno(dias)
+
+    def tabela(self, data):
+        """Totais do dia por Tipo_Operacao (colunas COLUNAS + Operacoes), maior Valor_Liquido primeiro."""
+        tipos = self._dias.get(pd.Timestamp(data), {})
+        df = pd.DataFrame(list(tipos.values()), columns=self.COLUNAS + ["Operacoes"])
+        df.insert(0, "Tipo_Operacao", list(tipos))
+        df["Operacoes"] = df["Operacoes"].astype(int)
+        return df.sort_values("Valor_Liquido", ascending=False, ignore_index=True)
+
+    def totais(self, data):
+        """Totais do dia que entram no saldo do Caixa Interno."""
+        tipos = self._dias.get(pd.Timestamp(data), {})
+
+        def soma(grupo, coluna="Valor_Liquido"):
+            i = self.COLUNAS.index(coluna)
+            return float(sum(tipos[t][i] for t in grupo if t in tipos))
+
+        return {
+            "saques_cartao": soma(self.TIPOS_SAQUE_CARTAO),
+            "saques_pix": soma(self.TIPOS_PIX),
+            "cheques": soma(self.TIPOS_CHEQUE),
+            "suprimentos": soma(("Suprimento",), "Valor_Bruto"),
+            "qtd_suprimentos": int(tipos["Suprimento"][-1]) if "Suprimento" in tipos else 0,
+            "operacoes": int(sum(linha[-1] for linha in tipos.values())),
+        }
+
+class PosicaoEstoque:
+    """Posição de estoque por (PDV, Produto) a partir da Estoque_Loterica_Mov: saldo em
+    quantidade (Entrada/Ajuste+ somam, Venda/Ajuste- subtraem) e quantidade/valor das
+    entradas, de onde sai o custo médio ponderado.
+
+    Imutável: com_linhas devolve uma nova posição com os movimentos novos somados.
+    """
+
+    COLUNAS = ["PDV", "Produto", "Saldo_Qtd", "Custo_Médio", "Valor_Custo_Estimado"]
+    FATOR = {"Entrada": 1, "Ajuste+": 1, "Venda": -1, "Ajuste-": -1}
+
+    def __init__(self, itens=None):
+        self._itens = itens or {}  # (PDV, Produto) -> array([saldo_qtd, qtd_entradas, valor_entradas])
+
+    @classmethod
+    def _agrupar(cls, df):
+        if df.empty:
+            return {}
+        fator = df["Tipo_Mov"].astype(str).map(cls.FATOR).fillna(0).to_numpy()
+        qtd = df["Qtd"].to_numpy(dtype="float64")
+        entrada = fator == 1
+        partes = pd.DataFrame({
+            "PDV": df["PDV"].astype(str).to_numpy(),
+            "Produto": df["Produto"].astype(str).to_numpy(),
+            "saldo": qtd * fator,
+            "qtd_ent": np.where(entrada, qtd, 0.0),
+            "valor_ent": np.where(entrada, df["Valor_Total"].to_numpy(dtype="float64"), 0.0),
+        })
+        somas = partes.groupby(["PDV", "Produto"], sort=False)[["saldo", "qtd_ent", "valor_ent"]].sum()
+        return dict(zip(somas.index, somas.to_numpy()))
+
+    @classmethod
+    def montar(cls, df):
+        return cls(cls._agrupar(df))
+
+    def com_linhas(self, df_novas):
+        itens = dict(self._itens)
+        for chave, linha in self._agrupar(df_novas).items():
+            itens[chave] = itens[chave] + linha if chave in itens else linha
+        return PosicaoEstoque(itens)
+
+    def tabela(self, pdv=None, produto=None):
+        """Saldo_Qtd, Custo_Médio e Valor_Custo_Estimado por (PDV, Produto), filtrado se pedido."""
+        itens = [(k, v) for k, v in self._itens.items()
+                 if (pdv is None or k[0] == pdv) and (produto is None or k[1] == produto)]
+        if not itens:
+            return pd.DataFrame(columns=self.COLUNAS)
+        chaves, valores = zip(*itens)
+        valores = np.array(valores)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            custo = valores[:, 2] / valores[:, 1]
+        custo = np.where(np.isfinite(custo), custo, 0.0)
+        df = pd.DataFrame(list(chaves), columns=["PDV", "Produto"])
+        df["Saldo_Qtd"] = valores[:, 0]
+        df["Custo_Médio"] = custo
+        df["Valor_Custo_Estimado"] = df["Saldo_Qtd"] * df["Custo_Médio"]
+        return df.sort_values(["PDV", "Produto"], ignore_index=True)
+
+    def diferencas(self, outra, tolerancia=1e-6):
+        """Itens (PDV, Produto) em que as duas posições divergem (para conferir com uma reconstrução)."""
+        chaves = set(self._itens) | set(outra._itens)
+        zero = np.zeros(3)
+        return sorted(k for k in chaves
+                      if not np.allclose(self._itens.get(k, zero), outra._itens.get(k, zero), atol=tolerancia))
+
+# Conciliação do Encerrante (regra acordada): Lado Esquerdo - Lado Direito deve dar zero
+ENCERRANTE_ESQUERDO = ["Encerrante_Relatorio", "Troco_Anterior", "Suprimento_Cofre", "Total_Vendas_Soma"]
+ENCERRANTE_DIREITO = ["Movimentacao_Cielo", "Pix_Saida", "Cheques_Recebidos", "Pagamento_Premios",
+                      "Vales_Despesas", "Retirada_Cofre", "Total_Compra_Bolao", "Retirada_CaixaInterno",
+                      "Dinheiro_Gaveta_Final"]
+
+def calcular_encerrante(df):
+    """Acrescenta Total_Vendas_Soma, Left_Enc, Right_Enc e Delta_Enc_Calc (colunas numéricas já tipadas)."""
+    df["Total_Vendas_Soma"] = df["Total_Venda_Bolao"] + df["Total_Venda_Raspadinha"] + df["Total_Venda_LoteriaFederal"]
+    df["Left_Enc"] = sum((df[c] for c in ENCERRANTE_ESQUERDO[1:]), df[ENCERRANTE_ESQUERDO[0]])
+    df["Right_Enc"] = sum((df[c] for c in ENCERRANTE_DIREITO[1:]), df[ENCERRANTE_DIREITO[0]])
+    df["Delta_Enc_Calc"] = df["Left_Enc"] - df["Right_Enc"]
+    return df
+
+class RelatorioFechamentos:
+    """Fechamentos de um PDV para relatórios de período: linhas ordenadas por data com o
+    Encerrante calculado e, de uma agregação diária só, somas acumuladas de todas as parcelas.
+
+    totais(ini, fim) sai por busca binária nas datas (e fica memorizado por período).
+    """
+
+    COLUNAS_SOMA = [
+        "Encerrante_Relatorio", "Troco_Anterior", "Suprimento_Cofre",
+        "Total_Venda_Bolao", "Total_Venda_Raspadinha", "Total_Venda_LoteriaFederal",
+        "Total_Compra_Bolao", "Total_Compra_Raspadinha", "Total_Compra_LoteriaFederal",
+        "Movimentacao_Cielo", "Pix_Saida", "Cheques_Recebidos", "Pagamento_Premios", "Vales_Despesas",
+        "Retirada_Cofre", "Retirada_CaixaInterno", "Dinheiro_Gaveta_Final",
+        "Total_Vendas_Soma", "Left_Enc", "Right_Enc", "Delta_Enc_Calc",
+    ]
+
+    def __init__(self, df, pdv):
+        df = df[df["Data_Fechamento"].notna()].sort_values("Data_Fechamento", kind="mergesort")
+        self.linhas = calcular_encerrante(df.assign(PDV=pdv).reset_index(drop=True))
+        self._datas = self.linhas["Data_Fechamento"].to_numpy()
+        diario = self.linhas.groupby("Data_Fechamento")[self.COLUNAS_SOMA].sum()
+        diario["Fechamentos"] = self.linhas.groupby("Data_Fechamento").size()
+        self.diario = diario
+        self._dias = diario.index.to_numpy()
+        self._acumulado = np.vstack([np.zeros((1, diario.shape[1])), diario.to_numpy().cumsum(axis=0)])
+        self._totais = {}
+
+    @staticmethod
+    def _faixa(datas, ini, fim):
+        return (int(np.searchsorted(datas, np.datetime64(pd.Timestamp(ini)), side="left")),
+                int(np.searchsorted(datas, np.datetime64(pd.Timestamp(fim)), side="right")))
+
+    def totais(self, ini, fim):
+        """Somas de COLUNAS_SOMA e nº de Fechamentos entre ini e fim (inclusive)."""
+        chave = (pd.Timestamp(ini), pd.Timestamp(fim))
+        if chave not in self._totais:
+            a, b = self._faixa(self._dias, ini, fim)
+            self._totais[chave] = pd.Series(self._acumulado[max(b, a)] - self._acumulado[a],
+                                            index=self.diario.columns)
+        return self._totais[chave]
+
+    def linhas_periodo(self, ini, fim):
+        a, b = self._faixa(self._datas, ini, fim)
+        return self.linhas.iloc[a:b]
+
+    def diario_periodo(self, ini, fim):
+        a, b = self._faixa(self._dias, ini, fim)
+        return self.diario.iloc[a:b]
+
+# Produto -> sufixo das colunas Qtd_/Custo_Unit_/Preco_Unit_ nos fechamentos dos PDVs
+PRODUTOS_FECHAMENTO = {"Bolão": "Bolao", "Raspadinha": "Raspadinha", "Loteria Federal": "LoteriaFederal"}
+
+# Granularidades dos agregados de fechamentos (rótulo -> frequência de período do pandas)
+GRANULARIDADES_CUBO = {"Diário": "D", "Semanal": "W", "Mensal": "M"}
+
+class CuboFechamentos:
+    """Agregados dos fechamentos de um PDV: por dia e produto (quantidades, vendas, compras)
+    e por dia no caixa (fechamentos, Δ encerrante, Cielo, prêmios, vendas e compras totais).
+
+    Semanas e meses saem dos agregados diários (rollup(g), memorizado por granularidade);
+    relatórios longos leem algumas centenas de períodos em vez das linhas da aba.
+    Imutável: com_linhas devolve um novo cubo com os fechamentos novos somados.
+    """
+
+    MEDIDAS_PRODUTO = {"Qtd_Venda": "Qtd_Venda_{}", "Vendas": "Total_Venda_{}",
+                       "Qtd_Compra": "Qtd_Compra_{}", "Compras": "Total_Compra_{}"}
+    MEDIDAS_CAIXA = {"Delta_Enc": "Delta_Enc_Calc", "Cielo": "Movimentacao_Cielo", "Premios": "Pagamento_Premios"}
+
+    def __init__(self, pdv, produtos, caixa):
+        self.pdv = pdv
+        self._diario = {"produtos": produtos, "caixa": caixa}
+        self._rollups = {}
+
+    @classmethod
+    def _agregar(cls, df):
+        df = calcular_encerrante(df[df["Data_Fechamento"].notna()].copy())
+        dia = df["Data_Fechamento"].rename("Periodo")
+        produtos = pd.concat([
+            pd.DataFrame({"Periodo": dia, "Produto": produto,
+                          **{m: df[c.format(sufixo)] for m, c in cls.MEDIDAS_PRODUTO.items()}})
+            for produto, sufixo in PRODUTOS_FECHAMENTO.items()
+        ], ignore_index=True).groupby(["Periodo", "Produto"]).sum()
+        caixa = pd.DataFrame({"Fechamentos": 1, **{m: df[c] for m, c in cls.MEDIDAS_CAIXA.items()}},
+                             index=df.index).groupby(dia).sum()
+        vendas = produtos.groupby(level="Periodo")[["Vendas", "Compras"]].sum()
+        caixa = caixa.join(vendas, how="left").fillna(0.0)
+        return produtos, caixa
+
+    @classmethod
+    def montar(cls, df, pdv):
+        return cls(pdv, *cls._agregar(df))
+
+    def com_linhas(self, df_novas):
+        if df_novas.empty:
+            return self
+        produtos, caixa = self._agregar(df_novas)
+        somar = lambda a, b: a.add(b, fill_value=0).sort_index()
+        return CuboFechamentos(self.pdv, somar(self._diario["produtos"], produtos),
+                               somar(self._diario["caixa"], caixa))
+
+    def rollup(self, granularidade="D"):
+        """(produtos, caixa) agregados por período (D, W ou M); Periodo = início do período."""
+        if granularidade == "D":
+            return self._diario["produtos"], self._diario["caixa"]
+        if granularidade not in self._rollups:
+            produtos, caixa = self._diario["produtos"], self._diario["caixa"]
+            per_prod = produtos.index.get_level_values("Periodo").to_period(granularidade).start_time
+            per_caixa = caixa.index.to_period(granularidade).start_time
+            self._rollups[granularidade] = (
+                produtos.groupby([per_prod.rename("Periodo"), produtos.index.get_level_values("Produto")]).sum(),
+                caixa.groupby(per_caixa.rename("Periodo")).sum(),
+            )
+        return self._rollups[granularidade]
+
+    @staticmethod
+    def combinar(cubos, granularidade="D", ini=None, fim=None):
+        """Soma os rollups de vários PDVs e recorta os períodos que começam entre ini e fim.
+
+        Devolve (produtos, caixa) como tabelas com Periodo em coluna e Margem calculada.
+        """
+        partes = [c.rollup(granularidade) for c in cubos]
+        saida = []
+        for i, niveis in ((0, ["Periodo", "Produto"]), (1, ["Periodo"])):
+            frames = [p[i] for p in partes if not p[i].empty]
+            if not frames:
+                colunas = niveis + (list(CuboFechamentos.MEDIDAS_PRODUTO) if i == 0 else
+                                    ["Fechamentos", *CuboFechamentos.MEDIDAS_CAIXA, "Vendas", "Compras"])
+                saida.append(pd.DataFrame(columns=colunas + ["Margem"]))
+                continue
+            df = pd.concat(frames).groupby(level=niveis).sum().reset_index()
+            if ini is not None:
+                df = df[df["Periodo"] >= pd.Timestamp(ini).to_period(granularidade).start_time]
+            if fim is not None:
+                df = df[df["Periodo"] <= pd.Timestamp(fim)]
+            saida.append(df.assign(Margem=df["Vendas"] - df["Compras"]).reset_index(drop=True))
+        return tuple(saida)
+
+def movimentos_estoque_dos_fechamentos(df_fech, pdv, sheet):
+    """Movimentos de estoque (linhas de Estoque_Loterica_Mov) que os fechamentos geram:
+    uma Entrada por produto comprado e uma Venda por produto vendido (Qtd > 0).
+
+    df_fech é o frame tipado da aba de fechamentos; a ordem é a dos fechamentos, com as
+    compras antes das vendas. Chave_Sync = "data|PDV|produto|ENT/SAI|qtd|valor_unit".
+    """
+    blocos = []
+    for sentido, tipo_mov, col_qtd, col_valor in (("ENT", "Entrada", "Qtd_Compra_", "Custo_Unit_"),
+                                                  ("SAI", "Venda", "Qtd_Venda_", "Preco_Unit_")):
+        for produto, sufixo in PRODUTOS_FECHAMENTO.items():
+            blocos.append(pd.DataFrame({
+                "pos": np.arange(len(df_fech)),
+                "ordem": len(blocos),
+                "Data": df_fech["Data_Fechamento"].dt.strftime("%Y-%m-%d").to_numpy(),
+                "Produto": produto,
+                "Tipo_Mov": tipo_mov,
+                "Sentido": sentido,
+                "Qtd": df_fech[col_qtd + sufixo].to_numpy(dtype="float64"),
+                "Valor_Unit": df_fech[col_valor + sufixo].to_numpy(dtype="float64"),
+            }))
+    mov = pd.concat(blocos, ignore_index=True)
+    mov = mov[mov["Qtd"] > 0].sort_values(["pos", "ordem"], kind="stable", ignore_index=True)
+    qtds, valores = mov["Qtd"].tolist(), mov["Valor_Unit"].tolist()
+    mov["Valor_Total"] = [q * v for q, v in zip(qtds, valores)]
+    mov["Chave_Sync"] = [f"{d}|{pdv}|{p}|{s}|{q}|{v}" for d, p, s, q, v in
+                         zip(mov["Data"], mov["Produto"], mov["Sentido"], qtds, valores)]
+    mov["PDV"], mov["Obs"], mov["Origem"] = pdv, "sync-fech", sheet
+    return mov
+
+_LOCK_SINC_ESTOQUE = threading.Lock()  # sincronização manual e fila não gravam ao mesmo tempo
+
+def _frame_da_aba(spreadsheet, sheet_name):
+    """Frame tipado da aba sem st.* (erros sobem para quem chamou)."""
+    return _sincronizador(spreadsheet).estado(spreadsheet, sheet_name).frame(sheet_name)
+
+def _linhas_por_bloco(linhas):
+    """Números de linha -> blocos contíguos (inicio, fim), do fim para o começo da aba."""
+    blocos = []
+    for n in sorted(linhas, reverse=True):
+        if blocos and blocos[-1][0] == n + 1:
+            blocos[-1][0] = n
+        else:
+            blocos.append([n, n])
+    return [tuple(b) for b in blocos]
+
+def sincronizar_estoque_fechamentos(spreadsheet, pdv, sheet, inicio, fim, reconciliar=False):
+    """Lança em Estoque_Loterica_Mov os movimentos dos fechamentos do PDV entre inicio e fim
+    que ainda não estão lá (pela Chave_Sync), numa única gravação.
+
+    Com reconciliar, remove também os movimentos "sync-fech" do PDV no período que os
+    fechamentos não geram mais (fechamento editado ou removido).
+    Devolve (nº de fechamentos no período, movimentos incluídos, removidos). Não usa st.*.
+    """
+    with _LOCK_SINC_ESTOQUE:
+        df = _frame_da_aba(spreadsheet, sheet)
+        df = df[(df["Data_Fechamento"] >= pd.Timestamp(inicio)) & (df["Data_Fechamento"] <= pd.Timestamp(fim))]
+        mov = movimentos_estoque_dos_fechamentos(df, pdv, sheet).drop_duplicates("Chave_Sync")
+        ws = get_or_create_worksheet(spreadsheet, "Estoque_Loterica_Mov", HEADERS_ESTOQUE_MOV)
+        estoque = _frame_da_aba(spreadsheet, "Estoque_Loterica_Mov")
+
+        removidos = 0
+        if reconciliar:
+            sinc = _sincronizador(spreadsheet)
+            for _ in range(TENTATIVAS_GRAVACAO):
+                obsoletos = (estoque["Obs"].eq("sync-fech") & estoque["Origem"].eq(sheet)
+                             & estoque["PDV"].astype(str).eq(pdv)
+                             & (estoque["Data"] >= pd.Timestamp(inicio)) & (estoque["Data"] <= pd.Timestamp(fim))
+                             & ~estoque["Chave_Sync"].isin(mov["Chave_Sync"])).to_numpy()
+                posicoes = np.flatnonzero(obsoletos)
+                chave_da_linha = dict(zip((posicoes + 2).tolist(),  # 1 = cabeçalho
+                                          estoque["Chave_Sync"].iloc[posicoes].astype(str).tolist()))
+                col = _indice_para_col(
+                    sinc.estado(spreadsheet, "Estoque_Loterica_Mov").cabecalho.index("Chave_Sync") + 1)
+                mudou = False
+                for inicio_bloco, fim_bloco in _linhas_por_bloco(chave_da_linha):
+                    # as posições vêm do cache: antes de apagar, confere a Chave_Sync das linhas na planilha
+                    atual = [l[0] if l else "" for l in ws.get_values(f"{col}{inicio_bloco}:{col}{fim_bloco}")]
+                    atual += [""] * (fim_bloco - inicio_bloco + 1 - len(atual))
+                    if atual != [chave_da_linha[n] for n in range(inicio_bloco, fim_bloco + 1)]:
+                        mudou = True
+                        break
+                    ws.delete_rows(inicio_bloco, fim_bloco)
+                    removidos += fim_bloco - inicio_bloco + 1
+                if not mudou:
+                    break
+                # a aba mudou por fora do app: relê inteira e recalcula as linhas a remover
+                sinc.invalidar("Estoque_Loterica_Mov", recarga_completa=True)
+                estoque = _frame_da_aba(spreadsheet, "Estoque_Loterica_Mov")
+            else:
+                raise RuntimeError("Estoque_Loterica_Mov mudou durante a reconciliação; tente novamente")
+            if removidos:
+                estoque = _frame_da_aba(spreadsheet, "Estoque_Loterica_Mov")
+
+        mov = mov[~mov["Chave_Sync"].isin(estoque["Chave_Sync"])]
+        if not mov.empty:
+            hora = obter_horario_brasilia()
+            ws.append_rows([
+                [d, hora, p, prod, tipo, q, v, t, obs, origem, chave]
+                for d, p, prod, tipo, q, v, t, obs, origem, chave in
+                zip(mov["Data"], mov["PDV"], mov["Produto"], mov["Tipo_Mov"], mov["Qtd"].tolist(),
+                    mov["Valor_Unit"].tolist(), mov["Valor_Total"], mov["Obs"], mov["Origem"], mov["Chave_Sync"])
+            ])
+        return len(df), len(mov), removidos
+
+
+class FilaSincronizacaoEstoque:
+    """Fila em segundo plano que lança no estoque os movimentos de cada fechamento salvo,
+    editado ou removido, sem segurar o salvamento do operador.
+
+    Uma thread por planilha processa os pedidos em ordem; não usa st.* (roda fora da página).
+    Falhas transitórias são repetidas como na TransacaoPlanilhas; as demais ficam em erros.
+    """
+
+    def __init__(self, spreadsheet):
+        self._spreadsheet = spreadsheet
+        self._fila = queue.Queue()
+        self.erros = []
+        threading.Thread(target=self._rodar, name="sinc-estoque", daemon=True).start()
+
+    def agendar(self, pdv, sheet, data):
+        self._fila.put((pdv, sheet, pd.Timestamp(data).date()))
+
+    def pendentes(self):
+        return self._fila.unfinished_tasks
+
+    def aguardar(self):
+        self._fila.join()
+
+    def _rodar(self):
+        while True:
+            pdv, sheet, data = self._fila.get()
+            try:
+                for tentativa in range(TENTATIVAS_GRAVACAO):
+                    try:
+                        sincronizar_estoque_fechamentos(self._spreadsheet, pdv, sheet, data, data, reconciliar=True)
+                        break
+                    except Exception as e:
+                        if tentativa == TENTATIVAS_GRAVACAO - 1 or not _erro_transitorio(e):
+                            raise
+                        time.sleep(2 ** tentativa)
+            except Exception as e:
+                self.erros = (self.erros + [f"{data.strftime('%d/%m/%Y')} {pdv}: {e}"])[-20:]
+            finally:
+                self._fila.task_done()
+
+@st.cache_resource(show_spinner=False)
+def _fila_sinc_estoque(_spreadsheet, chave_planilha):
+    return FilaSincronizacaoEstoque(_spreadsheet)
+
+def fila_sinc_estoque(spreadsheet):
+    return _fila_sinc_estoque(spreadsheet, str(getattr(spreadsheet, "id", "padrao")))
+
+def caixa_interno_do_dia(ctx, data):
+    """Retrato do Caixa Interno no dia: saldo do último fechamento anterior, totais do dia
+    (ResumoCaixaInterno.totais) e o saldo calculado (anterior + suprimentos - saídas)."""
+    ant = ctx.livro_fechamentos("Fechamento_Diario_Caixa_Interno", por=None).anterior(None, data)
+    dia = ctx.resumo_caixa_interno().totais(data)
+    dia["tem_fechamento_anterior"] = ant is not None
+    dia["saldo_anterior"] = float(ant["Saldo_Calculado_Dia"]) if ant is not None else 0.0
+    dia["saldo"] = dia["saldo_anterior"] + dia["suprimentos"] - (
+        dia["saques_cartao"] + dia["saques_pix"] + dia["cheques"])
+    return dia
+
+class LivroCofre:
+    """Saldo do cofre por dia, em centavos, atualizado só com as linhas novas.
+
+    Saldo = Entradas - Saídas da Operacoes_Cofre + sangrias - suprimentos da
+    Movimentacoes_PDV cujo Vinculo_ID não aparece no cofre (lançadas fora do cofre).
+    Guarda até onde leu cada aba (geração, nº de linhas); se uma aba foi reescrita
+    (geração mudou ou encolheu), remonta do zero.
+    """
+
+    ABA_COFRE = "Operacoes_Cofre"
+    ABA_MOV_PDV = "Movimentacoes_PDV"
+    _DIA_SEM_DATA = pd.Timestamp.min  # linhas sem data entram no saldo desde o início
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._zerar()
+
+    def _zerar(self):
+        self._lidas = {}              # aba -> (geracao, nº de linhas processadas)
+        self._por_dia = {}            # dia -> centavos
+        self._vinculos_cofre = set()
+        self._pdv_por_vinculo = {}    # Vinculo_ID -> [(dia, centavos)] contados da Mov_PDV
+        self._acumulado = None        # (dias ordenados, saldo acumulado) montado sob demanda
+
+    def _somar(self, dia, centavos):
+        if centavos:
+            self._por_dia[dia] = self._por_dia.get(dia, 0) + centavos
+            self._acumulado = None
+
+    @classmethod
+    def _centavos_por_linha(cls, df, sinal):
+        dias = df["Data"].fillna(cls._DIA_SEM_DATA)
+        centavos = np.round(df["Valor"].to_numpy(dtype="float64") * 100).astype(np.int64) * sinal
+        return dias, centavos
+
+    def _processar_cofre(self, df):
+        tipo = df["Tipo"].astype(str).str.lower()
+        sinal = np.where(tipo.eq("entrada"), 1, np.where(tipo.isin(["saída", "saida"]), -1, 0))
+        dias, centavos = self._centavos_por_linha(df, sinal)
+        for dia, total in pd.Series(centavos).groupby(dias.to_numpy()).sum().items():
+            self._somar(dia, int(total))
+        # sangria/suprimento da Mov_PDV que já tinha sido contada e agora tem par no cofre
+        for v in set(df["Vinculo_ID"].astype(str)) - self._vinculos_cofre:
+            self._vinculos_cofre.add(v)
+            for dia, c in self._pdv_por_vinculo.pop(v, ()):
+                self._somar(dia, -c)
+
+    def _processar_mov_pdv(self, df):
+        tipo = df["Tipo_Mov"].astype(str).str.lower()
+        sinal = np.where(tipo.eq("sangria"), 1, np.where(tipo.eq("suprimento"), -1, 0))
+        vinculos = df["Vinculo_ID"].astype(str)
+        m = (sinal != 0) & ~vinculos.isin(self._vinculos_cofre).to_numpy()
+        if not m.any():
+            return
+        dias, centavos = self._centavos_por_linha(df.loc[m], sinal[m])
+        for v, dia, c in zip(vinculos[m], dias, centavos):
+            self._pdv_por_vinculo.setdefault(v, []).append((dia, int(c)))
+            self._somar(dia, int(c))
+
+    def atualizar(self, spreadsheet):
+        sinc = _sincronizador(spreadsheet)
+        estados = {aba: sinc.estado(spreadsheet, aba) for aba in (self.ABA_COFRE, self.ABA_MOV_PDV)}
+        with self._lock:
+            for aba, est in estados.items():
+                geracao, n = self._lidas.get(aba, (est.geracao, 0))
+                if geracao != est.geracao or n > len(est.registros):
+                    self._zerar()
+                    break
+            # cofre antes da Mov_PDV: os vínculos do cofre decidem o que conta da Mov_PDV
+            for aba, processar in ((self.ABA_COFRE, self._processar_cofre),
+                                   (self.ABA_MOV_PDV, self._processar_mov_pdv)):
+                est = estados[aba]
+                n = self._lidas.get(aba, (est.geracao, 0))[1]
+                if len(est.registros) > n:
+                    processar(est.frame(aba).iloc[n:])
+                self._lidas[aba] = (est.geracao, len(est.registros))
+        return self
+
+    def saldo(self, ate=None):
+        """Saldo em reais (Decimal); com ate, só os movimentos até essa data (inclusive)."""
+        with self._lock:
+            if self._acumulado is None:
+                dias = sorted(self._por_dia)
+                self._acumulado = (dias, np.cumsum([self._por_dia[d] for d in dias], dtype=np.int64))
+            dias, acumulado = self._acumulado
+            i = len(dias) if ate is None else bisect.bisect_right(dias, pd.Timestamp(ate))
+            centavos = int(acumulado[i - 1]) if i else 0
+        return Decimal(centavos) / 100
+
+@st.cache_resource
+def _livro_cofre_da_planilha(chave_planilha):
+    return LivroCofre()
+
+def livro_cofre(spreadsheet):
+    """LivroCofre da planilha, já com as linhas novas das duas abas processadas."""
+    return _livro_cofre_da_planilha(str(getattr(spreadsheet, "id", "padrao"))).atualizar(spreadsheet)
+
+FATORES_NORMALIZACAO = [1, 0.01, 0.1, 10, 100]
+TOLERANCIA_NORMALIZACAO = 0.01  # um centavo
+
+def _melhores_fatores(valor_bruto, taxa_cliente, valor_liquido):
+    """Escolhe, para todas as linhas de uma vez, o par (fator_taxa, fator_liquido) entre
+    as 25 combinações de FATORES_NORMALIZACAO que melhor fecha Liquido = Bruto - Taxa.
+    Devolve dois arrays com os índices (em FATORES_NORMALIZACAO) dos fatores de cada linha.
+
+    Linha que já fecha dentro de TOLERANCIA_NORMALIZACAO fica (1, 1). Nas demais, outro par
+    só é aceito se fechar dentro da tolerância (descartando líquido > bruto ou líquido <= 0);
+    em empate vale o primeiro (fator_taxa externo, fator_liquido interno). Sem par aceito, fica (1, 1).
+    """
+    b = np.asarray(valor_bruto, dtype="float64")[:, None]
+    t = np.asarray(taxa_cliente, dtype="float64")[:, None]
+    l = np.asarray(valor_liquido, dtype="float64")[:, None]
+    fatores = np.asarray(FATORES_NORMALIZACAO, dtype="float64")
+    ft = np.repeat(fatores, len(fatores))[None, :]
+    fl = np.tile(fatores, len(fatores))[None, :]
+    taxa_teste, liquido_teste = t * ft, l * fl
+    with np.errstate(invalid="ignore", over="ignore"):
+        # arredonda em centavos para o erro de ponto flutuante não passar da tolerância
+        erro = np.round(np.abs(liquido_teste - (b - taxa_teste)), 2)
+        valido = (liquido_teste <= b) & (liquido_teste > 0) & np.isfinite(erro)
+    # (1, 1) é a coluna 0: vale sempre que ela mesma fecha, e quando nenhum par fecha
+    mantem = erro[:, 0] <= TOLERANCIA_NORMALIZACAO
+    erro = np.where(valido, erro, np.inf)
+    melhor = erro.argmin(axis=1)
+    mantem |= erro[np.arange(len(erro)), melhor] > TOLERANCIA_NORMALIZACAO
+    return np.divmod(np.where(mantem, 0, melhor), len(fatores))
+
+class _CacheFatores:
+    """hash da linha (Valor_Bruto, Taxa_Cliente, Valor_Liquido) -> código do par de fatores,
+    em arrays ordenados para a busca ser vetorizada (searchsorted).
+    código = idx_taxa * len(FATORES_NORMALIZACAO) + idx_liquido; 0 = sem correção."""
+
+    def __init__(self):
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.codigos = np.empty(0, dtype=np.int64)
+        self._lock = threading.Lock()
+
+    def buscar(self, hashes):
+        hs, cs = self.hashes, self.codigos
+        if not len(hs):
+            return np.full(len(hashes), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(hs, hashes), len(hs) - 1)
+        return np.where(hs[pos] == hashes, cs[pos], -1)
+
+    def guardar(self, hashes, codigos):
+        with self._lock:
+            hs = np.concatenate([self.hashes, hashes])
+            cs = np.concatenate([self.codigos, codigos])
+            hs, unicos = np.unique(hs, return_index=True)
+            self.hashes, self.codigos = hs, cs[unicos]
+
+@st.cache_resource
+def _cache_fatores_normalizacao():
+    return _CacheFatores()
+
+def _codigos_fatores(valores):
+    """Código do par de fatores de cada linha de `valores` (n x 3: bruto, taxa, líquido),
+    calculando em lote só as linhas ainda fora do cache."""
+    valores = np.asarray(valores, dtype="float64").reshape(-1, 3)
+    hashes = pd.util.hash_pandas_object(pd.DataFrame(valores), index=False).to_numpy()
+    cache = _cache_fatores_normalizacao()
+    codigos = cache.buscar(hashes)
+    novos = np.flatnonzero(codigos < 0)
+    if len(novos):
+        idx_taxa, idx_liquido = _melhores_fatores(*valores[novos].T)
+        codigos[novos] = idx_taxa * len(FATORES_NORMALIZACAO) + idx_liquido
+        cache.guardar(hashes[novos], codigos[novos])
+    return codigos
+
+def _numero(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
 # Função para normalizar dados com detecção inteligente
 def normalizar_dados_inteligente(dados):
     """
     Função inteligente que detecta automaticamente padrões de erro nos dados
-    e aplica a correção mais adequada baseada em validação matemática
+    e aplica a correção mais adequada baseada em validação matemática.
+    Os fatores são calculados em lote (_melhores_fatores) e guardados por linha.
     """
-    dados_corrigidos = []
-    
-    for registro in dados:
-        registro_corrigido = registro.copy()
-        
-        # Verificar se tem os campos necessários
-        if not all(campo in registro for campo in ["Valor_Bruto", "Taxa_Cliente", "Valor_Liquido"]):
-            dados_corrigidos.append(registro_corrigido)
-            continue
-            
+    dados_corrigidos = [registro.copy() for registro in dados]
+
+    linhas, chaves = [], []
+    for i, registro in enumerate(dados_corrigidos):
         try:
-            valor_bruto = registro["Valor_Bruto"]
-            taxa_cliente = registro["Taxa_Cliente"]
-            valor_liquido = registro["Valor_Liquido"]
-            
-            # Se valor bruto é 0, pular validação
-            if valor_bruto == 0:
-                dados_corrigidos.append(registro_corrigido)
-                continue
-            
-            # Testar diferentes fatores de correção
-            fatores_teste = [1, 0.01, 0.1, 10, 100]
-            melhor_fator_taxa = 1
-            melhor_fator_liquido = 1
-            menor_erro = "Infinity"
-            
-            for fator_taxa in fatores_teste:
-                for fator_liquido in fatores_teste:
-                    taxa_teste = taxa_cliente * fator_taxa
-                    liquido_teste = valor_liquido * fator_liquido
-                    
-                    # Validações básicas
-                    if taxa_teste > valor_bruto * 0.5:  # Taxa não pode ser maior que 50%
-                        continue
-                    if liquido_teste > valor_bruto:  # Líquido não pode ser maior que bruto
-                        continue
-                    if liquido_teste <= 0:  # Líquido deve ser positivo
-                        continue
-                    
-                    # Calcular erro matemático: Valor_Liquido deveria ser Valor_Bruto - Taxa_Cliente
-                    valor_esperado = valor_bruto - taxa_teste
-                    erro = abs(liquido_teste - valor_esperado)
-                    
-                    if erro < menor_erro:
-                        menor_erro = erro
-                        melhor_fator_taxa = fator_taxa
-                        melhor_fator_liquido = fator_liquido
-            
-            # Aplicar correções se necessário
-            if melhor_fator_taxa != 1:
-                registro_corrigido["Taxa_Cliente"] = taxa_cliente * melhor_fator_taxa
-                
-            if melhor_fator_liquido != 1:
-                registro_corrigido["Valor_Liquido"] = valor_liquido * melhor_fator_liquido
-            
-            # Corrigir outros campos relacionados se existirem
-            if "Taxa_Banco" in registro and melhor_fator_taxa != 1:
-                taxa_banco = registro.get("Taxa_Banco", 0)
-                registro_corrigido["Taxa_Banco"] = taxa_banco * melhor_fator_taxa
-                
-            if "Lucro" in registro and melhor_fator_taxa != 1:
-                lucro = registro.get("Lucro", 0)
-                registro_corrigido["Lucro"] = lucro * melhor_fator_taxa
-                
-        except (ValueError, TypeError):
-            # Se houver erro na conversão, manter dados originais
-            pass
-            
-        dados_corrigidos.append(registro_corrigido)
-    
+            chave = (registro["Valor_Bruto"], registro["Taxa_Cliente"], registro["Valor_Liquido"])
+        except KeyError:
+            continue  # sem os campos necessários
+        # Se valor bruto é 0 (ou algum campo não é número), pular validação
+        if not all(_numero(v) for v in chave) or chave[0] == 0:
+            continue
+        linhas.append(i)
+        chaves.append(chave)
+    if not chaves:
+        return dados_corrigidos
+
+    n = len(FATORES_NORMALIZACAO)
+    for i, chave, codigo in zip(linhas, chaves, _codigos_fatores(chaves).tolist()):
+        if codigo == 0:
+            continue
+        fator_taxa, fator_liquido = FATORES_NORMALIZACAO[codigo // n], FATORES_NORMALIZACAO[codigo % n]
+        registro = dados_corrigidos[i]
+        taxa_cliente, valor_liquido = chave[1], chave[2]
+
+        # Aplicar correções se necessário
+        if fator_taxa != 1:
+            registro["Taxa_Cliente"] = taxa_cliente * fator_taxa
+        if fator_liquido != 1:
+            registro["Valor_Liquido"] = valor_liquido * fator_liquido
+
+        # Corrigir outros campos relacionados se existirem
+        if fator_taxa != 1:
+            for campo in ("Taxa_Banco", "Lucro"):
+                if campo in registro and _numero(registro[campo]):
+                    registro[campo] = registro[campo] * fator_taxa
+
     return dados_corrigidos
 
-# Função para limpar cache forçadamente
-def limpar_cache_forcado():
-    st.cache_data.clear()
-    if "simulacao_atual" in st.session_state:
-        del st.session_state.simulacao_atual
+NORMALIZADO_SIM = "SIM"
+
+def fatores_normalizacao(df):
+    """(fator_taxa, fator_liquido) de cada linha do DataFrame, como em normalizar_dados_inteligente.
+
+    Vale 1 onde não há o que corrigir e nas linhas já reparadas na planilha (Normalizado = SIM).
+    """
+    fator_taxa, fator_liquido = np.ones(len(df)), np.ones(len(df))
+    cols = ["Valor_Bruto", "Taxa_Cliente", "Valor_Liquido"]
+    if df.empty or not set(cols).issubset(df.columns):
+        return fator_taxa, fator_liquido
+    base = df[cols].apply(pd.to_numeric, errors="coerce")
+    elegivel = base.notna().all(axis=1) & base["Valor_Bruto"].ne(0)
+    if "Normalizado" in df.columns:
+        elegivel &= df["Normalizado"].astype(str).ne(NORMALIZADO_SIM)
+    elegivel = elegivel.to_numpy()
+    if elegivel.any():
+        codigos = _codigos_fatores(base.to_numpy()[elegivel])
+        n = len(FATORES_NORMALIZACAO)
+        fatores = np.asarray(FATORES_NORMALIZACAO, dtype="float64")
+        fator_taxa[elegivel], fator_liquido[elegivel] = fatores[codigos // n], fatores[codigos % n]
+    return fator_taxa, fator_liquido
+
+def normalizar_frame(df):
+    """Mesma correção de normalizar_dados_inteligente sobre um DataFrame inteiro (sem laço por linha).
+
+    Devolve uma cópia; os fatores ficam em cache pelo hash de (Valor_Bruto, Taxa_Cliente, Valor_Liquido).
+    Linhas com Normalizado = SIM já foram corrigidas na planilha e passam direto.
+    """
+    fator_taxa, fator_liquido = fatores_normalizacao(df)
+    df = df.copy()
+    corrige_taxa, corrige_liquido = fator_taxa != 1, fator_liquido != 1
+    if not corrige_taxa.any() and not corrige_liquido.any():
+        return df
+    for campo in ("Valor_Liquido", "Taxa_Cliente", "Taxa_Banco", "Lucro"):
+        if campo in df.columns and pd.api.types.is_integer_dtype(df[campo]):
+            df[campo] = df[campo].astype("float64")
+    for campo, fator, mascara in (("Valor_Liquido", fator_liquido, corrige_liquido),
+                                  ("Taxa_Cliente", fator_taxa, corrige_taxa),
+                                  ("Taxa_Banco", fator_taxa, corrige_taxa),
+                                  ("Lucro", fator_taxa, corrige_taxa)):
+        if campo in df.columns and mascara.any():
+            valores = pd.to_numeric(df[campo], errors="coerce")
+            df.loc[mascara, campo] = (valores * fator).where(valores.notna(), df[campo])[mascara]
+    return df
+
+CAMPOS_REPARO_ESCALA = ("Taxa_Cliente", "Valor_Liquido", "Taxa_Banco", "Lucro")
+
+def _ler_operacoes_para_reparo(spreadsheet, sheet_name):
+    """(worksheet, cabeçalho, DataFrame das linhas) da aba, lidos direto da planilha."""
+    ws = get_or_create_worksheet(spreadsheet, sheet_name, HEADERS_CAIXA)
+    valores = ws.get_all_values()
+    cabecalho = _aparar(list(valores[0])) if valores else []
+    df = pd.DataFrame(_linhas_para_registros(cabecalho, valores[1:]), columns=cabecalho)
+    for c in ("Normalizado", "Fator_Correcao"):
+        if c not in df.columns:
+            df[c] = ""
+    return ws, cabecalho, df
+
+def _plano_reparo_escala(df):
+    """Uma linha por campo que o reparo alteraria: Linha (na planilha), Data, Operador,
+    Tipo_Operacao, Campo, Atual, Corrigido, Fator_Taxa, Fator_Liquido."""
+    colunas = ["Linha", "Data", "Operador", "Tipo_Operacao", "Campo", "Atual", "Corrigido",
+               "Fator_Taxa", "Fator_Liquido"]
+    if df.empty:
+        return pd.DataFrame(columns=colunas)
+    fator_taxa, fator_liquido = fatores_normalizacao(df)
+    corrigido = normalizar_frame(df)
+    alvo = (fator_taxa != 1) | (fator_liquido != 1)
+    partes = []
+    for campo in CAMPOS_REPARO_ESCALA:
+        if campo not in df.columns:
+            continue
+        mudou = np.flatnonzero(alvo & corrigido[campo].ne(df[campo]).to_numpy())
+        if not len(mudou):
+            continue
+        partes.append(pd.DataFrame({
+            "Linha": mudou + 2,
+            "Data": df["Data"].iloc[mudou].to_numpy() if "Data" in df.columns else "",
+            "Operador": df["Operador"].iloc[mudou].to_numpy() if "Operador" in df.columns else "",
+            "Tipo_Operacao": df["Tipo_Operacao"].iloc[mudou].to_numpy() if "Tipo_Operacao" in df.columns else "",
+            "Campo": campo,
+            "Atual": df[campo].iloc[mudou].to_numpy(),
+            "Corrigido": corrigido[campo].iloc[mudou].astype("float64").to_numpy(),
+            "Fator_Taxa": fator_taxa[mudou],
+            "Fator_Liquido": fator_liquido[mudou],
+        }))
+    if not partes:
+        return pd.DataFrame(columns=colunas)
+    return pd.concat(partes, ignore_index=True).sort_values(["Linha", "Campo"], ignore_index=True)
+
+def previa_reparo_escala(spreadsheet, sheet_name="Operacoes_Caixa"):
+    """O que reparar_escala_operacoes_caixa gravaria agora (ver _plano_reparo_escala), sem gravar nada."""
+    return _plano_reparo_escala(_ler_operacoes_para_reparo(spreadsheet, sheet_name)[2])
+
+def _mesmo_plano(a, b):
+    chaves = ["Linha", "Campo", "Atual", "Corrigido"]
+    return len(a) == len(b) and a[chaves].astype(str).reset_index(drop=True).equals(
+        b[chaves].astype(str).reset_index(drop=True))
+
+def reparar_escala_operacoes_caixa(spreadsheet, previa, sheet_name="Operacoes_Caixa"):
+    """Grava na planilha a correção de escala que normalizar_frame faz a cada leitura,
+    exatamente nas linhas/campos da `previa` (previa_reparo_escala) mostrada ao gerente.
+
+    Garante as colunas Normalizado/Fator_Correcao; em cada linha corrigida grava os novos
+    Taxa_Cliente, Valor_Liquido, Taxa_Banco e Lucro, marca Normalizado = SIM e guarda em
+    Fator_Correcao (JSON) os fatores e os valores originais, para desfazer_reparo_escala.
+    Se a planilha mudou desde a prévia, não grava nada (ValueError).
+    Devolve quantas linhas foram corrigidas.
+    """
+    ws, cabecalho, df = _ler_operacoes_para_reparo(spreadsheet, sheet_name)
+    plano = _plano_reparo_escala(df)
+    if not _mesmo_plano(plano, previa):
+        raise ValueError("a planilha mudou desde a prévia; gere a prévia novamente")
+    if plano.empty:
+        return 0
+    faltando = [c for c in ("Normalizado", "Fator_Correcao") if c not in cabecalho]
+    if faltando:
+        cabecalho += faltando
+        ws.update(range_name="A1", values=[cabecalho])
+
+    col = {c: _indice_para_col(i + 1) for i, c in enumerate(cabecalho)}
+    alteracoes = []
+    registros = {}
+    for linha, campo, atual, novo, f_taxa, f_liquido in zip(
+            plano["Linha"].tolist(), plano["Campo"].tolist(), plano["Atual"].tolist(),
+            plano["Corrigido"].tolist(), plano["Fator_Taxa"].tolist(), plano["Fator_Liquido"].tolist()):
+        registro = registros.setdefault(linha, {"taxa": float(f_taxa), "liquido": float(f_liquido), "original": {}})
+        registro["original"][campo] = atual
+        alteracoes.append({"range": f"{col[campo]}{linha}", "values": [[float(novo)]]})
+    for linha, registro in registros.items():
+        alteracoes.append({"range": f"{col['Normalizado']}{linha}", "values": [[NORMALIZADO_SIM]]})
+        alteracoes.append({"range": f"{col['Fator_Correcao']}{linha}", "values": [[json.dumps(registro)]]})
+
+    for i in range(0, len(alteracoes), 500):
+        ws.batch_update(alteracoes[i:i + 500])
+    return int(plano["Linha"].nunique())
+
+def _reparos_gravados(df):
+    """Linhas com o JSON de reparar_escala_operacoes_caixa em Fator_Correcao:
+    Linha, Campo, Atual e Original (o valor de antes do reparo)."""
+    linhas = []
+    for i, texto in enumerate(df["Fator_Correcao"].astype(str).tolist() if not df.empty else []):
+        if not texto.startswith("{"):
+            continue
+        try:
+            original = json.loads(texto)["original"]
+        except (ValueError, KeyError, TypeError):
+            continue
+        linhas += [{"Linha": i + 2, "Campo": campo, "Atual": df[campo].iat[i], "Original": valor}
+                   for campo, valor in original.items() if campo in df.columns]
+    return pd.DataFrame(linhas, columns=["Linha", "Campo", "Atual", "Original"])
+
+def previa_desfazer_reparo_escala(spreadsheet, sheet_name="Operacoes_Caixa"):
+    """O que desfazer_reparo_escala restauraria agora, sem gravar nada."""
+    return _reparos_gravados(_ler_operacoes_para_reparo(spreadsheet, sheet_name)[2])
+
+def desfazer_reparo_escala(spreadsheet, previa, sheet_name="Operacoes_Caixa"):
+    """Restaura os valores originais guardados por reparar_escala_operacoes_caixa e limpa
+    Normalizado/Fator_Correcao dessas linhas (a correção volta a ser só na leitura).
+    Se a planilha mudou desde a `previa` (previa_desfazer_reparo_escala), não grava nada (ValueError).
+    Devolve quantas linhas foram restauradas.
+    """
+    ws, cabecalho, df = _ler_operacoes_para_reparo(spreadsheet, sheet_name)
+    gravados = _reparos_gravados(df)
+    chaves = ["Linha", "Campo", "Atual", "Original"]
+    if len(gravados) != len(previa) or not gravados[chaves].astype(str).equals(
+            previa[chaves].astype(str).reset_index(drop=True)):
+        raise ValueError("a planilha mudou desde a prévia; gere a prévia novamente")
+    if gravados.empty:
+        return 0
+    col = {c: _indice_para_col(i + 1) for i, c in enumerate(cabecalho)}
+    alteracoes = [{"range": f"{col[campo]}{linha}", "values": [[valor]]}
+                  for linha, campo, valor in gravados[["Linha", "Campo", "Original"]].itertuples(index=False)]
+    for linha in gravados["Linha"].unique().tolist():
+        alteracoes.append({"range": f"{col['Normalizado']}{linha}", "values": [[""]]})
+        alteracoes.append({"range": f"{col['Fator_Correcao']}{linha}", "values": [[""]]})
+    for i in range(0, len(alteracoes), 500):
+        ws.batch_update(alteracoes[i:i + 500])
+    return int(gravados["Linha"].nunique())
 
 # Função de debug para valores
 def debug_valores(dados, titulo="Debug"):
@@ -404,85 +2581,103 @@ def debug_valores(dados, titulo="Debug"):
                 if campo in registro:
                     st.write(f"  {campo}: {registro[campo]} (tipo: {type(registro[campo])})")
 
-# Funções de cálculo corrigidas
-def calcular_taxa_cartao_debito(valor):
-    # Garante que valor está formatado corretamente para Decimal
-    valor_dec = Decimal(str(valor).replace(",", "."))
-    
-    taxa_percentual = Decimal("0.01")
-    taxa_cliente = (valor_dec * taxa_percentual).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-    
-    taxa_banco = Decimal("1.00")
-    lucro = taxa_cliente - taxa_banco
-    lucro = max(Decimal("0.00"), lucro)  # Lucro não pode ser negativo
-    
-    valor_liquido = valor_dec - taxa_cliente
-
-    return {
+# ------------------------------------------------------------
+# Motor de taxas: tabela por tipo de operação, cálculo em inteiros
+# ------------------------------------------------------------
+# taxa_cliente = valor * (pct_cliente + pct_cliente_dia * dias), arredondada ao centavo (ROUND_HALF_UP)
+# taxa_banco   = fixo_banco + valor * pct_banco, idem
+# lucro        = taxa_cliente - taxa_banco (nunca negativo quando há custo do banco)
+# valor_liquido = valor - taxa_cliente
+TABELA_TAXAS = {
+    # tipo: (pct_cliente, pct_cliente_dia, pct_banco, fixo_banco); None = % informado na operação
+    "Saque Cartão Débito":    ("0.01",   "0",      "0",      "1.00"),
+    "Saque Cartão Crédito":   ("0.0533", "0",      "0.0433", "0"),
+    "Saque PIX":              ("0.01",   "0",      "0",      "0"),
+    "Cielo Posto":            ("0",      "0",      "0",      "0"),
+    "Cheque à Vista":         ("0.02",   "0",      "0",      "0"),
+    "Cheque Pré-datado":      ("0.02",   "0.0033", "0",      "0"),
+    "Cheque com Taxa Manual": (None,     "0",      "0",      "0"),
+}
+
+ESCALA_VALOR = 10_000     # valores em 1/10000 de real (exato até 4 casas decimais)
+ESCALA_TAXA = 1_000_000   # percentuais em 1/1000000 (ex.: 5,33% = 53_300)
+_CENTAVO = ESCALA_VALOR // 100
+
+def _para_inteiro(valor, escala):
+    """Decimal/str/float -> inteiro na escala, arredondando ROUND_HALF_UP (como Decimal(str(valor)))."""
+    return int((Decimal(str(valor).replace(",", ".")) * escala).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+def _arredondar_centavos(produto, divisor):
+    """produto / divisor arredondado ao centavo (ROUND_HALF_UP), devolvido em ESCALA_VALOR."""
+    d = divisor * _CENTAVO
+    return np.sign(produto) * ((np.abs(produto) + d // 2) // d) * _CENTAVO
+
+def calcular_taxas_lote(valores, tipos, dias=0, taxa_percentual=None):
+    """Taxas de várias operações de uma vez, em inteiros (mesmo resultado das calcular_taxa_*).
+
+    valores: inteiros em ESCALA_VALOR (ver _para_inteiro) ou floats com até 4 casas;
+    tipos: um tipo de TABELA_TAXAS ou um por linha; dias/taxa_percentual (em %): escalar ou por linha.
+    Devolve DataFrame em ESCALA_VALOR com taxa_cliente, taxa_banco, lucro e valor_liquido.
+    """
+    v = np.asarray(valores)
+    if not np.issubdtype(v.dtype, np.integer):
+        v = np.round(v.astype("float64") * ESCALA_VALOR).astype(np.int64)
+    v = v.astype(np.int64).reshape(-1)
+    n = len(v)
+    tipos = np.broadcast_to(np.asarray(tipos, dtype=object), (n,))
+    dias = np.broadcast_to(np.asarray(dias, dtype=np.int64), (n,))
+    manual = np.broadcast_to(np.asarray(taxa_percentual if taxa_percentual is not None else 0, dtype=object), (n,))
+
+    pct_cli, pct_dia, pct_banco, fixo = (np.zeros(n, dtype=np.int64) for _ in range(4))
+    for tipo in pd.unique(tipos):
+        if tipo not in TABELA_TAXAS:
+            raise ValueError(f"Tipo de operação sem taxa cadastrada: {tipo}")
+        m = tipos == tipo
+        cli, dia, banco, fx = TABELA_TAXAS[tipo]
+        if cli is None:
+            pct_cli[m] = [_para_inteiro(Decimal(str(p)) / 100, ESCALA_TAXA) for p in manual[m]]
+        else:
+            pct_cli[m] = _para_inteiro(cli, ESCALA_TAXA)
+        pct_dia[m] = _para_inteiro(dia, ESCALA_TAXA)
+        pct_banco[m] = _para_inteiro(banco, ESCALA_TAXA)
+        fixo[m] = _para_inteiro(fx, ESCALA_VALOR)
+
+    taxa_cliente = _arredondar_centavos(v * (pct_cli + pct_dia * dias), ESCALA_TAXA)
+    taxa_banco = fixo + _arredondar_centavos(v * pct_banco, ESCALA_TAXA)
+    return pd.DataFrame({
         "taxa_cliente": taxa_cliente,
         "taxa_banco": taxa_banco,
-        "lucro": lucro,
-        "valor_liquido": valor_liquido
-    }
+        "lucro": np.where((pct_banco != 0) | (fixo != 0), np.maximum(taxa_cliente - taxa_banco, 0), taxa_cliente - taxa_banco),
+        "valor_liquido": v - taxa_cliente,
+    })
+
+def _em_reais(inteiro):
+    """Inteiro em ESCALA_VALOR -> Decimal (2 casas quando for centavo exato)."""
+    d = Decimal(int(inteiro)) / ESCALA_VALOR
+    return d.quantize(Decimal("0.01")) if int(inteiro) % _CENTAVO == 0 else d.normalize()
+
+def _calcular_taxa(valor, tipo, dias=0, taxa_percentual=None):
+    linha = calcular_taxas_lote([_para_inteiro(valor, ESCALA_VALOR)], tipo, dias, taxa_percentual).iloc[0]
+    return {campo: _em_reais(linha[campo]) for campo in ("taxa_cliente", "taxa_banco", "lucro", "valor_liquido")}
+
+# Funções de cálculo corrigidas (uma operação; ver calcular_taxas_lote)
+def calcular_taxa_cartao_debito(valor):
+    return _calcular_taxa(valor, "Saque Cartão Débito")
 
 def calcular_taxa_cartao_credito(valor):
-    valor_dec = Decimal(str(valor))
-    taxa_cliente = (valor_dec * Decimal("0.0533")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-    taxa_banco = (valor_dec * Decimal("0.0433")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-    lucro = taxa_cliente - taxa_banco
-    valor_liquido = valor_dec - taxa_cliente
+    return _calcular_taxa(valor, "Saque Cartão Crédito")
 
-    return {
-        "taxa_cliente": taxa_cliente,
-        "taxa_banco": taxa_banco,
-        "lucro": lucro if lucro > Decimal("0") else Decimal("0.00"),
-        "valor_liquido": valor_liquido
-    }
+def calcular_taxa_saque_pix(valor):
+    return _calcular_taxa(valor, "Saque PIX")
 
 def calcular_taxa_cheque_vista(valor):
-    valor_dec = Decimal(str(valor))
-    taxa_cliente = (valor_dec * Decimal("0.02")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-    taxa_banco = Decimal("0.00")
-    lucro = taxa_cliente
-    valor_liquido = valor_dec - taxa_cliente
-
-    return {
-        "taxa_cliente": taxa_cliente,
-        "taxa_banco": taxa_banco,
-        "lucro": lucro,
-        "valor_liquido": valor_liquido
-    }
+    return _calcular_taxa(valor, "Cheque à Vista")
 
 def calcular_taxa_cheque_pre_datado(valor, dias):
-    valor_dec = Decimal(str(valor))
-    taxa_base = valor_dec * Decimal("0.02")  # 2%
-    taxa_adicional = valor_dec * Decimal("0.0033") * Decimal(dias)  # 0.33% por dia
-    taxa_cliente = (taxa_base + taxa_adicional).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-    taxa_banco = Decimal("0.00")
-    lucro = taxa_cliente
-    valor_liquido = valor_dec - taxa_cliente
-
-    return {
-        "taxa_cliente": taxa_cliente,
-        "taxa_banco": taxa_banco,
-        "lucro": lucro,
-        "valor_liquido": valor_liquido
-    }
+    return _calcular_taxa(valor, "Cheque Pré-datado", dias=dias)
 
 def calcular_taxa_cheque_manual(valor, taxa_percentual):
-    valor_dec = Decimal(str(valor))
-    taxa_perc_dec = Decimal(str(taxa_percentual)) / Decimal("100")
-    taxa_cliente = (valor_dec * taxa_perc_dec).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-    taxa_banco = Decimal("0.00")
-    lucro = taxa_cliente
-    valor_liquido = valor_dec - taxa_cliente
-
-    return {
-        "taxa_cliente": taxa_cliente,
-        "taxa_banco": taxa_banco,
-        "lucro": lucro,
-        "valor_liquido": valor_liquido
-    }
+    return _calcular_taxa(valor, "Cheque com Taxa Manual", taxa_percentual=taxa_percentual)
 
 # Sistema de autenticação
 def verificar_login():
@@ -551,23 +2746,9 @@ def render_fechamento_loterica(spreadsheet):
     st.subheader("📋 Fechamento da Lotérica (PDVs)")
 
     # ====== Config / cabeçalhos ======
-    HEADERS_FECHAMENTO = [
-        "Data_Fechamento","PDV","Operador",
-        "Qtd_Compra_Bolao","Custo_Unit_Bolao","Total_Compra_Bolao",
-        "Qtd_Compra_Raspadinha","Custo_Unit_Raspadinha","Total_Compra_Raspadinha",
-        "Qtd_Compra_LoteriaFederal","Custo_Unit_LoteriaFederal","Total_Compra_LoteriaFederal",
-        "Qtd_Venda_Bolao","Preco_Unit_Bolao","Total_Venda_Bolao",
-        "Qtd_Venda_Raspadinha","Preco_Unit_Raspadinha","Total_Venda_Raspadinha",
-        "Qtd_Venda_LoteriaFederal","Preco_Unit_LoteriaFederal","Total_Venda_LoteriaFederal",
-        "Movimentacao_Cielo","Pagamento_Premios","Vales_Despesas","Pix_Saida",
-        "Retirada_Cofre","Retirada_CaixaInterno","Dinheiro_Gaveta_Final",
-        "Saldo_Anterior","Saldo_Final_Calculado","Diferenca_Caixa",
-        "Encerrante_Relatorio","Cheques_Recebidos","Suprimento_Cofre","Troco_Anterior","Delta_Encerrante"
-    ]
+    HEADERS_FECHAMENTO = HEADERS_FECHAMENTO_PDV
     MOV_PDV_SHEET   = "Movimentacoes_PDV"
-    HEADERS_MOV_PDV = ["Data","Hora","PDV","Tipo_Mov","Valor","Vinculo_ID","Operador","Observacoes"]
     COFRE_SHEET     = "Operacoes_Cofre"
-    HEADERS_COFRE   = ["Data","Hora","Operador","Tipo","Categoria","Origem","Destino","Valor","Observacoes","Status","Vinculo_ID"]
 
     PDV_UI_TO_CODE = {
         "Pdv1 - terminal 051650 - bruna": "PDV 1",
@@ -586,24 +2767,13 @@ def render_fechamento_loterica(spreadsheet):
     SANG_ALIASES = {"sangria", "saida para cofre", "saída para cofre", "retirada para cofre"}
     SANG_INT_ALIASES = {"saída p/ caixa interno","saida p/ caixa interno","retirada p/ caixa interno"}
 
+    # Mov_PDV e fechamentos são lidos/tipados uma vez por renderização
+    ctx = ContextoDados(spreadsheet)
+
     def _sum_mov_by_alias(pdv_code, data_alvo, aliases_set):
         total, ids = 0.0, []
         try:
-            mov_raw = buscar_dados(spreadsheet, MOV_PDV_SHEET) or []
-            df = pd.DataFrame(mov_raw)
-            if df.empty: return 0.0, []
-            for c in ["Data","PDV","Tipo_Mov","Valor","Vinculo_ID"]:
-                if c not in df.columns: df[c] = None
-            df["Data"] = pd.to_datetime(df["Data"], errors="coerce").dt.date
-            df["Tipo_Mov_norm"] = df["Tipo_Mov"].astype(str).str.lower().str.strip()
-            m = (df["Data"].eq(pd.to_datetime(data_alvo).date())
-                 & df["PDV"].astype(str).eq(pdv_code)
-                 & df["Tipo_Mov_norm"].isin(aliases_set))
-            dfx = df.loc[m].copy()
-            if dfx.empty: return 0.0, []
-            dfx["Valor"] = pd.to_numeric(dfx["Valor"], errors="coerce").fillna(0.0)
-            total = float(dfx["Valor"].sum())
-            ids = dfx["Vinculo_ID"].dropna().astype(str).tolist()
+            total, ids = ctx.indice_mov_pdv().total(pdv_code, data_alvo, aliases_set)
         except Exception as e:
             st.warning(f"⚠️ Não foi possível ler {MOV_PDV_SHEET}: {e}")
         return total, ids
@@ -617,37 +2787,15 @@ def render_fechamento_loterica(spreadsheet):
     def _get_sangrias_do_dia(pdv_code, data_alvo):
         return _sum_mov_by_alias(pdv_code, data_alvo, SANG_INT_ALIASES)
 
-    def _get_saldo_anterior(pdv_code, data_alvo):
+    def _get_anteriores(pdv_code, data_alvo):
+        """(saldo, troco) do último fechamento antes de data_alvo."""
         try:
-            ws_name = _sheet_for_pdv_code(pdv_code)
-            df = pd.DataFrame(buscar_dados(spreadsheet, ws_name) or [])
-            if df.empty or "Data_Fechamento" not in df.columns: return 0.0
-            df["Data_Fechamento"] = pd.to_datetime(df["Data_Fechamento"], errors="coerce").dt.date
-            df = df[df["PDV"].astype(str).eq(pdv_code)]
-            df = df[df["Data_Fechamento"] < pd.to_datetime(data_alvo).date()]
-            if df.empty: return 0.0
-            if "Saldo_Final_Calculado" in df.columns:
-                df["Saldo_Final_Calculado"] = pd.to_numeric(df["Saldo_Final_Calculado"], errors="coerce").fillna(0.0)
-                df = df.sort_values("Data_Fechamento")
-                return float(df["Saldo_Final_Calculado"].iloc[-1])
-            return 0.0
-        except Exception:
-            return 0.0
-
-    def _get_troco_anterior(pdv_code, data_alvo):
-        try:
-            ws_name = _sheet_for_pdv_code(pdv_code)
-            df = pd.DataFrame(buscar_dados(spreadsheet, ws_name) or [])
-            if df.empty or "Data_Fechamento" not in df.columns: return 0.0
-            df["Data_Fechamento"] = pd.to_datetime(df["Data_Fechamento"], errors="coerce").dt.date
-            df = df[(df["PDV"].astype(str).eq(pdv_code)) & (df["Data_Fechamento"] < pd.to_datetime(data_alvo).date())]
-            if df.empty: return 0.0
-            df = df.sort_values("Data_Fechamento")
-            if "Dinheiro_Gaveta_Final" in df.columns:
-                return float(pd.to_numeric(df["Dinheiro_Gaveta_Final"], errors="coerce").fillna(0.0).iloc[-1])
-            return 0.0
+            ant = ctx.livro_fechamentos(_sheet_for_pdv_code(pdv_code)).anterior(pdv_code, data_alvo)
+            if ant is None: return 0.0, 0.0
+            return (float(ant.get("Saldo_Final_Calculado", 0.0)),
+                    float(ant.get("Dinheiro_Gaveta_Final", 0.0)))
         except Exception:
-            return 0.0
+            return 0.0, 0.0
 
     # ====== RESET SEGURO (flag + rerun) ======
     DEFAULTS = {
@@ -669,8 +2817,14 @@ def render_fechamento_loterica(spreadsheet):
         if not st.session_state.get(K("keep_context"), True):
             st.session_state[K("pdv_ui")] = list(PDV_UI_TO_CODE.keys())[0]
             st.session_state[K("data")] = obter_date_brasilia()
+        st.session_state.pop(K("lote"), None)  # próximo fechamento, vínculos novos
         st.session_state[K("do_reset")] = False  # limpa a flag
 
+    # sufixo dos Vinculo_ID de suprimento/retirada: fixo até o fechamento ser salvo, para que
+    # salvar de novo após uma falha parcial não duplique as linhas que já foram gravadas
+    if K("lote") not in st.session_state:
+        st.session_state[K("lote")] = uuid.uuid4().hex[:8]
+
     def _reset_fechamento_form(keep_context=True):
         # Em vez de alterar session_state após widgets, só marcamos a flag
         st.session_state[K("keep_context")] = bool(keep_context)
@@ -779,8 +2933,7 @@ def render_fechamento_loterica(spreadsheet):
 
     st.markdown("---")
     st.markdown("### Fechamento de caixa")
-    saldo_anterior = _get_saldo_anterior(pdv_code, data_alvo)
-    troco_anterior = _get_troco_anterior(pdv_code, data_alvo)
+    saldo_anterior, troco_anterior = _get_anteriores(pdv_code, data_alvo)
     encerrante_rel = st.number_input("Encerrante do Relatório (pode ser negativo)", step=50.0, format="%.2f", key=K("encerrante_rel"))
     dg_final       = st.number_input("Dinheiro em Gaveta (final do dia) (R$)", min_value=0.0, step=50.0, format="%.2f", key=K("dg_final"))
 
@@ -844,48 +2997,47 @@ def render_fechamento_loterica(spreadsheet):
             ws = get_or_create_worksheet(spreadsheet, ws_name, HEADERS_FECHAMENTO)
 
             # duplicidade PDV+Data
-            df_exist = pd.DataFrame(buscar_dados(spreadsheet, ws_name) or [])
+            df_exist = ctx.df(ws_name)
             existe_registro = False
-            if not df_exist.empty and {"Data_Fechamento","PDV"}.issubset(df_exist.columns):
-                df_exist["Data_Fechamento"] = pd.to_datetime(df_exist["Data_Fechamento"], errors="coerce").dt.date
+            if not df_exist.empty:
                 mask_dup = (df_exist["PDV"].astype(str).eq(pdv_code) &
-                            df_exist["Data_Fechamento"].eq(pd.to_datetime(data_alvo).date()))
+                            df_exist["Data_Fechamento"].eq(pd.Timestamp(data_alvo)))
                 existe_registro = bool(df_exist.loc[mask_dup].shape[0] > 0)
             if existe_registro:
                 st.error("❌ Já existe um fechamento para este PDV nesta data. Edite/remova o registro existente.")
                 st.stop()
 
+            # Mov_PDV, Cofre e o fechamento vão juntos: um append_rows por aba
+            tx = TransacaoPlanilhas(spreadsheet)
+            operador_logado = st.session_state.get("nome_usuario","")
+
             # 1) Suprimento manual => Mov_PDV: Suprimento | Cofre: Saída
             if _to_float(supr_manual) > 0:
-                ws_mov_pdv = get_or_create_worksheet(spreadsheet, MOV_PDV_SHEET, HEADERS_MOV_PDV)
-                ws_cofre   = get_or_create_worksheet(spreadsheet, COFRE_SHEET, HEADERS_COFRE)
                 hora = obter_horario_brasilia()
-                vinc = f"SUPR|{str(data_alvo)}|{pdv_code}|{_to_float(supr_manual):.2f}|{hora}"
-                mov_exist = pd.DataFrame(buscar_dados(spreadsheet, MOV_PDV_SHEET) or [])
-                if not (("Vinculo_ID" in mov_exist.columns) and mov_exist["Vinculo_ID"].astype(str).eq(vinc).any()):
-                    ws_mov_pdv.append_row([str(data_alvo), hora, pdv_code, "Suprimento",
-                                           float(_to_float(supr_manual)), vinc, st.session_state.get("nome_usuario",""),
-                                           "lançado no Fechamento PDV"])
-                    ws_cofre.append_row([str(obter_data_brasilia()), hora, st.session_state.get("nome_usuario",""),
-                                         "Saída","Transferência para Caixa Lotérica","Cofre Principal",
-                                         f"Caixa Lotérica - {pdv_code}", float(_to_float(supr_manual)),
-                                         "lançado via Fechamento PDV","Concluído", vinc])
+                vinc = f"SUPR|{str(data_alvo)}|{pdv_code}|{_to_float(supr_manual):.2f}|{st.session_state[K('lote')]}"
+                tx.adicionar(MOV_PDV_SHEET, HEADERS_MOV_PDV,
+                             [str(data_alvo), hora, pdv_code, "Suprimento",
+                              float(_to_float(supr_manual)), vinc, operador_logado,
+                              "lançado no Fechamento PDV"], vinculo_id=vinc)
+                tx.adicionar(COFRE_SHEET, HEADERS_COFRE,
+                             [str(obter_data_brasilia()), hora, operador_logado,
+                              "Saída","Transferência para Caixa Lotérica","Cofre Principal",
+                              f"Caixa Lotérica - {pdv_code}", float(_to_float(supr_manual)),
+                              "lançado via Fechamento PDV","Concluído", vinc], vinculo_id=vinc)
 
             # 2) Retirada p/ Cofre manual => Mov_PDV: Sangria | Cofre: Entrada
             if _to_float(ret_cofre_manual) > 0:
-                ws_mov_pdv = get_or_create_worksheet(spreadsheet, MOV_PDV_SHEET, HEADERS_MOV_PDV)
-                ws_cofre   = get_or_create_worksheet(spreadsheet, COFRE_SHEET, HEADERS_COFRE)
                 hora = obter_horario_brasilia()
-                vinc = f"RETCOFRE|{str(data_alvo)}|{pdv_code}|{_to_float(ret_cofre_manual):.2f}|{hora}"
-                mov_exist = pd.DataFrame(buscar_dados(spreadsheet, MOV_PDV_SHEET) or [])
-                if not (("Vinculo_ID" in mov_exist.columns) and mov_exist["Vinculo_ID"].astype(str).eq(vinc).any()):
-                    ws_mov_pdv.append_row([str(data_alvo), hora, pdv_code, "Sangria",
-                                           float(_to_float(ret_cofre_manual)), vinc, st.session_state.get("nome_usuario",""),
-                                           "lançado no Fechamento PDV"])
-                    ws_cofre.append_row([str(obter_data_brasilia()), hora, st.session_state.get("nome_usuario",""),
-                                         "Entrada","Transferência do Caixa Lotérica",f"Caixa Lotérica - {pdv_code}",
-                                         "Cofre Principal", float(_to_float(ret_cofre_manual)),
-                                         "lançado via Fechamento PDV","Concluído", vinc])
+                vinc = f"RETCOFRE|{str(data_alvo)}|{pdv_code}|{_to_float(ret_cofre_manual):.2f}|{st.session_state[K('lote')]}"
+                tx.adicionar(MOV_PDV_SHEET, HEADERS_MOV_PDV,
+                             [str(data_alvo), hora, pdv_code, "Sangria",
+                              float(_to_float(ret_cofre_manual)), vinc, operador_logado,
+                              "lançado no Fechamento PDV"], vinculo_id=vinc)
+                tx.adicionar(COFRE_SHEET, HEADERS_COFRE,
+                             [str(obter_data_brasilia()), hora, operador_logado,
+                              "Entrada","Transferência do Caixa Lotérica",f"Caixa Lotérica - {pdv_code}",
+                              "Cofre Principal", float(_to_float(ret_cofre_manual)),
+                              "lançado via Fechamento PDV","Concluído", vinc], vinculo_id=vinc)
 
             # 3) Salvar o fechamento
             row = [
@@ -902,10 +3054,13 @@ def render_fechamento_loterica(spreadsheet):
                 float(encerrante_rel), float(cheques_recebidos), float(supr_total), float(troco_anterior),
                 float(delta_enc_calc)
             ]
-            ws.append_row(row)
+            tx.adicionar(ws_name, HEADERS_FECHAMENTO, row)
+            tx.confirmar()
+
+            # compras/vendas do fechamento -> Estoque_Loterica_Mov, em segundo plano
+            fila_sinc_estoque(spreadsheet).agendar(pdv_code, ws_name, data_alvo)
 
             st.success("✅ Fechamento salvo com sucesso!")
-            st.cache_data.clear()
 
             # Reset seguro (sem tocar no session_state após widgets)
             _reset_fechamento_form(keep_context=True)
@@ -933,26 +3088,10 @@ def render_gestao_loterica(spreadsheet):
     PRODUTOS = ["Bolão", "Raspadinha", "Loteria Federal"]
 
     # Cabeçalho dos fechamentos (com novos campos ao fim)
-    HEADERS_FECHAMENTO = [
-        "Data_Fechamento", "PDV", "Operador",
-        "Qtd_Compra_Bolao", "Custo_Unit_Bolao", "Total_Compra_Bolao",
-        "Qtd_Compra_Raspadinha", "Custo_Unit_Raspadinha", "Total_Compra_Raspadinha",
-        "Qtd_Compra_LoteriaFederal", "Custo_Unit_LoteriaFederal", "Total_Compra_LoteriaFederal",
-        "Qtd_Venda_Bolao", "Preco_Unit_Bolao", "Total_Venda_Bolao",
-        "Qtd_Venda_Raspadinha", "Preco_Unit_Raspadinha", "Total_Venda_Raspadinha",
-        "Qtd_Venda_LoteriaFederal", "Preco_Unit_LoteriaFederal", "Total_Venda_LoteriaFederal",
-        "Movimentacao_Cielo", "Pagamento_Premios", "Vales_Despesas", "Pix_Saida",
-        "Retirada_Cofre", "Retirada_CaixaInterno", "Dinheiro_Gaveta_Final",
-        "Saldo_Anterior", "Saldo_Final_Calculado", "Diferenca_Caixa",
-        "Encerrante_Relatorio", "Cheques_Recebidos", "Suprimento_Cofre", "Troco_Anterior", "Delta_Encerrante"
-    ]
+    HEADERS_FECHAMENTO = HEADERS_FECHAMENTO_PDV
 
-    # Movimentos de estoque
-    HEADERS_MOV = [
-        "Data", "Hora", "PDV", "Produto", "Tipo_Mov",  # Entrada | Venda | Ajuste+ | Ajuste-
-        "Qtd", "Valor_Unit", "Valor_Total", "Obs",
-        "Origem", "Chave_Sync"
-    ]
+    # Movimentos de estoque (Entrada | Venda | Ajuste+ | Ajuste-)
+    HEADERS_MOV = HEADERS_ESTOQUE_MOV
 
     # garante existência da planilha de movimentos
     try:
@@ -962,33 +3101,11 @@ def render_gestao_loterica(spreadsheet):
         return
 
     # -------------------- utils internos --------------------
-    def _load_mov():
-        dados = buscar_dados(spreadsheet, SHEET_MOV) or []
-        df = pd.DataFrame(dados)
-        if df.empty:
-            df = pd.DataFrame(columns=HEADERS_MOV)
-        for c in ["Qtd", "Valor_Unit", "Valor_Total"]:
-            if c in df.columns:
-                df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0.0)
-        return df
+    ctx = ContextoDados(spreadsheet)
 
-    def _saldo_estoque(df_mov):
-        if df_mov.empty:
-            return pd.DataFrame(columns=["PDV", "Produto", "Saldo_Qtd", "Custo_Médio", "Valor_Custo_Estimado"])
-        df = df_mov.copy()
-        df["fator"] = 0
-        df.loc[df["Tipo_Mov"].isin(["Entrada", "Ajuste+"]), "fator"] = 1
-        df.loc[df["Tipo_Mov"].isin(["Venda", "Ajuste-"]), "fator"] = -1
-        df["Mov_Qtd"] = df["Qtd"] * df["fator"]
-        df_ent = df[df["fator"] == 1].groupby(["PDV", "Produto"], as_index=False)[["Qtd", "Valor_Total"]].sum()
-        if not df_ent.empty:
-            df_ent["Custo_Médio"] = (df_ent["Valor_Total"] / df_ent["Qtd"]).replace([np.inf, -np.inf], 0).fillna(0)
-        else:
-            df_ent = pd.DataFrame(columns=["PDV", "Produto", "Qtd", "Valor_Total", "Custo_Médio"])
-        df_saldo = df.groupby(["PDV", "Produto"], as_index=False)["Mov_Qtd"].sum().rename(columns={"Mov_Qtd": "Saldo_Qtd"})
-        df_saldo = df_saldo.merge(df_ent[["PDV", "Produto", "Custo_Médio"]], on=["PDV", "Produto"], how="left").fillna({"Custo_Médio": 0})
-        df_saldo["Valor_Custo_Estimado"] = df_saldo["Saldo_Qtd"] * df_saldo["Custo_Médio"]
-        return df_saldo
+    def _saldo_estoque(pdv=None, produto=None):
+        """Posição mantida pelos movimentos (PosicaoEstoque), filtrada por PDV/Produto."""
+        return ctx.posicao_estoque().tabela(pdv, produto)
 
     def _sheet_for_pdv(pdv): 
         return FECH_PDV[pdv]
@@ -1003,21 +3120,7 @@ def render_gestao_loterica(spreadsheet):
         """Saídas p/ Caixa Interno do dia (auto)."""
         total, ids = 0.0, []
         try:
-            mov_raw = buscar_dados(spreadsheet, "Movimentacoes_PDV") or []
-            df = pd.DataFrame(mov_raw)
-            if not df.empty:
-                for col in ["Data","PDV","Tipo_Mov","Valor","Vinculo_ID"]:
-                    if col not in df.columns: 
-                        df[col] = None
-                df["Data"] = pd.to_datetime(df["Data"], errors="coerce").dt.date
-                m = (df["Data"].eq(pd.to_datetime(data_alvo).date())
-                     & df["PDV"].astype(str).eq(pdv)
-                     & df["Tipo_Mov"].astype(str).eq("Saída p/ Caixa Interno"))
-                dfd = df.loc[m].copy()
-                if not dfd.empty:
-                    dfd["Valor"] = pd.to_numeric(dfd["Valor"], errors="coerce").fillna(0.0)
-                    total = float(dfd["Valor"].sum())
-                    ids = dfd["Vinculo_ID"].dropna().astype(str).tolist()
+            total, ids = ctx.indice_mov_pdv().total(pdv, data_alvo, ["Saída p/ Caixa Interno"])
         except Exception as e:
             st.warning(f"⚠️ Não foi possível ler Movimentacoes_PDV (sangrias): {e}")
         return total, ids
@@ -1029,84 +3132,47 @@ def render_gestao_loterica(spreadsheet):
         """
         total, ids = 0.0, []
         try:
-            mov_raw = buscar_dados(spreadsheet, "Movimentacoes_PDV") or []
-            df = pd.DataFrame(mov_raw)
-            if not df.empty:
-                for col in ["Data","PDV","Tipo_Mov","Valor","Vinculo_ID"]:
-                    if col not in df.columns: 
-                        df[col] = None
-                df["Data"] = pd.to_datetime(df["Data"], errors="coerce").dt.date
-                m = (df["Data"].eq(pd.to_datetime(data_alvo).date())
-                     & df["PDV"].astype(str).eq(pdv)
-                     & df["Tipo_Mov"].astype(str).isin(["Entrada do Cofre", "Suprimento do Cofre"]))
-                dfe = df.loc[m].copy()
-                if not dfe.empty:
-                    dfe["Valor"] = pd.to_numeric(dfe["Valor"], errors="coerce").fillna(0.0)
-                    total = float(dfe["Valor"].sum())
-                    ids = dfe["Vinculo_ID"].dropna().astype(str).tolist()
+            total, ids = ctx.indice_mov_pdv().total(pdv, data_alvo, ["Entrada do Cofre", "Suprimento do Cofre"])
         except Exception as e:
             st.warning(f"⚠️ Não foi possível ler Movimentacoes_PDV (entradas do cofre): {e}")
         return total, ids
 
-    def _get_saldo_anterior(pdv, data_alvo):
-        """Último Saldo_Final_Calculado anterior (para manter compatibilidade)."""
+    def _get_anteriores(pdv, data_alvo):
+        """(Saldo_Final_Calculado, Dinheiro_Gaveta_Final) do último fechamento anterior:
+        saldo anterior e troco do Lado Esquerdo."""
         try:
-            ws_name = _sheet_for_pdv(pdv)
-            df = pd.DataFrame(buscar_dados(spreadsheet, ws_name) or [])
-            if df.empty or "Data_Fechamento" not in df.columns: 
-                return 0.0
-            df["Data_Fechamento"] = pd.to_datetime(df["Data_Fechamento"], errors="coerce").dt.date
-            df = df[(df["PDV"].astype(str).eq(pdv)) & (df["Data_Fechamento"] < pd.to_datetime(data_alvo).date())]
-            if df.empty: 
-                return 0.0
-            df = df.sort_values("Data_Fechamento")
-            if "Saldo_Final_Calculado" in df.columns:
-                return float(pd.to_numeric(df["Saldo_Final_Calculado"], errors="coerce").fillna(0.0).iloc[-1])
-            return 0.0
+            ant = ctx.livro_fechamentos(_sheet_for_pdv(pdv)).anterior(pdv, data_alvo)
+            if ant is None:
+                return 0.0, 0.0
+            return (float(ant.get("Saldo_Final_Calculado", 0.0)),
+                    float(ant.get("Dinheiro_Gaveta_Final", 0.0)))
         except Exception:
-            return 0.0
+            return 0.0, 0.0
 
-    def _get_troco_anterior(pdv, data_alvo):
-        """Dinheiro em Gaveta do dia anterior (troco) — usado no Lado Esquerdo."""
+    def _find_row_by_pdv_date(ws, target_pdv, target_date):
+        """Linha do fechamento (1 = cabeçalho) pelo LocalizadorFechamentos da aba, sem ler a planilha."""
         try:
-            ws_name = _sheet_for_pdv(pdv)
-            df = pd.DataFrame(buscar_dados(spreadsheet, ws_name) or [])
-            if df.empty or "Data_Fechamento" not in df.columns: 
-                return 0.0
-            df["Data_Fechamento"] = pd.to_datetime(df["Data_Fechamento"], errors="coerce").dt.date
-            df = df[(df["PDV"].astype(str).eq(pdv)) & (df["Data_Fechamento"] < pd.to_datetime(data_alvo).date())]
-            if df.empty: 
-                return 0.0
-            df = df.sort_values("Data_Fechamento")
-            if "Dinheiro_Gaveta_Final" in df.columns:
-                return float(pd.to_numeric(df["Dinheiro_Gaveta_Final"], errors="coerce").fillna(0.0).iloc[-1])
-            return 0.0
+            return ctx.localizador_fechamentos(ws.title).linha(target_pdv, target_date)
         except Exception:
-            return 0.0
+            return None
 
-    def _find_row_by_pdv_date(ws, target_pdv, target_date):
-        try:
-            vals = ws.get_all_values()
-            if not vals: 
-                return None
-            headers = vals[0]
-            try:
-                i_pdv = headers.index("PDV"); i_dt = headers.index("Data_Fechamento")
-            except ValueError:
-                return None
-            tgt_date = pd.to_datetime(target_date, errors="coerce").date()
-            for i in range(1, len(vals)):
-                row = vals[i]
-                if len(row) <= max(i_pdv, i_dt): 
-                    continue
-                r_pdv = str(row[i_pdv]); r_dt = pd.to_datetime(row[i_dt], errors="coerce")
-                if pd.isna(r_dt): 
-                    continue
-                if (r_pdv == target_pdv) and (r_dt.date() == tgt_date):
-                    return i + 1
+    def _confirmar_linha(ws, row_idx, target_pdv, target_date):
+        """Antes de gravar, confere só a linha alvo na planilha; se ela mudou por fora do app,
+        recarrega a aba e localiza de novo."""
+        if row_idx is None:
             return None
+        try:
+            headers = _sincronizador(spreadsheet).estado(spreadsheet, ws.title).cabecalho
+            vals = ws.row_values(row_idx)
+            vals += [""] * (len(headers) - len(vals))
+            r_dt = pd.to_datetime(vals[headers.index("Data_Fechamento")], errors="coerce")
+            if (str(vals[headers.index("PDV")]) == target_pdv and not pd.isna(r_dt)
+                    and r_dt.date() == pd.to_datetime(target_date).date()):
+                return row_idx
         except Exception:
-            return None
+            pass
+        _sincronizador(spreadsheet).invalidar(ws.title, recarga_completa=True)
+        return _find_row_by_pdv_date(ws, target_pdv, target_date)
 
     # -------- helpers de normalização e conciliação --------
     _num_cols_all = [
@@ -1130,19 +3196,12 @@ def render_gestao_loterica(spreadsheet):
         for c in HEADERS_FECHAMENTO:
             if c not in df.columns: 
                 df[c] = 0
-        # tipa
+        # tipa (frames de carregar_tabela já chegam numéricos)
         for c in _num_cols_all:
-            if c in df.columns:
+            if c in df.columns and not pd.api.types.is_float_dtype(df[c]):
                 df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0.0)
-        # soma vendas
-        df["Total_Vendas_Soma"] = df["Total_Venda_Bolao"] + df["Total_Venda_Raspadinha"] + df["Total_Venda_LoteriaFederal"]
-        # fórmula de conciliação do Encerrante (regra acordada)
-        df["Left_Enc"]  = df["Encerrante_Relatorio"] + df["Troco_Anterior"] + df["Suprimento_Cofre"] + df["Total_Vendas_Soma"]
-        df["Right_Enc"] = df["Movimentacao_Cielo"] + df["Pix_Saida"] + df["Cheques_Recebidos"] \
-                          + df["Pagamento_Premios"] + df["Vales_Despesas"] + df["Retirada_Cofre"] \
-                          + df["Total_Compra_Bolao"] + df["Retirada_CaixaInterno"] + df["Dinheiro_Gaveta_Final"]
-        df["Delta_Enc_Calc"] = df["Left_Enc"] - df["Right_Enc"]
-        return df
+        # vendas e conciliação do Encerrante (regra acordada)
+        return calcular_encerrante(df)
 
     # ---------------------- abas ----------------------
     tab1, tab2, tab3, tab4, tab5 = st.tabs([
@@ -1153,20 +3212,14 @@ def render_gestao_loterica(spreadsheet):
     with tab1:
         st.markdown("#### 📦 Estoque Atual por PDV/Produto")
 
-        df_mov = _load_mov()
         c1, c2 = st.columns(2)
         with c1:
             filtro_pdv = st.selectbox("Filtrar por PDV", ["Todos"] + list(FECH_PDV.keys()), key="flt_pdv_est")
         with c2:
             filtro_prod = st.selectbox("Filtrar por Produto", ["Todos"] + PRODUTOS, key="flt_prod_est")
 
-        df_fil = df_mov.copy()
-        if filtro_pdv != "Todos": 
-            df_fil = df_fil[df_fil["PDV"] == filtro_pdv]
-        if filtro_prod != "Todos": 
-            df_fil = df_fil[df_fil["Produto"] == filtro_prod]
-
-        df_saldo = _saldo_estoque(df_fil)
+        df_saldo = _saldo_estoque(None if filtro_pdv == "Todos" else filtro_pdv,
+                                  None if filtro_prod == "Todos" else filtro_prod)
         if df_saldo.empty:
             st.info("Nenhum movimento de estoque lançado ainda.")
         else:
@@ -1175,9 +3228,24 @@ def render_gestao_loterica(spreadsheet):
             with colB: st.metric("Soma de quantidades", f"{df_saldo['Saldo_Qtd'].sum():,.0f}")
             with colC: st.metric("Valor de custo estimado", f"R$ {df_saldo['Valor_Custo_Estimado'].sum():,.2f}")
             st.dataframe(df_saldo.sort_values(["PDV","Produto"]), use_container_width=True)
-            st.download_button("⬇️ Baixar estoque (CSV)",
-                               data=df_saldo.to_csv(index=False).encode("utf-8"),
-                               file_name="estoque_pdv_produto.csv", mime="text/csv")
+            botao_exportacao("⬇️ Baixar estoque", "estoque_pdv_produto",
+                             ("estoque", (filtro_pdv, filtro_prod), ctx.versoes([SHEET_MOV])),
+                             lambda: df_saldo, key="exp_estoque")
+
+        with st.expander("🔍 Conferir posição do estoque"):
+            st.caption("Recalcula a posição a partir de todo o histórico de movimentos e compara com a mantida.")
+            if st.button("🔁 Reconstruir e conferir", key="btn_reconstruir_estoque"):
+                try:
+                    reconstruida = PosicaoEstoque.montar(ctx.df(SHEET_MOV))
+                    divergentes = ctx.posicao_estoque().diferencas(reconstruida)
+                    if divergentes:
+                        st.warning(f"⚠️ {len(divergentes)} item(ns) divergente(s); a posição será recarregada da planilha.")
+                        st.dataframe(pd.DataFrame(divergentes, columns=["PDV", "Produto"]), use_container_width=True)
+                        _sincronizador(spreadsheet).invalidar(SHEET_MOV, recarga_completa=True)
+                    else:
+                        st.success("✅ Posição mantida confere com a reconstrução.")
+                except Exception as e:
+                    st.error(f"Erro ao conferir estoque: {e}")
 
         st.markdown("---")
         st.markdown("#### ✍️ Ajuste Manual de Estoque")
@@ -1203,10 +3271,34 @@ def render_gestao_loterica(spreadsheet):
                                float(aj_qtd), float(aj_val), float(valor_total),
                                aj_obs, "AJUSTE_MANUAL", ""])
                 st.success("✅ Ajuste registrado.")
-                st.cache_data.clear(); st.experimental_rerun()
+                st.rerun()
             except Exception as e:
                 st.error(f"❌ Erro ao registrar ajuste: {e}")
 
+    # -------- relatórios de período (RelatorioFechamentos por PDV, compartilhado entre as abas) --------
+    def _relatorios(pdv_sel):
+        rels = []
+        for pdv, sheet in FECH_PDV.items():
+            if pdv_sel != "Todos" and pdv != pdv_sel:
+                continue
+            try:
+                rels.append(ctx.relatorio_fechamentos(sheet, pdv))
+            except Exception as e:
+                st.warning(f"⚠️ Erro ao buscar {sheet}: {e}")
+        return rels
+
+    def _totais_periodo(rels, ini, fim):
+        return sum((r.totais(ini, fim) for r in rels),
+                   pd.Series(0.0, index=RelatorioFechamentos.COLUNAS_SOMA + ["Fechamentos"]))
+
+    def _linhas_periodo(rels, ini, fim):
+        frames = [r.linhas_periodo(ini, fim) for r in rels]
+        frames = [f for f in frames if not f.empty]
+        if not frames:
+            return pd.DataFrame(columns=HEADERS_FECHAMENTO + ["Total_Vendas_Soma", "Left_Enc", "Right_Enc", "Delta_Enc_Calc"])
+        df = pd.concat(frames, ignore_index=True)
+        return df.assign(Data_Fechamento=df["Data_Fechamento"].dt.date)
+
     # -------------------- TAB 2 — RELATÓRIOS ---------------------
     with tab2:
         st.markdown("#### 📊 Relatórios e Conciliação do Encerrante")
@@ -1215,32 +3307,15 @@ def render_gestao_loterica(spreadsheet):
         with c2: ini = st.date_input("Início", value=obter_date_brasilia() - timedelta(days=7), key="rel_ini")
         with c3: fim = st.date_input("Fim", value=obter_date_brasilia(), key="rel_fim")
 
-        frames = []
-        for pdv, sheet in FECH_PDV.items():
-            try:
-                dados = buscar_dados(spreadsheet, sheet) or []
-                df = pd.DataFrame(dados)
-                if df.empty: 
-                    continue
-                df["Data_Fechamento"] = pd.to_datetime(df["Data_Fechamento"], errors="coerce").dt.date
-                df = df[(df["Data_Fechamento"] >= ini) & (df["Data_Fechamento"] <= fim)]
-                if df.empty: 
-                    continue
-                df["PDV"] = pdv
-                frames.append(df)
-            except Exception as e:
-                st.warning(f"⚠️ Erro ao buscar {sheet}: {e}")
+        rels = _relatorios(pdv_r)
+        tot = _totais_periodo(rels, ini, fim)
 
-        if not frames:
+        if not tot["Fechamentos"]:
             st.info("Sem dados no período selecionado.")
         else:
-            df_all = _normalize_fech(pd.concat(frames, ignore_index=True))
-            if pdv_r != "Todos": 
-                df_all = df_all[df_all["PDV"] == pdv_r]
-
             # KPIs compras x vendas
-            total_compra = df_all[["Total_Compra_Bolao","Total_Compra_Raspadinha","Total_Compra_LoteriaFederal"]].sum().sum()
-            total_venda  = df_all[["Total_Venda_Bolao","Total_Venda_Raspadinha","Total_Venda_LoteriaFederal"]].sum().sum()
+            total_compra = tot[["Total_Compra_Bolao","Total_Compra_Raspadinha","Total_Compra_LoteriaFederal"]].sum()
+            total_venda  = tot[["Total_Venda_Bolao","Total_Venda_Raspadinha","Total_Venda_LoteriaFederal"]].sum()
             margem_bruta = total_venda - total_compra
 
             k1, k2, k3 = st.columns(3)
@@ -1250,8 +3325,8 @@ def render_gestao_loterica(spreadsheet):
                             f"{(margem_bruta/total_venda*100 if total_venda>0 else 0):.1f}%")
 
             # Conciliação do Encerrante — período (mesma fórmula do fechamento)
-            left_period  = float(df_all["Left_Enc"].sum())
-            right_period = float(df_all["Right_Enc"].sum())
+            left_period  = float(tot["Left_Enc"])
+            right_period = float(tot["Right_Enc"])
             delta_period = left_period - right_period
             cA, cB, cC = st.columns(3)
             with cA: st.metric("Lado Esquerdo (período)", f"R$ {left_period:,.2f}")
@@ -1261,12 +3336,12 @@ def render_gestao_loterica(spreadsheet):
             # ======= NOVO: tabelas por lado (Entradas x Saídas) =======
             # ENTRADAS (Lado Esquerdo)
             entradas_dict = {
-                "Encerrante do Relatório": float(df_all["Encerrante_Relatorio"].sum()),
-                "Troco do dia anterior":   float(df_all["Troco_Anterior"].sum()),
-                "Suprimentos do Cofre":    float(df_all["Suprimento_Cofre"].sum()),
-                "Vendas Bolão":            float(df_all["Total_Venda_Bolao"].sum()),
-                "Vendas Raspadinha":       float(df_all["Total_Venda_Raspadinha"].sum()),
-                "Vendas Loteria Federal":  float(df_all["Total_Venda_LoteriaFederal"].sum()),
+                "Encerrante do Relatório": float(tot["Encerrante_Relatorio"]),
+                "Troco do dia anterior":   float(tot["Troco_Anterior"]),
+                "Suprimentos do Cofre":    float(tot["Suprimento_Cofre"]),
+                "Vendas Bolão":            float(tot["Total_Venda_Bolao"]),
+                "Vendas Raspadinha":       float(tot["Total_Venda_Raspadinha"]),
+                "Vendas Loteria Federal":  float(tot["Total_Venda_LoteriaFederal"]),
             }
             df_entradas = pd.DataFrame(
                 [{"Categoria": k, "Total_R$": v} for k, v in entradas_dict.items()]
@@ -1274,15 +3349,15 @@ def render_gestao_loterica(spreadsheet):
 
             # SAÍDAS (Lado Direito)
             saidas_dict = {
-                "Movimentação Cielo":      float(df_all["Movimentacao_Cielo"].sum()),
-                "PIX Saída":               float(df_all["Pix_Saida"].sum()),
-                "Cheques Recebidos":       float(df_all["Cheques_Recebidos"].sum()),
-                "Pagamento de Prêmios":    float(df_all["Pagamento_Premios"].sum()),
-                "Vales/Despesas":          float(df_all["Vales_Despesas"].sum()),
-                "Retirada para Cofre":     float(df_all["Retirada_Cofre"].sum()),
-                "Total Compra Bolão":      float(df_all["Total_Compra_Bolao"].sum()),
-                "Retirada p/ Caixa Interno": float(df_all["Retirada_CaixaInterno"].sum()),
-                "Dinheiro em Gaveta":      float(df_all["Dinheiro_Gaveta_Final"].sum()),
+                "Movimentação Cielo":      float(tot["Movimentacao_Cielo"]),
+                "PIX Saída":               float(tot["Pix_Saida"]),
+                "Cheques Recebidos":       float(tot["Cheques_Recebidos"]),
+                "Pagamento de Prêmios":    float(tot["Pagamento_Premios"]),
+                "Vales/Despesas":          float(tot["Vales_Despesas"]),
+                "Retirada para Cofre":     float(tot["Retirada_Cofre"]),
+                "Total Compra Bolão":      float(tot["Total_Compra_Bolao"]),
+                "Retirada p/ Caixa Interno": float(tot["Retirada_CaixaInterno"]),
+                "Dinheiro em Gaveta":      float(tot["Dinheiro_Gaveta_Final"]),
             }
             df_saidas = pd.DataFrame(
                 [{"Categoria": k, "Total_R$": v} for k, v in saidas_dict.items()]
@@ -1319,20 +3394,55 @@ def render_gestao_loterica(spreadsheet):
             st.markdown("#### Produtos — Compras x Vendas x Margem")
             resumo = pd.DataFrame({
                 "Produto": ["Bolão","Raspadinha","Loteria Federal"],
-                "Compra_R$":[df_all["Total_Compra_Bolao"].sum(),
-                            df_all["Total_Compra_Raspadinha"].sum(),
-                            df_all["Total_Compra_LoteriaFederal"].sum()],
-                "Venda_R$":[df_all["Total_Venda_Bolao"].sum(),
-                            df_all["Total_Venda_Raspadinha"].sum(),
-                            df_all["Total_Venda_LoteriaFederal"].sum()],
+                "Compra_R$":[tot["Total_Compra_Bolao"],
+                            tot["Total_Compra_Raspadinha"],
+                            tot["Total_Compra_LoteriaFederal"]],
+                "Venda_R$":[tot["Total_Venda_Bolao"],
+                            tot["Total_Venda_Raspadinha"],
+                            tot["Total_Venda_LoteriaFederal"]],
             })
             resumo["Margem_R$"] = resumo["Venda_R$"] - resumo["Compra_R$"]
             st.dataframe(resumo, use_container_width=True)
 
-            # Download
-            st.download_button("⬇️ Baixar fechamentos (CSV)",
-                            data=df_all.to_csv(index=False).encode("utf-8"),
-                            file_name="fechamentos_periodo.csv", mime="text/csv")
+            # Download (gerado só no clique)
+            abas_sel = [sheet for pdv, sheet in FECH_PDV.items() if pdv_r in ("Todos", pdv)]
+            botao_exportacao("⬇️ Baixar fechamentos", "fechamentos_periodo",
+                             ("fechamentos", (pdv_r, ini, fim), ctx.versoes(abas_sel)),
+                             lambda: _linhas_periodo(rels, ini, fim), key="exp_fechamentos")
+
+        # Evolução de longo prazo — lida dos agregados (CuboFechamentos), não das linhas da aba
+        st.markdown("#### 📈 Evolução por período")
+        e1, e2 = st.columns(2)
+        with e1: gran_label = st.selectbox("Agrupar por", list(GRANULARIDADES_CUBO), index=2, key="rel_gran")
+        with e2: evo_ini = st.date_input("Desde", value=obter_date_brasilia() - timedelta(days=365), key="rel_evo_ini")
+        gran = GRANULARIDADES_CUBO[gran_label]
+        cubos = []
+        for pdv, sheet in FECH_PDV.items():
+            if pdv_r != "Todos" and pdv != pdv_r:
+                continue
+            try:
+                cubos.append(ctx.cubo_fechamentos(sheet, pdv))
+            except Exception as e:
+                st.warning(f"⚠️ Erro ao buscar {sheet}: {e}")
+        evo_prod, evo_caixa = CuboFechamentos.combinar(cubos, gran, evo_ini, obter_date_brasilia())
+
+        if evo_caixa.empty:
+            st.info("Sem fechamentos desde a data escolhida.")
+        else:
+            try:
+                import plotly.express as px
+                fig = px.line(evo_caixa, x="Periodo", y=["Vendas", "Compras", "Margem"], markers=True,
+                              title=f"Vendas x Compras x Margem ({gran_label.lower()})")
+                fig.update_layout(height=420, font=dict(family="Inter, sans-serif"))
+                st.plotly_chart(fig, use_container_width=True)
+            except Exception:
+                pass
+            evo_caixa = evo_caixa.assign(Periodo=evo_caixa["Periodo"].dt.date)
+            evo_prod = evo_prod.assign(Periodo=evo_prod["Periodo"].dt.date)
+            st.dataframe(evo_caixa.sort_values("Periodo", ascending=False), use_container_width=True)
+            with st.expander("Por produto"):
+                st.dataframe(evo_prod.sort_values(["Periodo", "Produto"], ascending=[False, True]),
+                             use_container_width=True)
 
 
     # ----------------- TAB 3 — CONFERÊNCIA DE FECHAMENTOS -----------------
@@ -1345,27 +3455,12 @@ def render_gestao_loterica(spreadsheet):
         with c2: conf_ini = st.date_input("Início", value=obter_date_brasilia() - timedelta(days=7), key="conf_ini")
         with c3: conf_fim = st.date_input("Fim", value=obter_date_brasilia(), key="conf_fim")
 
-        frames = []
-        for pdv, sheet in FECH_PDV.items():
-            if pdv_conf != "Todos" and pdv != pdv_conf: 
-                continue
-            try:
-                df = pd.DataFrame(buscar_dados(spreadsheet, sheet) or [])
-                if df.empty: 
-                    continue
-                df["Data_Fechamento"] = pd.to_datetime(df["Data_Fechamento"], errors="coerce").dt.date
-                df = df[(df["Data_Fechamento"] >= conf_ini) & (df["Data_Fechamento"] <= conf_fim)]
-                if df.empty: 
-                    continue
-                df["PDV"] = pdv
-                frames.append(df)
-            except Exception as e:
-                st.warning(f"⚠️ Erro ao buscar {sheet}: {e}")
+        rels = _relatorios(pdv_conf)
+        df_all = _linhas_periodo(rels, conf_ini, conf_fim)
 
-        if not frames:
+        if df_all.empty:
             st.info("Sem fechamentos no período selecionado.")
         else:
-            df_all = _normalize_fech(pd.concat(frames, ignore_index=True))
             df_all["Status"] = np.where(df_all["Delta_Enc_Calc"].abs() < 0.005, "OK", "Divergente")
             view_cols = [
                 "Data_Fechamento","PDV","Operador",
@@ -1378,7 +3473,9 @@ def render_gestao_loterica(spreadsheet):
                          use_container_width=True)
 
             try:
-                gdf = df_all.groupby("Data_Fechamento", as_index=False)["Delta_Enc_Calc"].sum()
+                gdf = (pd.concat([r.diario_periodo(conf_ini, conf_fim)["Delta_Enc_Calc"] for r in rels])
+                       .groupby(level=0).sum().rename_axis("Data_Fechamento").reset_index())
+                gdf["Data_Fechamento"] = gdf["Data_Fechamento"].dt.date
                 fig = px.bar(gdf, x="Data_Fechamento", y="Delta_Enc_Calc", text_auto=".2f",
                              title="Δ Encerrante por dia (soma)")
                 fig.update_layout(height=380, showlegend=False)
@@ -1389,6 +3486,13 @@ def render_gestao_loterica(spreadsheet):
     # ------------------- TAB 4 — SINCRONIZAÇÃO -------------------
     with tab4:
         st.markdown("#### 🔄 Sincronizar Estoque a partir dos Fechamentos")
+        fila = fila_sinc_estoque(spreadsheet)
+        st.caption(f"Fechamentos salvos entram no estoque automaticamente (em segundo plano). "
+                   f"Pendentes agora: {fila.pendentes()}.")
+        if fila.erros:
+            with st.expander(f"⚠️ {len(fila.erros)} falha(s) na sincronização automática"):
+                for erro in fila.erros:
+                    st.write(erro)
         s1, s2, s3 = st.columns(3)
         with s1: pdv_sinc = st.selectbox("PDV", list(FECH_PDV.keys()), key="sinc_pdv")
         with s2: ini_s = st.date_input("Início", value=obter_date_brasilia() - timedelta(days=7), key="sinc_ini")
@@ -1396,45 +3500,12 @@ def render_gestao_loterica(spreadsheet):
 
         if st.button("⚙️ Sincronizar estoque com base nos fechamentos", use_container_width=True):
             try:
-                sheet = FECH_PDV[pdv_sinc]
-                df = pd.DataFrame(buscar_dados(spreadsheet, sheet) or [])
-                if df.empty: 
-                    st.info("Nenhum fechamento encontrado."); 
-                    return
-                df["Data_Fechamento"] = pd.to_datetime(df["Data_Fechamento"], errors="coerce").dt.date
-                df = df[(df["Data_Fechamento"] >= ini_s) & (df["Data_Fechamento"] <= fim_s)]
-                if df.empty: 
-                    st.info("Sem fechamentos no período informado."); 
-                    return
-
-                df_mov_exist = _load_mov()
-                chaves_exist = set(df_mov_exist.get("Chave_Sync", []).tolist())
-
-                ws = get_or_create_worksheet(spreadsheet, SHEET_MOV, HEADERS_MOV)
-                add_count = 0
-                for _, row in df.iterrows():
-                    data = str(row.get("Data_Fechamento")); hora = obter_horario_brasilia()
-                    compras = [("Bolão", float(row.get("Qtd_Compra_Bolao",0)), float(row.get("Custo_Unit_Bolao",0))),
-                               ("Raspadinha", float(row.get("Qtd_Compra_Raspadinha",0)), float(row.get("Custo_Unit_Raspadinha",0))),
-                               ("Loteria Federal", float(row.get("Qtd_Compra_LoteriaFederal",0)), float(row.get("Custo_Unit_LoteriaFederal",0)))]
-                    vendas  = [("Bolão", float(row.get("Qtd_Venda_Bolao",0)), float(row.get("Preco_Unit_Bolao",0))),
-                               ("Raspadinha", float(row.get("Qtd_Venda_Raspadinha",0)), float(row.get("Preco_Unit_Raspadinha",0))),
-                               ("Loteria Federal", float(row.get("Qtd_Venda_LoteriaFederal",0)), float(row.get("Preco_Unit_LoteriaFederal",0)))]
-                    for prod,qtd,vu in compras:
-                        if qtd>0:
-                            chave=f"{data}|{pdv_sinc}|{prod}|ENT|{qtd}|{vu}"
-                            if chave not in chaves_exist:
-                                ws.append_row([data,hora,pdv_sinc,prod,"Entrada",qtd,vu,qtd*vu,"sync-fech",sheet,chave])
-                                chaves_exist.add(chave); add_count+=1
-                    for prod,qtd,vu in vendas:
-                        if qtd>0:
-                            chave=f"{data}|{pdv_sinc}|{prod}|SAI|{qtd}|{vu}"
-                            if chave not in chaves_exist:
-                                ws.append_row([data,hora,pdv_sinc,prod,"Venda",qtd,vu,qtd*vu,"sync-fech",sheet,chave])
-                                chaves_exist.add(chave); add_count+=1
-
-                st.success(f"✅ Sincronização concluída: {add_count} movimentos incluídos.")
-                st.cache_data.clear()
+                qtd_fech, add_count, _ = sincronizar_estoque_fechamentos(
+                    spreadsheet, pdv_sinc, FECH_PDV[pdv_sinc], ini_s, fim_s)
+                if not qtd_fech:
+                    st.info("Sem fechamentos no período informado.")
+                else:
+                    st.success(f"✅ Sincronização concluída: {add_count} movimentos incluídos.")
             except Exception as e:
                 st.error(f"❌ Erro na sincronização: {e}")
 
@@ -1468,8 +3539,7 @@ def render_gestao_loterica(spreadsheet):
         # automáticos do dia
         ret_caixa_interno, _ = _get_sangrias_do_dia(pdv_ed, data_sel)
         supr_cofre_dia, _  = _get_suprimentos_cofre_do_dia(pdv_ed, data_sel)
-        saldo_ant_recalc    = _get_saldo_anterior(pdv_ed, data_sel)
-        troco_anterior      = _get_troco_anterior(pdv_ed, data_sel)
+        saldo_ant_recalc, troco_anterior = _get_anteriores(pdv_ed, data_sel)
 
         with st.form("form_editar_fechamento", clear_on_submit=False):
             st.markdown("##### Dados do registro")
@@ -1616,6 +3686,7 @@ def render_gestao_loterica(spreadsheet):
         row_idx = _find_row_by_pdv_date(ws_pdv, pdv_ed, data_sel)
 
         if salvar:
+            row_idx = _confirmar_linha(ws_pdv, row_idx, pdv_ed, data_sel)
             if row_idx is None:
                 st.error("Não foi possível localizar a linha no Sheets para atualizar.")
             else:
@@ -1634,20 +3705,22 @@ def render_gestao_loterica(spreadsheet):
                         float(encerrante_relatorio), float(cheques_recebidos), float(supr_cofre_dia), float(troco_anterior), float(delta_enc)
                     ]
                     ws_pdv.update(f"A{row_idx}", [row])
+                    fila_sinc_estoque(spreadsheet).agendar(pdv_ed, _sheet_for_pdv(pdv_ed), data_sel)
                     st.success("✅ Fechamento atualizado com sucesso.")
-                    st.cache_data.clear()
                 except Exception as e:
                     st.error(f"❌ Erro ao atualizar: {e}")
 
         if excluir:
             if st.checkbox("Confirmo que desejo remover este fechamento definitivamente."):
+                row_idx = _confirmar_linha(ws_pdv, row_idx, pdv_ed, data_sel)
                 if row_idx is None:
                     st.error("Não foi possível localizar a linha no Sheets para remover.")
                 else:
                     try:
                         ws_pdv.delete_rows(row_idx)
+                        fila_sinc_estoque(spreadsheet).agendar(pdv_ed, _sheet_for_pdv(pdv_ed), data_sel)
                         st.success("✅ Fechamento removido.")
-                        st.cache_data.clear(); st.experimental_rerun()
+                        st.rerun()
                     except Exception as e:
                         st.error(f"❌ Erro ao remover: {e}")
             else:
@@ -1661,10 +3734,32 @@ def render_gestao_loterica(spreadsheet):
 def render_operacoes_caixa(spreadsheet):
     import pandas as pd
     from datetime import timedelta
-    from uuid import uuid4
     from decimal import Decimal
 
     st.subheader("💳 Operações do Caixa Interno")
+
+    # operações confirmadas ao operador que o DiarioGravacoes ainda está enviando à planilha
+    diario = diario_gravacoes(spreadsheet)
+    n_pendentes = diario.pendentes()
+    if n_pendentes:
+        st.caption(f"⏳ {n_pendentes} operação(ões) registrada(s) aguardando envio à planilha.")
+        erros_envio = diario.erros()
+        if erros_envio:
+            with st.expander("⚠️ Falhas no envio (serão repetidas automaticamente)"):
+                for id_operacao, tentativas, erro in erros_envio:
+                    st.write(f"{id_operacao} — {tentativas} tentativa(s): {erro}")
+    mortas = diario.mortas()
+    if mortas:
+        with st.expander(f"🛑 {len(mortas)} operação(ões) não enviada(s) — decida reenviar ou descartar", expanded=True):
+            for id_operacao, registrado_em, tentativas, erro in mortas:
+                c1, c2, c3 = st.columns([4, 1, 1])
+                c1.write(f"**{id_operacao}** ({registrado_em}) — {tentativas} tentativa(s): {erro}")
+                if c2.button("🔁 Reenviar", key=f"diario_reenviar_{id_operacao}"):
+                    diario.reenviar(id_operacao)
+                    st.rerun()
+                if c3.button("🗑️ Descartar", key=f"diario_descartar_{id_operacao}"):
+                    diario.descartar(id_operacao)
+                    st.rerun()
     
     PDV_UI_TO_CODE = {
         "Pdv1 - terminal 051650 - bruna": "PDV 1",
@@ -1672,15 +3767,12 @@ def render_operacoes_caixa(spreadsheet):
     }
 
     ABA_CAIXA = "Operacoes_Caixa"
-    HEADERS_CAIXA = ["Data","Hora","Operador","Tipo_Operacao","Cliente","CPF","Valor_Bruto","Taxa_Cliente","Taxa_Banco","Valor_Liquido","Lucro","Status","Data_Vencimento_Cheque","Taxa_Percentual","Observacoes"]
     ABA_MOV_PDV = "Movimentacoes_PDV"
-    HEADERS_MOV_PDV = ["Data","Hora","PDV","Tipo_Mov","Valor","Vinculo_ID","Operador","Observacoes"]
     ABA_COFRE = "Operacoes_Cofre"
-    HEADERS_COFRE = ["Data","Hora","Operador","Tipo","Categoria","Origem","Destino","Valor","Observacoes","Status","Vinculo_ID"]
 
     # --------- helpers ---------
     def _gerar_vinc(prefix="CXINT"):
-        return f"{prefix}-{uuid4().hex[:8]}"
+        return novo_vinculo(spreadsheet, prefix, diario)
 
     def _to_float(x):
         try:
@@ -1694,49 +3786,47 @@ def render_operacoes_caixa(spreadsheet):
         basef = _to_float(base)
         return 0.0 if basef == 0 else (_to_float(taxa) / basef) * 100.0
 
-    def _try_registrar_no_fechamento_ret_caixa_interno(data_mov, pdv_code, valor, vinculo_id, obs):
-        ws_name = "Fechamentos_PDV1" if pdv_code == "PDV 1" else "Fechamentos_PDV2"
-        try:
-            dados = buscar_dados(spreadsheet, ws_name) or []
-        except Exception:
-            dados = None
-
-        if dados:
-            df = pd.DataFrame(dados)
-            if not df.empty:
-                cols = list(df.columns)
-                low  = {c: c.lower() for c in cols}
-                col_data = next((c for c in cols if "data" in low[c]), None)
-                col_pdv  = next((c for c in cols if "pdv"  in low[c]), None)
-                if "Retirada_CaixaInterno" in cols:
-                    col_ret_int = "Retirada_CaixaInterno"
-                else:
-                    col_ret_int = next((c for c in cols if "retirada" in low[c] and "interno" in low[c]), None)
-
-                if col_data and col_pdv and col_ret_int:
-                    ws = get_or_create_worksheet(spreadsheet, ws_name, cols)
-                    nova = {c: "" for c in cols}
-                    nova[col_data]    = str(data_mov)
-                    nova[col_pdv]     = pdv_code
-                    nova[col_ret_int] = _to_float(valor)
-
-                    col_vinc = next((c for c in cols if "vinculo" in low[c]), None)
-                    if col_vinc: nova[col_vinc] = vinculo_id
-                    col_obs  = next((c for c in cols if "observ" in low[c]), None)
-                    if col_obs:  nova[col_obs]  = f"PDV → Caixa Interno. {obs or ''}"
-
-                    ws.append_row([nova.get(c, "") for c in cols])
-                    return True
+    def _try_registrar_no_fechamento_ret_caixa_interno(tx, data_mov, pdv_code, valor, vinculo_id, obs):
+        """Lança a retirada p/ o Caixa Interno na aba de fechamentos do PDV.
 
-        ws_fb = get_or_create_worksheet(
-            spreadsheet,
+        Não lê a planilha (a gravação fica para o DiarioGravacoes): as colunas vêm da versão da
+        aba já em cache, ou de HEADERS_FECHAMENTO_PDV se ela ainda não foi carregada.
+        A linha leva o Vinculo_ID (a aba ganha a coluna no fim se ainda não tiver), para que
+        reenviar a operação não a duplique. Sem colunas de data/PDV/retirada, vai para
+        'Fechamento_PDV_Lancamentos'.
+        """
+        ws_name = "Fechamentos_PDV1" if pdv_code == "PDV 1" else "Fechamentos_PDV2"
+        est = _sincronizador(spreadsheet).em_cache(ws_name)
+        cols = list(est.cabecalho) if est is not None and est.cabecalho else list(HEADERS_FECHAMENTO_PDV)
+        low  = {c: c.lower() for c in cols}
+        col_data = next((c for c in cols if "data" in low[c]), None)
+        col_pdv  = next((c for c in cols if "pdv"  in low[c]), None)
+        if "Retirada_CaixaInterno" in cols:
+            col_ret_int = "Retirada_CaixaInterno"
+        else:
+            col_ret_int = next((c for c in cols if "retirada" in low[c] and "interno" in low[c]), None)
+
+        if col_data and col_pdv and col_ret_int:
+            if "Vinculo_ID" not in cols:
+                cols.append("Vinculo_ID")
+            nova = {c: "" for c in cols}
+            nova[col_data]     = str(data_mov)
+            nova[col_pdv]      = pdv_code
+            nova[col_ret_int]  = _to_float(valor)
+            nova["Vinculo_ID"] = vinculo_id
+            col_obs = next((c for c in cols if "observ" in low.get(c, "")), None)
+            if col_obs: nova[col_obs] = f"PDV → Caixa Interno. {obs or ''}"
+
+            tx.adicionar(ws_name, cols, [nova[c] for c in cols], vinculo_id=vinculo_id)
+            return True
+
+        tx.adicionar(
             "Fechamento_PDV_Lancamentos",
-            ["Data","PDV","Tipo","Valor","Vinculo_ID","Observacoes"]
+            ["Data","PDV","Tipo","Valor","Vinculo_ID","Observacoes"],
+            [str(data_mov), pdv_code, "Retirada Caixa Interno",
+             _to_float(valor), vinculo_id, f"PDV → Caixa Interno. {obs or ''}"],
+            vinculo_id=vinculo_id
         )
-        ws_fb.append_row([
-            str(data_mov), pdv_code, "Retirada Caixa Interno",
-            _to_float(valor), vinculo_id, f"PDV → Caixa Interno. {obs or ''}"
-        ])
         return False
 
     try:
@@ -1812,17 +3902,18 @@ def render_operacoes_caixa(spreadsheet):
                             st.error("❌ Faça a simulação antes de confirmar!")
                         else:
                             sim = st.session_state.simulacao_atual
-                            ws = get_or_create_worksheet(spreadsheet, ABA_CAIXA, HEADERS_CAIXA)
-                            ws.append_row([
+                            vinculo_id = _gerar_vinc()
+                            tx = TransacaoPlanilhas(spreadsheet)
+                            tx.adicionar(ABA_CAIXA, HEADERS_CAIXA, [
                                 obter_data_brasilia(), obter_horario_brasilia(), operador_selecionado,
                                 sim["tipo"], sim["nome"], sim["cpf"], _to_float(sim["valor_bruto"]),
                                 _to_float(sim["dados"]["taxa_cliente"]), _to_float(sim["dados"]["taxa_banco"]), _to_float(sim["dados"]["valor_liquido"]),
                                 _to_float(sim["dados"]["lucro"]), "Concluído", "", f"{_pct(sim['dados']['taxa_cliente'], sim['valor_bruto']):.2f}%",
-                                sim["observacoes"]
-                            ])
+                                sim["observacoes"], NORMALIZADO_SIM, "", vinculo_id
+                            ], vinculo_id=vinculo_id)
+                            diario_gravacoes(spreadsheet).registrar(vinculo_id, tx)
                             st.success(f"✅ {sim['tipo']} de R$ {sim['valor_bruto']:,.2f} registrado!")
                             del st.session_state.simulacao_atual
-                            st.cache_data.clear()
                     except Exception as e:
                         st.error(f"❌ Erro ao salvar operação: {str(e)}")
 
@@ -1845,17 +3936,7 @@ def render_operacoes_caixa(spreadsheet):
 
                 if simular_pix and valor_pix > 0:
                     try:
-                        taxa_cliente = _to_float(valor_pix) * 0.01  # 1% cobrado do cliente
-                        taxa_banco = 0.0                           # custo para empresa = 0%
-                        lucro = taxa_cliente - taxa_banco
-                        valor_liquido = _to_float(valor_pix) - taxa_cliente
-
-                        calc_pix = {
-                            "taxa_cliente": taxa_cliente,
-                            "taxa_banco": taxa_banco,
-                            "lucro": lucro,
-                            "valor_liquido": valor_liquido
-                        }
+                        calc_pix = calcular_taxa_saque_pix(valor_pix)  # 1% cliente, custo banco 0%
 
                         st.markdown("---")
                         st.markdown("### ✅ Simulação - Saque PIX")
@@ -1887,17 +3968,18 @@ def render_operacoes_caixa(spreadsheet):
                             st.error("❌ Faça a simulação antes de confirmar!")
                         else:
                             sim = st.session_state.simulacao_pix
-                            ws = get_or_create_worksheet(spreadsheet, ABA_CAIXA, HEADERS_CAIXA)
-                            ws.append_row([
+                            vinculo_id = _gerar_vinc()
+                            tx = TransacaoPlanilhas(spreadsheet)
+                            tx.adicionar(ABA_CAIXA, HEADERS_CAIXA, [
                                 obter_data_brasilia(), obter_horario_brasilia(), operador_pix,
                                 sim["tipo"], sim["nome"], sim["cpf"], _to_float(sim["valor_bruto"]),
                                 _to_float(sim["dados"]["taxa_cliente"]), _to_float(sim["dados"]["taxa_banco"]), _to_float(sim["dados"]["valor_liquido"]),
                                 _to_float(sim["dados"]["lucro"]), "Concluído", "", f"{_pct(sim['dados']['taxa_cliente'], sim['valor_bruto']):.2f}%",
-                                sim["observacoes"]
-                            ])
+                                sim["observacoes"], NORMALIZADO_SIM, "", vinculo_id
+                            ], vinculo_id=vinculo_id)
+                            diario_gravacoes(spreadsheet).registrar(vinculo_id, tx)
                             st.success(f"✅ {sim['tipo']} de R$ {sim['valor_bruto']:,.2f} registrado!")
                             del st.session_state.simulacao_pix
-                            st.cache_data.clear()
                     except Exception as e:
                         st.error(f"❌ Erro ao salvar operação: {str(e)}")
         
@@ -1955,17 +4037,19 @@ def render_operacoes_caixa(spreadsheet):
                             st.error("❌ Faça a simulação antes de confirmar!")
                         else:
                             sim = st.session_state.simulacao_atual
-                            ws = get_or_create_worksheet(spreadsheet, ABA_CAIXA, HEADERS_CAIXA)
-                            ws.append_row([
+                            vinculo_id = _gerar_vinc()
+                            tx = TransacaoPlanilhas(spreadsheet)
+                            tx.adicionar(ABA_CAIXA, HEADERS_CAIXA, [
                                 obter_data_brasilia(), obter_horario_brasilia(), operador_selecionado_cheque,
                                 sim["tipo"], sim["nome"], sim["cpf"], _to_float(sim["valor_bruto"]),
                                 _to_float(sim["dados"]["taxa_cliente"]), _to_float(sim["dados"]["taxa_banco"]), _to_float(sim["dados"]["valor_liquido"]),
                                 _to_float(sim["dados"]["lucro"]), "Concluído", sim["data_vencimento"],
-                                f"{_pct(sim['dados']['taxa_cliente'], sim['valor_bruto']):.2f}%", sim["observacoes"]
-                            ])
+                                f"{_pct(sim['dados']['taxa_cliente'], sim['valor_bruto']):.2f}%", sim["observacoes"],
+                                NORMALIZADO_SIM, "", vinculo_id
+                            ], vinculo_id=vinculo_id)
+                            diario_gravacoes(spreadsheet).registrar(vinculo_id, tx)
                             st.success(f"✅ {sim['tipo']} de R$ {sim['valor_bruto']:,.2f} registrado!")
                             del st.session_state.simulacao_atual
-                            st.cache_data.clear()
                     except Exception as e:
                         st.error(f"❌ Erro ao salvar operação: {str(e)}")
         
@@ -1986,60 +4070,46 @@ def render_operacoes_caixa(spreadsheet):
 
                 if st.form_submit_button("💰 Registrar Suprimento", use_container_width=True):
                     try:
-                        ws_cx = get_or_create_worksheet(spreadsheet, ABA_CAIXA, HEADERS_CAIXA)
+                        tx = TransacaoPlanilhas(spreadsheet)
                         data_mov = obter_data_brasilia()
                         hora_mov = obter_horario_brasilia()
                         vinculo_id = _gerar_vinc("CXINT_SUPR")
 
                         # 1) Lança no Caixa Interno
-                        ws_cx.append_row([
+                        tx.adicionar(ABA_CAIXA, HEADERS_CAIXA, [
                             data_mov, hora_mov, operador_selecionado_suprimento,
                             "Suprimento", "Sistema", "N/A",
                             _to_float(valor_suprimento), 0, 0, _to_float(valor_suprimento), 0,
                             "Concluído", "", "0.00%",
-                            f"Origem: {origem_normalizada}. Vínculo {vinculo_id}. {observacoes_sup or ''}"
-                        ])
+                            f"Origem: {origem_normalizada}. Vínculo {vinculo_id}. {observacoes_sup or ''}",
+                            NORMALIZADO_SIM, "", vinculo_id
+                        ], vinculo_id=vinculo_id)
 
                         # 2) SE a origem for COFRE PRINCIPAL -> espelha no COFRE como SAÍDA (Transferência p/ Caixa Interno)
                         if origem_suprimento_ui == "Cofre Principal":
-                            ws_cofre = get_or_create_worksheet(spreadsheet, ABA_COFRE, HEADERS_COFRE)
-                            try:
-                                exist = buscar_dados(spreadsheet, ABA_COFRE) or []
-                                df_exist = pd.DataFrame(exist)
-                                dup = (not df_exist.empty and "Vinculo_ID" in df_exist.columns
-                                       and df_exist["Vinculo_ID"].astype(str).eq(vinculo_id).any())
-                            except Exception:
-                                dup = False
-                            if not dup:
-                                ws_cofre.append_row([
-                                    str(data_mov), str(hora_mov), st.session_state.get("nome_usuario",""),
-                                    "Saída", "Transferência para Caixa Interno", "Cofre Principal", "Caixa Interno",
-                                    _to_float(valor_suprimento),
-                                    f"Gerado por Suprimento do Caixa Interno. Vínculo {vinculo_id}. {observacoes_sup or ''}",
-                                    "Concluído", vinculo_id
-                                ])
+                            tx.adicionar(ABA_COFRE, HEADERS_COFRE, [
+                                str(data_mov), str(hora_mov), st.session_state.get("nome_usuario",""),
+                                "Saída", "Transferência para Caixa Interno", "Cofre Principal", "Caixa Interno",
+                                _to_float(valor_suprimento),
+                                f"Gerado por Suprimento do Caixa Interno. Vínculo {vinculo_id}. {observacoes_sup or ''}",
+                                "Concluído", vinculo_id
+                            ], vinculo_id=vinculo_id)
 
                         # 3) SE a origem for PDV -> já havia integração PDV + Fechamento
                         if pdv_code_origem in ["PDV 1","PDV 2"]:
-                            ws_mov = get_or_create_worksheet(spreadsheet, ABA_MOV_PDV, HEADERS_MOV_PDV)
-                            mov_exist = buscar_dados(spreadsheet, ABA_MOV_PDV) or []
-                            df_mov = pd.DataFrame(mov_exist)
-                            ja_existe = (not df_mov.empty and "Vinculo_ID" in df_mov.columns
-                                         and df_mov["Vinculo_ID"].astype(str).eq(vinculo_id).any())
-                            if not ja_existe:
-                                ws_mov.append_row([
-                                    str(data_mov), str(hora_mov),
-                                    pdv_code_origem, "Saída p/ Caixa Interno",
-                                    _to_float(valor_suprimento), vinculo_id,
-                                    st.session_state.get("nome_usuario",""),
-                                    f"Gerado por suprimento do Caixa Interno. {observacoes_sup or ''}"
-                                ])
+                            tx.adicionar(ABA_MOV_PDV, HEADERS_MOV_PDV, [
+                                str(data_mov), str(hora_mov),
+                                pdv_code_origem, "Saída p/ Caixa Interno",
+                                _to_float(valor_suprimento), vinculo_id,
+                                st.session_state.get("nome_usuario",""),
+                                f"Gerado por suprimento do Caixa Interno. {observacoes_sup or ''}"
+                            ], vinculo_id=vinculo_id)
                             _try_registrar_no_fechamento_ret_caixa_interno(
-                                data_mov, pdv_code_origem, valor_suprimento, vinculo_id, observacoes_sup
+                                tx, data_mov, pdv_code_origem, valor_suprimento, vinculo_id, observacoes_sup
                             )
 
+                        diario_gravacoes(spreadsheet).registrar(vinculo_id, tx)
                         st.success(f"✅ Suprimento de R$ {valor_suprimento:,.2f} registrado com sucesso!")
-                        st.cache_data.clear()
 
                     except Exception as e:
                         st.error(f"❌ Erro ao registrar suprimento: {str(e)}")
@@ -2061,35 +4131,37 @@ def render_operacoes_caixa(spreadsheet):
                 with col_filtro2:
                     # 👇 NOVO: inclui Saque PIX no filtro
                     tipo_operacao_filtro = st.selectbox("Tipo de Operação", ["Todos", "Saque Cartão Débito", "Saque Cartão Crédito", "Saque PIX", "Troca Cheque à Vista", "Troca Cheque Pré-datado", "Suprimento"])
-                operacoes_data = buscar_dados(spreadsheet, ABA_CAIXA)
-                if operacoes_data:
-                    df_operacoes = pd.DataFrame(normalizar_dados_inteligente(operacoes_data))
-                    if tipo_operacao_filtro != "Todos":
-                        df_operacoes = df_operacoes[df_operacoes["Tipo_Operacao"] == tipo_operacao_filtro]
-                    if st.session_state.get("mostrar_filtro_data", False):
-                        try:
-                            df_operacoes["Data"] = pd.to_datetime(df_operacoes["Data"], errors="coerce")
-                            df_operacoes = df_operacoes[(df_operacoes["Data"] >= pd.to_datetime(data_inicio)) & (df_operacoes["Data"] <= pd.to_datetime(data_fim))]
-                        except Exception:
-                            st.warning("⚠️ Erro ao aplicar filtro de data.")
-                    if not df_operacoes.empty:
-                        try:
-                            if {"Data","Hora"}.issubset(df_operacoes.columns):
-                                df_operacoes = df_operacoes.sort_values(by=["Data","Hora"], ascending=False)
-                        except Exception:
-                            pass
+                # filtros e totais resolvidos no histórico em cache; só a página vai para a tela
+                ctx = ContextoDados(spreadsheet)
+                consulta = ctx.historico_caixa()
+                if consulta.df.empty:
+                    st.info("Nenhuma operação registrada ainda.")
+                else:
+                    periodo = (data_inicio, data_fim) if st.session_state.get("mostrar_filtro_data", False) else (None, None)
+                    tipo = None if tipo_operacao_filtro == "Todos" else tipo_operacao_filtro
+                    _, n_operacoes, somas = consulta.consultar(*periodo, tipo=tipo, pagina=1, por_pagina=0)
+                    if n_operacoes:
+                        n_paginas = -(-n_operacoes // ConsultaHistorico.POR_PAGINA)
+                        with col_filtro3:
+                            pagina = st.number_input("Página", min_value=1, max_value=n_paginas, value=1, step=1,
+                                                     key="hist_caixa_pagina")
+                        df_operacoes, _, _ = consulta.consultar(*periodo, tipo=tipo, pagina=pagina)
+                        df_operacoes = _com_data(df_operacoes)
                         st.dataframe(df_operacoes, use_container_width=True)
+                        st.caption(f"Página {pagina} de {n_paginas} — {n_operacoes} operações no filtro.")
+                        botao_exportacao("⬇️ Baixar histórico", "historico_caixa_interno",
+                                         ("historico_caixa", (periodo, tipo), ctx.versoes([ABA_CAIXA])),
+                                         lambda: _com_data(consulta.linhas(*periodo, tipo=tipo)),
+                                         key="exp_hist_caixa")
                         st.markdown("---"); st.markdown("### 📈 Estatísticas do Período")
                         c1,c2,c3 = st.columns(3)
-                        with c1: st.metric("Total de Operações", len(df_operacoes))
+                        with c1: st.metric("Total de Operações", n_operacoes)
                         with c2:
-                            if "Valor_Bruto" in df_operacoes.columns: st.metric("Total Movimentado", f"R$ {df_operacoes['Valor_Bruto'].sum():,.2f}")
+                            if "Valor_Bruto" in somas: st.metric("Total Movimentado", f"R$ {somas['Valor_Bruto']:,.2f}")
                         with c3:
-                            if "Taxa_Cliente" in df_operacoes.columns: st.metric("Total em Taxas", f"R$ {df_operacoes['Taxa_Cliente'].sum():,.2f}")
+                            if "Taxa_Cliente" in somas: st.metric("Total em Taxas", f"R$ {somas['Taxa_Cliente']:,.2f}")
                     else:
                         st.info("Nenhuma operação encontrada com os filtros aplicados.")
-                else:
-                    st.info("Nenhuma operação registrada ainda.")
             except Exception as e:
                 st.error(f"❌ Erro ao carregar histórico: {str(e)}")
     
@@ -2112,57 +4184,22 @@ def render_dashboard_caixa(spreadsheet):
     is_gerente = "gerente" in str(st.session_state.get("tipo_usuario", "")).lower()
 
     # 1) Buscar e normalizar dados de operações
-    operacoes_data = buscar_dados(spreadsheet, "Operacoes_Caixa") or []
-    operacoes_data_normalizada = normalizar_dados_inteligente(operacoes_data)
-    df_operacoes = pd.DataFrame(operacoes_data_normalizada)
-
-    # Tipagem defensiva
-    if not df_operacoes.empty:
-        for col in ["Valor_Bruto", "Taxa_Cliente", "Taxa_Banco", "Valor_Liquido", "Lucro"]:
-            if col in df_operacoes.columns:
-                df_operacoes[col] = pd.to_numeric(df_operacoes[col], errors="coerce").fillna(0.0)
-        try:
-            df_operacoes["Data"] = pd.to_datetime(df_operacoes["Data"], errors="coerce").dt.date
-        except Exception:
-            pass
+    df_operacoes = normalizar_frame(carregar_tabela(spreadsheet, "Operacoes_Caixa"))
 
     # ================== CÁLCULO NOVO DO SALDO ==================
-    # 👇 Inclui Saque PIX nas saídas
-    TIPOS_SAQUE  = ["Saque Cartão Débito", "Saque Cartão Crédito", "Saque PIX"]
-    TIPOS_CHEQUE = ["Cheque à Vista", "Cheque Pré-datado", "Cheque com Taxa Manual"]
-
-    # 1) Saldo do dia anterior (último fechamento <= ontem)
-    saldo_anterior = 0.0
+    # Saldo do último fechamento <= ontem + suprimentos de hoje - saques (cartão e PIX) e cheques,
+    # tudo do resumo diário do Caixa Interno (sem reagregar a Operacoes_Caixa)
+    hoje_dt = obter_date_brasilia()
     try:
-        fech_data = buscar_dados(spreadsheet, "Fechamento_Diario_Caixa_Interno") or []
-        if fech_data:
-            df_fech = pd.DataFrame(fech_data)
-            df_fech["Data_Fechamento"] = pd.to_datetime(df_fech["Data_Fechamento"], errors="coerce").dt.date
-            df_fech["Saldo_Calculado_Dia"] = pd.to_numeric(df_fech.get("Saldo_Calculado_Dia", 0), errors="coerce").fillna(0.0)
-
-            hoje_dt  = obter_date_brasilia()
-            ontem_dt = hoje_dt - timedelta(days=1)
-
-            prev = df_fech[df_fech["Data_Fechamento"] <= ontem_dt].sort_values("Data_Fechamento").tail(1)
-            if not prev.empty:
-                saldo_anterior = float(prev.iloc[0]["Saldo_Calculado_Dia"])
+        hoje = caixa_interno_do_dia(ContextoDados(spreadsheet), hoje_dt)
     except Exception:
-        pass  # se der erro, mantém 0.0
-
-    # 2) Somente operações de HOJE
-    hoje_dt = obter_date_brasilia()
-    ops_hoje = df_operacoes[df_operacoes["Data"] == hoje_dt] if not df_operacoes.empty else pd.DataFrame()
+        hoje = {"saldo": 0.0, "operacoes": 0, "saques_cartao": 0.0, "saques_pix": 0.0, "cheques": 0.0}
 
-    suprimentos_hoje = ops_hoje[ops_hoje["Tipo_Operacao"] == "Suprimento"]["Valor_Bruto"].sum() if not ops_hoje.empty else 0.0
-    saques_hoje      = ops_hoje[ops_hoje["Tipo_Operacao"].isin(TIPOS_SAQUE)]["Valor_Liquido"].sum() if not ops_hoje.empty else 0.0
-    cheques_hoje     = ops_hoje[ops_hoje["Tipo_Operacao"].isin(TIPOS_CHEQUE)]["Valor_Liquido"].sum() if not ops_hoje.empty else 0.0
-
-    # 3) Saldo final do card
-    saldo_caixa = float(saldo_anterior + suprimentos_hoje - (saques_hoje + cheques_hoje))
+    saldo_caixa = float(hoje["saldo"])
 
     # Métricas auxiliares para os cards
-    operacoes_hoje_count = int(len(ops_hoje))
-    valor_saque_hoje = float(sakes if (sakes := saques_hoje + cheques_hoje) else 0.0)  # saída total do dia
+    operacoes_hoje_count = int(hoje["operacoes"])
+    valor_saque_hoje = float(hoje["saques_cartao"] + hoje["saques_pix"] + hoje["cheques"])  # saída total do dia
     # ============================================================
 
     # ----------------- CARDS DE MÉTRICAS -----------------
@@ -2224,13 +4261,12 @@ def render_dashboard_caixa(spreadsheet):
                 st.info("📊 Nenhuma operação nos últimos 7 dias para exibir no gráfico.")
             else:
                 data_limite = obter_date_brasilia() - timedelta(days=7)
-                df_recente = df_operacoes.copy()
-                df_recente = df_recente[df_recente["Data"] >= data_limite]
+                df_recente = df_operacoes.loc[df_operacoes["Data"].dt.date >= data_limite]
 
                 if df_recente.empty:
                     st.info("📊 Nenhuma operação nos últimos 7 dias para exibir no gráfico.")
                 else:
-                    resumo_por_tipo = df_recente.groupby("Tipo_Operacao")["Valor_Liquido"].sum().reset_index()
+                    resumo_por_tipo = df_recente.groupby("Tipo_Operacao", observed=True)["Valor_Liquido"].sum().reset_index()
                     fig = px.bar(
                         resumo_por_tipo,
                         x="Tipo_Operacao",
@@ -2277,7 +4313,6 @@ def render_dashboard_caixa(spreadsheet):
 def render_cofre(spreadsheet):
     import pandas as pd
     from decimal import Decimal
-    from uuid import uuid4
     from datetime import date as _date
 
     st.subheader("🏦 Gestão do Cofre")
@@ -2294,29 +4329,14 @@ def render_cofre(spreadsheet):
     ABA_MOV_PDV       = "Movimentacoes_PDV"
     ABA_CAIXA_INTERNO = "Operacoes_Caixa"
 
-    HEADERS_COFRE = [
-        "Data","Hora","Operador","Tipo","Categoria","Origem","Destino",
-        "Valor","Observacoes","Status","Vinculo_ID"
-    ]
-    HEADERS_MOV_PDV = [
-        "Data","Hora","PDV","Tipo_Mov","Valor","Vinculo_ID","Operador","Observacoes"
-    ]
-    HEADERS_CAIXA = [
-        "Data","Hora","Operador","Tipo_Operacao","Cliente","CPF",
-        "Valor_Bruto","Taxa_Cliente","Taxa_Banco","Valor_Liquido","Lucro",
-        "Status","Data_Vencimento_Cheque","Taxa_Percentual","Observacoes"
-    ]
-
-    def _gerar_id(prefix="COFRE"):
-        return f"{prefix}-{uuid4().hex[:8]}"
-
     # ---- Registrar também no Fechamento diário do PDV (silencioso) ----
-    def _try_registrar_no_fechamento_pdv(data_mov, pdv_code, tipo_mov_pdv, valor, vinculo_id, obs):
+    def _try_registrar_no_fechamento_pdv(tx, data_mov, pdv_code, tipo_mov_pdv, valor, vinculo_id, obs):
         """
         tipo_mov_pdv: "Suprimento" (Cofre -> PDV) ou "Sangria" (PDV -> Cofre)
         Abre somente a planilha do PDV (Fechamentos_PDV1/Fechamentos_PDV2).
         Escreve nas colunas corretas: Suprimento_Cofre ou Retirada_Cofre.
         Fallback: 'Fechamento_PDV_Lancamentos' (sem warnings).
+        A linha entra na transação `tx`; quem chama faz o confirmar().
         """
         ws_name = "Fechamentos_PDV1" if pdv_code == "PDV 1" else "Fechamentos_PDV2"
 
@@ -2343,7 +4363,6 @@ def render_cofre(spreadsheet):
                              next((c for c in cols if "retirada" in low[c] and "cofre" in low[c]), None)
 
                 if col_data and col_pdv and target:
-                    ws = get_or_create_worksheet(spreadsheet, ws_name, cols)
                     nova = {c: "" for c in cols}
                     nova[col_data] = str(data_mov)
                     nova[col_pdv]  = pdv_code
@@ -2354,52 +4373,24 @@ def render_cofre(spreadsheet):
                     col_obs  = next((c for c in cols if "observ" in low[c]), None)
                     if col_obs:  nova[col_obs]  = f"Gerado via Cofre ({tipo_mov_pdv}). {obs or ''}"
 
-                    ws.append_row([nova.get(c, "") for c in cols])
+                    tx.adicionar(ws_name, cols, [nova.get(c, "") for c in cols],
+                                 vinculo_id=vinculo_id if col_vinc else None)
                     return True
 
         # Fallback silencioso (auditoria)
-        ws_fb = get_or_create_worksheet(
-            spreadsheet,
+        tx.adicionar(
             "Fechamento_PDV_Lancamentos",
-            ["Data","PDV","Tipo","Valor","Vinculo_ID","Observacoes"]
+            ["Data","PDV","Tipo","Valor","Vinculo_ID","Observacoes"],
+            [str(data_mov), pdv_code, tipo_mov_pdv,
+             float(valor), vinculo_id, f"Gerado via Cofre. {obs or ''}"],
+            vinculo_id=vinculo_id
         )
-        ws_fb.append_row([
-            str(data_mov), pdv_code, tipo_mov_pdv,
-            float(valor), vinculo_id, f"Gerado via Cofre. {obs or ''}"
-        ])
         return False
 
     # ---- Saldo do Cofre ----
+    # Entradas - Saídas do cofre + sangrias - suprimentos da Mov_PDV sem vínculo no cofre
     try:
-        cofre_data = buscar_dados(spreadsheet, ABA_COFRE) or []
-        df_cofre = pd.DataFrame(cofre_data)
-
-        saldo_cofre = Decimal("0")
-        entradas = Decimal("0")
-        saidas   = Decimal("0")
-
-        if not df_cofre.empty and "Valor" in df_cofre.columns:
-            df_cofre["Valor"] = pd.to_numeric(df_cofre["Valor"], errors="coerce").fillna(0.0)
-            if "Tipo" in df_cofre.columns:
-                t = df_cofre["Tipo"].astype(str).str.lower()
-                entradas = Decimal(str(df_cofre.loc[t.eq("entrada"), "Valor"].sum()))
-                saidas   = Decimal(str(df_cofre.loc[t.isin(["saída","saida"]), "Valor"].sum()))
-            saldo_cofre = entradas - saidas
-
-        # Ajuste: PDV sem vínculo (não duplicar os que já tem Vinculo_ID no cofre)
-        try:
-            mov_pdv = buscar_dados(spreadsheet, ABA_MOV_PDV) or []
-            df_pdv = pd.DataFrame(mov_pdv)
-            if not df_pdv.empty and {"Valor","Tipo_Mov"}.issubset(df_pdv.columns):
-                df_pdv["Valor"] = pd.to_numeric(df_pdv["Valor"], errors="coerce").fillna(0.0)
-                cofre_vinc = set(df_cofre["Vinculo_ID"].astype(str)) if (not df_cofre.empty and "Vinculo_ID" in df_cofre.columns) else set()
-                if "Vinculo_ID" in df_pdv.columns:
-                    df_pdv = df_pdv[~df_pdv["Vinculo_ID"].astype(str).isin(cofre_vinc)]
-                supr = df_pdv.loc[df_pdv["Tipo_Mov"].astype(str).str.lower().eq("suprimento"), "Valor"].sum()
-                sang = df_pdv.loc[df_pdv["Tipo_Mov"].astype(str).str.lower().eq("sangria"), "Valor"].sum()
-                saldo_cofre += Decimal(str(sang)) - Decimal(str(supr))
-        except Exception:
-            pass
+        saldo_cofre = livro_cofre(spreadsheet).saldo()
 
         st.markdown(
             f"""
@@ -2434,6 +4425,12 @@ def render_cofre(spreadsheet):
                 key="cofre_tipo_saida"
             )
 
+        # o Vinculo_ID sai do conteúdo do formulário + um lote que só muda quando confirmar() termina:
+        # salvar de novo a mesma movimentação após uma falha parcial completa as abas que faltaram
+        # sem duplicar as outras; uma movimentação diferente ganha outro ID
+        if "cofre_lote" not in st.session_state:
+            st.session_state["cofre_lote"] = uuid.uuid4().hex
+
         with st.form("form_mov_cofre", clear_on_submit=True):
             valor = st.number_input("Valor da Movimentação (R$)", min_value=0.01, step=0.01, format="%.2f", key="cofre_valor")
             categoria, origem, destino = "", "", ""
@@ -2499,10 +4496,13 @@ def render_cofre(spreadsheet):
                 if float(valor) <= 0:
                     st.warning("Informe um valor maior que zero.")
                 else:
+                    conteudo = "|".join(str(c) for c in (
+                        st.session_state["cofre_lote"], data_mov, tipo_mov, categoria, origem, destino,
+                        f"{float(valor):.2f}", obs_user, detalhes_banco))
+                    vinculo_id = "COFRE-" + hashlib.sha1(conteudo.encode("utf-8")).hexdigest()[:8]
                     try:
-                        # 1) Registra no COFRE
-                        ws_cofre = get_or_create_worksheet(spreadsheet, ABA_COFRE, HEADERS_COFRE)
-                        vinculo_id = _gerar_id("COFRE")
+                        # 1) Registra no COFRE (todas as abas espelhadas saem numa única transação)
+                        tx = TransacaoPlanilhas(spreadsheet)
                         hora_agora = obter_horario_brasilia()
 
                         # Complementa observação quando for Depósito Banco
@@ -2511,62 +4511,61 @@ def render_cofre(spreadsheet):
                             if detalhes_banco:
                                 obs_final = f"{obs_final} Banco: {detalhes_banco}."
 
-                        ws_cofre.append_row([
+                        tx.adicionar(ABA_COFRE, HEADERS_COFRE, [
                             str(data_mov), str(hora_agora), st.session_state.get("nome_usuario",""),
                             tipo_mov, categoria, origem, destino, float(valor),
                             obs_final, "Concluído", vinculo_id
-                        ])
+                        ], vinculo_id=vinculo_id)
 
                         # 2) Integrações automáticas
                         # 2.1) Saída -> Caixa Interno  => Suprimento no Operacoes_Caixa
                         if (tipo_mov == "Saída") and (destino == "Caixa Interno"):
-                            ws_caixa = get_or_create_worksheet(spreadsheet, ABA_CAIXA_INTERNO, HEADERS_CAIXA)
-                            ws_caixa.append_row([
+                            tx.adicionar(ABA_CAIXA_INTERNO, HEADERS_CAIXA, [
                                 str(data_mov), str(hora_agora), st.session_state.get("nome_usuario",""),
                                 "Suprimento", "Sistema", "N/A",
                                 float(valor), 0.0, 0.0, float(valor), 0.0,
                                 "Concluído", "", "0.00%",
-                                f"Transferência do Cofre → Caixa Interno. Vínculo {vinculo_id}."
-                            ])
+                                f"Transferência do Cofre → Caixa Interno. Vínculo {vinculo_id}.",
+                                NORMALIZADO_SIM, "", vinculo_id
+                            ], vinculo_id=vinculo_id)
 
                         # 2.2) Saída -> PDV (Caixa Lotérica) => PDV: Suprimento + Fechamento: Suprimento_Cofre
                         if (tipo_mov == "Saída") and isinstance(destino, str) and destino.startswith("Caixa Lotérica - "):
                             pdv_code = "PDV 1" if "PDV 1" in destino else "PDV 2"
-                            ws_mov_pdv = get_or_create_worksheet(spreadsheet, ABA_MOV_PDV, HEADERS_MOV_PDV)
-
-                            mov_exist = buscar_dados(spreadsheet, ABA_MOV_PDV) or []
-                            df_mov = pd.DataFrame(mov_exist)
-                            ja_existe = (not df_mov.empty and "Vinculo_ID" in df_mov.columns
-                                         and df_mov["Vinculo_ID"].astype(str).eq(vinculo_id).any())
-                            if not ja_existe:
-                                ws_mov_pdv.append_row([
-                                    str(data_mov), str(hora_agora),
-                                    pdv_code, "Suprimento",
-                                    float(valor), vinculo_id, st.session_state.get("nome_usuario",""),
-                                    f"Cofre → {pdv_code}. {obs_user or ''}"
-                                ])
-                            _try_registrar_no_fechamento_pdv(data_mov, pdv_code, "Suprimento", valor, vinculo_id, obs_user)
+                            tx.adicionar(ABA_MOV_PDV, HEADERS_MOV_PDV, [
+                                str(data_mov), str(hora_agora),
+                                pdv_code, "Suprimento",
+                                float(valor), vinculo_id, st.session_state.get("nome_usuario",""),
+                                f"Cofre → {pdv_code}. {obs_user or ''}"
+                            ], vinculo_id=vinculo_id)
+                            _try_registrar_no_fechamento_pdv(tx, data_mov, pdv_code, "Suprimento", valor, vinculo_id, obs_user)
 
                         # 2.3) Entrada (Sangria dos PDVs) => PDV: Sangria + Fechamento: Retirada_Cofre
                         if (tipo_mov == "Entrada") and (categoria == "Sangria dos PDVs") and (origem in ["PDV 1","PDV 2"]):
-                            ws_mov_pdv = get_or_create_worksheet(spreadsheet, ABA_MOV_PDV, HEADERS_MOV_PDV)
-                            mov_exist = buscar_dados(spreadsheet, ABA_MOV_PDV) or []
-                            df_mov = pd.DataFrame(mov_exist)
-                            ja_existe = (not df_mov.empty and "Vinculo_ID" in df_mov.columns
-                                         and df_mov["Vinculo_ID"].astype(str).eq(vinculo_id).any())
-                            if not ja_existe:
-                                ws_mov_pdv.append_row([
-                                    str(data_mov), str(hora_agora),
-                                    origem, "Sangria",
-                                    float(valor), vinculo_id, st.session_state.get("nome_usuario",""),
-                                    f"{origem} → Cofre. {obs_user or ''}"
-                                ])
-                            _try_registrar_no_fechamento_pdv(data_mov, origem, "Sangria", valor, vinculo_id, obs_user)
-
-                        st.success(f"✅ Movimentação de R$ {valor:,.2f} registrada, integrada ao PDV e refletida no Fechamento.")
-                        st.cache_data.clear()
+                            tx.adicionar(ABA_MOV_PDV, HEADERS_MOV_PDV, [
+                                str(data_mov), str(hora_agora),
+                                origem, "Sangria",
+                                float(valor), vinculo_id, st.session_state.get("nome_usuario",""),
+                                f"{origem} → Cofre. {obs_user or ''}"
+                            ], vinculo_id=vinculo_id)
+                            _try_registrar_no_fechamento_pdv(tx, data_mov, origem, "Sangria", valor, vinculo_id, obs_user)
+
+                        esperadas = len(tx)
+                        gravadas = tx.confirmar()
+                        retentativa = st.session_state.pop("cofre_falhou", None) == vinculo_id
+                        del st.session_state["cofre_lote"]
+
+                        if gravadas < esperadas and not retentativa:
+                            st.error(f"❌ {esperadas - gravadas} de {esperadas} linha(s) não foram gravadas: "
+                                     f"o vínculo {vinculo_id} já existe na planilha. Confira o histórico.")
+                        elif gravadas < esperadas:
+                            st.success(f"✅ Movimentação de R$ {valor:,.2f} completada "
+                                       f"({esperadas - gravadas} linha(s) já tinham sido gravadas na tentativa anterior).")
+                        else:
+                            st.success(f"✅ Movimentação de R$ {valor:,.2f} registrada, integrada ao PDV e refletida no Fechamento.")
 
                     except Exception as e:
+                        st.session_state["cofre_falhou"] = vinculo_id
                         st.error(f"❌ Erro ao salvar movimentação: {e}")
 
     # =========================
@@ -2575,16 +4574,25 @@ def render_cofre(spreadsheet):
     with tab2:
         st.markdown("#### Histórico de Movimentações")
         try:
-            cofre_hist = buscar_dados(spreadsheet, ABA_COFRE) or []
-            dfh = pd.DataFrame(cofre_hist)
-            if not dfh.empty:
-                if "Data" in dfh.columns:
-                    try: dfh["Data"] = pd.to_datetime(dfh["Data"], errors="coerce")
-                    except Exception: pass
-                sort_cols = [c for c in ["Data","Hora"] if c in dfh.columns]
-                if sort_cols:
-                    dfh = dfh.sort_values(by=sort_cols, ascending=False)
-                st.dataframe(dfh, use_container_width=True)
+            ctx = ContextoDados(spreadsheet)
+            consulta = ctx.historico_cofre()
+            if not consulta.df.empty:
+                h1, h2, h3 = st.columns(3)
+                with h1: h_ini = st.date_input("Início", value=None, key="cofre_hist_ini")
+                with h2: h_fim = st.date_input("Fim", value=None, key="cofre_hist_fim")
+                with h3: h_tipo = st.selectbox("Tipo", ["Todos", "Entrada", "Saída"], key="cofre_hist_tipo")
+                filtro = dict(ini=h_ini, fim=h_fim, tipo=None if h_tipo == "Todos" else h_tipo)
+                _, n_mov, somas = consulta.consultar(**filtro, por_pagina=0)
+                n_paginas = max(1, -(-n_mov // ConsultaHistorico.POR_PAGINA))
+                pagina = st.number_input("Página", min_value=1, max_value=n_paginas, value=1, step=1,
+                                         key="cofre_hist_pagina")
+                dfh, _, _ = consulta.consultar(**filtro, pagina=pagina)
+                st.dataframe(_com_data(dfh), use_container_width=True)
+                st.caption(f"Página {pagina} de {n_paginas} — {n_mov} movimentações, "
+                           f"somando R$ {somas.get('Valor', 0.0):,.2f}.")
+                botao_exportacao("⬇️ Baixar histórico", "historico_cofre",
+                                 ("historico_cofre", tuple(filtro.items()), ctx.versoes([ABA_COFRE])),
+                                 lambda: _com_data(consulta.linhas(**filtro)), key="exp_hist_cofre")
             else:
                 st.info("Nenhuma movimentação registrada no cofre.")
         except Exception:
@@ -2601,19 +4609,9 @@ def render_fechamento_diario_simplificado(spreadsheet):
 
     st.subheader("🗓️ Fechamento Diário do Caixa Interno")
 
-    # Configuração de tipos
-    TIPOS_SAQUE  = ["Saque Cartão Débito", "Saque Cartão Crédito"]
-    TIPOS_PIX    = ["Saque PIX"]
-    TIPOS_CHEQUE = ["Cheque à Vista", "Cheque Pré-datado", "Cheque com Taxa Manual"]
-
     # ORDEM OFICIAL DA ABA (agora com PIX)
     SHEET = "Fechamento_Diario_Caixa_Interno"
-    HEADERS_FECHAMENTO = [
-        "Data_Fechamento", "Operador", "Saldo_Dia_Anterior",
-        "Total_Saques_Cartao", "Total_Saques_PIX", "Total_Trocas_Cheque",
-        "Total_Suprimentos", "Saldo_Calculado_Dia", "Dinheiro_Contado_Gaveta",
-        "Diferenca_Caixa", "Observacoes_Fechamento"
-    ]
+    HEADERS_FECHAMENTO = HEADERS_FECHAMENTO_CAIXA_INTERNO
 
     # Garante a worksheet no formato correto (e migra header se preciso)
     ws = get_or_create_worksheet(spreadsheet, SHEET, HEADERS_FECHAMENTO)
@@ -2624,37 +4622,17 @@ def render_fechamento_diario_simplificado(spreadsheet):
     except Exception:
         pass
 
-    # -------- helper: calcula totais do dia (com PIX) --------
-    def _calcular_totais_dia(data_ref, saldo_anterior):
-        operacoes = buscar_dados(spreadsheet, "Operacoes_Caixa") or []
-        df = pd.DataFrame(normalizar_dados_inteligente(operacoes)) if operacoes else pd.DataFrame()
+    # -------- helper: totais do dia (com PIX), do resumo diário do Caixa Interno --------
+    ctx = ContextoDados(spreadsheet)
 
-        if df.empty:
-            return 0.0, 0.0, 0.0, 0.0, float(saldo_anterior), pd.DataFrame()
-
-        # tipagem
-        for c in ["Valor_Bruto", "Taxa_Cliente", "Taxa_Banco", "Valor_Liquido", "Lucro"]:
-            if c in df.columns: df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0.0)
-        try:
-            df["Data"] = pd.to_datetime(df["Data"], errors="coerce").dt.date
-        except Exception:
-            pass
-        df.dropna(subset=["Data"], inplace=True)
-
-        dia = df[df["Data"] == data_ref]
-
-        total_saques_cartao = dia[dia["Tipo_Operacao"].isin(TIPOS_SAQUE)]["Valor_Liquido"].sum()
-        total_saques_pix    = dia[dia["Tipo_Operacao"].isin(TIPOS_PIX)]["Valor_Liquido"].sum()
-        total_trocas_cheque = dia[dia["Tipo_Operacao"].isin(TIPOS_CHEQUE)]["Valor_Liquido"].sum()
-        total_suprimentos   = dia[dia["Tipo_Operacao"].eq("Suprimento")]["Valor_Bruto"].sum()
-
-        saldo_calc = float(saldo_anterior + total_suprimentos - (total_saques_cartao + total_saques_pix + total_trocas_cheque))
+    def _calcular_totais_dia(data_ref):
+        dia = caixa_interno_do_dia(ctx, data_ref)
         return (
-            float(total_saques_cartao),
-            float(total_saques_pix),
-            float(total_trocas_cheque),
-            float(total_suprimentos),
-            float(saldo_calc),
+            dia["saques_cartao"],
+            dia["saques_pix"],
+            dia["cheques"],
+            dia["suprimentos"],
+            float(dia["saldo"]),
             dia
         )
 
@@ -2673,15 +4651,9 @@ def render_fechamento_diario_simplificado(spreadsheet):
     saldo_dia_anterior = 0.0
     usou_zero = True
     try:
-        dados_fech = buscar_dados(spreadsheet, SHEET) or []
-        dff = pd.DataFrame(dados_fech)
-        if not dff.empty:
-            dff["Data_Fechamento"]   = pd.to_datetime(dff["Data_Fechamento"], errors="coerce").dt.date
-            dff["Saldo_Calculado_Dia"] = pd.to_numeric(dff.get("Saldo_Calculado_Dia", 0), errors="coerce").fillna(0.0)
-            prev = dff[dff["Data_Fechamento"] <= dia_anterior].sort_values("Data_Fechamento").tail(1)
-            if not prev.empty:
-                saldo_dia_anterior = float(prev.iloc[0]["Saldo_Calculado_Dia"])
-                usou_zero = False
+        resumo_dia = caixa_interno_do_dia(ctx, data_alvo)
+        saldo_dia_anterior = resumo_dia["saldo_anterior"]
+        usou_zero = not resumo_dia["tem_fechamento_anterior"]
     except Exception as e:
         st.warning(f"⚠️ Erro ao buscar saldos anteriores: {e}")
 
@@ -2692,10 +4664,10 @@ def render_fechamento_diario_simplificado(spreadsheet):
     st.markdown("---")
 
     # ---------------- 3) Totais do dia (preview) ----------------
-    total_cartao, total_pix, total_cheque, total_supr, saldo_calc, ops_dia = _calcular_totais_dia(data_alvo, saldo_dia_anterior)
+    total_cartao, total_pix, total_cheque, total_supr, saldo_calc, resumo_dia = _calcular_totais_dia(data_alvo)
 
     # alerta operacional
-    if not ops_dia.empty and (ops_dia["Tipo_Operacao"] == "Suprimento").sum() == 0:
+    if resumo_dia["operacoes"] and resumo_dia["qtd_suprimentos"] == 0:
         st.markdown(
             """
             <div style="background:#fff3cd;color:#856404;border:1px solid #ffeeba;padding:10px;border-radius:10px;">
@@ -2728,8 +4700,9 @@ def render_fechamento_diario_simplificado(spreadsheet):
         # se já existe fechamento na data, permitir sobrescrever
         existe_registro_alvo, row_alvo = False, None
         try:
+            dff = carregar_tabela(spreadsheet, SHEET)
             if not dff.empty:
-                ex = dff[dff["Data_Fechamento"] == data_alvo]
+                ex = dff[dff["Data_Fechamento"] == pd.Timestamp(data_alvo)]
                 if not ex.empty:
                     existe_registro_alvo, row_alvo = True, (ex.index[0] + 2)  # 1-based + header
         except Exception:
@@ -2745,7 +4718,7 @@ def render_fechamento_diario_simplificado(spreadsheet):
                 st.session_state.nome_usuario = "OPERADOR"
 
             # Recalcula no momento de gravar
-            t_cartao, t_pix, t_cheque, t_supr, t_saldo, _ = _calcular_totais_dia(data_alvo, saldo_dia_anterior)
+            t_cartao, t_pix, t_cheque, t_supr, t_saldo, _ = _calcular_totais_dia(data_alvo)
             diferenca = float(dinheiro_contado - t_saldo)
 
             linha = [
@@ -2775,18 +4748,17 @@ def render_fechamento_diario_simplificado(spreadsheet):
                 ws.append_row(linha)
                 st.success(f"✅ Fechamento de {data_alvo.strftime('%d/%m/%Y')} registrado com sucesso!")
 
-            st.cache_data.clear()
         except Exception as e:
             st.error(f"❌ Erro ao salvar fechamento: {e}")
 
     # ---------------- 6) Conferência ----------------
     with st.expander("🔍 Conferência rápida dessa data"):
-        st.write(f"Linhas na data {data_alvo}: {len(ops_dia)}")
-        if not ops_dia.empty:
+        st.write(f"Linhas na data {data_alvo}: {resumo_dia['operacoes']}")
+        if resumo_dia["operacoes"]:
             st.dataframe(
-                ops_dia.groupby("Tipo_Operacao", as_index=False)[
-                    ["Valor_Bruto", "Taxa_Cliente", "Taxa_Banco", "Valor_Liquido", "Lucro"]
-                ].sum().sort_values("Valor_Liquido", ascending=False),
+                ctx.resumo_caixa_interno().tabela(data_alvo)[
+                    ["Tipo_Operacao", "Valor_Bruto", "Taxa_Cliente", "Taxa_Banco", "Valor_Liquido", "Lucro"]
+                ],
                 use_container_width=True
             )
 
@@ -2803,12 +4775,7 @@ def render_gestao_caixa_interno(spreadsheet):
     st.subheader("🛠️ Gestão do Caixa Interno — Fechamentos")
 
     SHEET = "Fechamento_Diario_Caixa_Interno"
-    EXPECTED_HEADERS = [
-        "Data_Fechamento", "Operador", "Saldo_Dia_Anterior",
-        "Total_Saques_Cartao", "Total_Saques_PIX", "Total_Trocas_Cheque",
-        "Total_Suprimentos", "Saldo_Calculado_Dia", "Dinheiro_Contado_Gaveta",
-        "Diferenca_Caixa", "Observacoes_Fechamento"
-    ]
+    EXPECTED_HEADERS = HEADERS_FECHAMENTO_CAIXA_INTERNO
 
     # ---------- helpers ----------
     def _col_letter(idx_1based: int) -> str:
@@ -2869,28 +4836,14 @@ def render_gestao_caixa_interno(spreadsheet):
         df = pd.DataFrame(rows, columns=hdr)
         df["_row"] = list(range(2, 2 + len(df)))  # linha real na planilha (1 = cabeçalho)
 
-        # --- normalização robusta ---
-        # 1) Data: força datetime, remove inválidos, volta para date
-        df["Data_Fechamento"] = pd.to_datetime(df["Data_Fechamento"], errors="coerce")
+        # --- normalização pelo esquema da aba (datas, numéricos; cria Total_Saques_PIX se faltar) ---
+        df = tipar_frame(df, esquema_da_aba(SHEET, hdr))
         df = df.loc[~df["Data_Fechamento"].isna()].copy()  # remove linhas quebradas (evita comparar date x float)
         df["Data_Fechamento"] = df["Data_Fechamento"].dt.date
 
-        # 2) Numéricos
-        for c in [
-            "Saldo_Dia_Anterior", "Total_Saques_Cartao", "Total_Saques_PIX",
-            "Total_Trocas_Cheque", "Total_Suprimentos", "Saldo_Calculado_Dia",
-            "Dinheiro_Contado_Gaveta", "Diferenca_Caixa"
-        ]:
-            if c in df.columns:
-                df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0.0)
-
-        # compat: se não existir, cria coluna PIX zerada
-        if "Total_Saques_PIX" not in df.columns:
-            df["Total_Saques_PIX"] = 0.0
-
         return df
 
-    tab_hist, tab_edit = st.tabs(["📜 Histórico", "✏️ Editar / Remover"])
+    tab_hist, tab_edit, tab_reparo = st.tabs(["📜 Histórico", "✏️ Editar / Remover", "🧰 Reparo de Escala"])
 
     # -------------------- HISTÓRICO --------------------
     with tab_hist:
@@ -2952,6 +4905,58 @@ def render_gestao_caixa_interno(spreadsheet):
                 )
 
     # ----------------- EDITAR / REMOVER ----------------
+    # -------------------- REPARO DE ESCALA (Operacoes_Caixa) --------------------
+    with tab_reparo:
+        if "gerente" not in str(st.session_state.get("tipo_usuario", "")).lower():
+            st.info("Somente o gerente pode reparar a escala das operações do Caixa Interno.")
+        else:
+            st.caption(
+                "Grava em Operacoes_Caixa a correção de escala (taxa/líquido em centavos ou x10) que hoje é "
+                "refeita a cada leitura. Os valores originais ficam em Fator_Correcao e o reparo pode ser desfeito."
+            )
+            c1, c2 = st.columns(2)
+            try:
+                if c1.button("🔍 Prévia do reparo", key="btn_previa_reparo_escala", use_container_width=True):
+                    st.session_state["previa_reparo_escala"] = previa_reparo_escala(spreadsheet)
+                    st.session_state.pop("previa_desfazer_reparo_escala", None)
+                if c2.button("↩️ Prévia para desfazer", key="btn_previa_desfazer_reparo", use_container_width=True):
+                    st.session_state["previa_desfazer_reparo_escala"] = previa_desfazer_reparo_escala(spreadsheet)
+                    st.session_state.pop("previa_reparo_escala", None)
+            except Exception as e:
+                st.error(f"❌ Erro ao ler Operacoes_Caixa: {e}")
+
+            previa = st.session_state.get("previa_reparo_escala")
+            if previa is not None:
+                if previa.empty:
+                    st.success("✅ Nenhuma operação precisa de reparo.")
+                else:
+                    st.warning(f"⚠️ {previa['Linha'].nunique()} linha(s) e {len(previa)} campo(s) serão alterados:")
+                    st.dataframe(previa, hide_index=True, use_container_width=True)
+                    confirma = st.checkbox("Confirmo a gravação destas alterações", key="chk_reparo_escala")
+                    if st.button("🛠️ Aplicar reparo", key="btn_aplicar_reparo_escala", disabled=not confirma):
+                        try:
+                            n = reparar_escala_operacoes_caixa(spreadsheet, previa)
+                            st.session_state.pop("previa_reparo_escala", None)
+                            st.success(f"✅ {n} linha(s) reparada(s).")
+                        except Exception as e:
+                            st.error(f"❌ Erro ao reparar: {e}")
+
+            previa = st.session_state.get("previa_desfazer_reparo_escala")
+            if previa is not None:
+                if previa.empty:
+                    st.success("✅ Nenhum reparo gravado para desfazer.")
+                else:
+                    st.warning(f"⚠️ {previa['Linha'].nunique()} linha(s) voltarão aos valores originais:")
+                    st.dataframe(previa, hide_index=True, use_container_width=True)
+                    confirma = st.checkbox("Confirmo a restauração dos valores originais", key="chk_desfazer_reparo")
+                    if st.button("↩️ Desfazer reparo", key="btn_desfazer_reparo_escala", disabled=not confirma):
+                        try:
+                            n = desfazer_reparo_escala(spreadsheet, previa)
+                            st.session_state.pop("previa_desfazer_reparo_escala", None)
+                            st.success(f"✅ {n} linha(s) restaurada(s).")
+                        except Exception as e:
+                            st.error(f"❌ Erro ao desfazer: {e}")
+
     with tab_edit:
         df = _load_df()
         if df.empty:
@@ -3068,7 +5073,6 @@ def render_gestao_caixa_interno(spreadsheet):
                 last_col = _col_letter(len(HEADERS))  # ex.: 11 -> 'K'
                 ws.update(f"A{row_idx}:{last_col}{row_idx}", [linha])
                 st.success("✅ Registro atualizado com sucesso!")
-                st.cache_data.clear()
                 st.rerun()
             except Exception as e:
                 st.error(f"❌ Erro ao atualizar: {e}")
@@ -3077,7 +5081,6 @@ def render_gestao_caixa_interno(spreadsheet):
             try:
                 ws.delete_rows(row_idx)
                 st.success("🗑️ Registro removido com sucesso!")
-                st.cache_data.clear()
                 st.rerun()
             except Exception as e:
                 st.error(f"❌ Erro ao remover: {e}")
@@ -3091,8 +5094,8 @@ def main():
         if not verificar_login():
             return
 
-        # Conectar ao Google Sheets
-        spreadsheet = conectar_google_sheets()
+        # Conectar ao armazenamento (Google Sheets ou SQLite local)
+        spreadsheet = conectar_armazenamento()
         if not spreadsheet:
             st.error("❌ Não foi possível conectar ao Google Sheets. Verifique as credenciais.")
             return